@@ -0,0 +1,361 @@
+"""In-process equivalent of `applytopup --method=jac --interp=spline`.
+
+The off-resonance field (Hz) that topup writes with --fout is converted to a voxel displacement along the phase encode
+axis of the selected acquisition parameter row. Each volume is resampled along that axis with cubic B-splines and
+multiplied by the Jacobian of the displacement. Volumes are streamed through in chunks that share the same sample
+positions and weights, so the interpolation setup is shared by all volumes in a run and memory use is bounded. The
+displacement, Jacobian and sampling weights are cached per (topup result, acquisition row, grid) and reused by every
+file with that geometry.
+
+Rigid body movement estimated by topup (topup_movpar.txt) is not applied. For the row of the first fieldmap it is zero
+by definition; for other rows a warning is logged when the movement isn't negligible.
+"""
+
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nb
+import numpy as np
+from nibabel.openers import Opener
+from nibabel.volumeutils import seek_tell
+from scipy import ndimage
+
+from fw_gear_fsl_topup.nifti import nifti_path
+
+log = logging.getLogger(__name__)
+
+_maps_cache = OrderedDict()
+# keys whose maps are being computed, set once they are in _maps_cache (or the computation failed)
+_maps_pending = {}
+_maps_lock = threading.Lock()
+
+# volumes read and corrected at once when no chunk size is given
+BATCH_VOLUMES = 16
+
+# movement (mm or radians) above which the skipped rigid body component is worth a warning
+MOVEMENT_TOLERANCE = 0.05
+
+# number of (topup result, acquisition row, grid) correction map sets kept in memory
+MAPS_CACHE_SIZE = 4
+
+# largest difference (mm) between the affines of the topup field and an image to correct that is still the same grid
+AFFINE_TOLERANCE = 1e-3
+
+# maximum allowed difference from FSL's applytopup, relative to the largest FSL intensity
+VALIDATION_TOLERANCE = 0.02
+
+
+def read_acq_params(acq_params):
+    """Reads an acquisition parameters file into an (n, 4) array."""
+    return np.atleast_2d(np.loadtxt(acq_params, dtype=np.float64))
+
+
+def read_movpar(topup_out):
+    """Reads topup's movement parameters (one row of 6 per input volume), or None if they weren't written."""
+    movpar = topup_out + "_movpar.txt"
+    if not os.path.exists(movpar):
+        return None
+    return np.atleast_2d(np.loadtxt(movpar, dtype=np.float64))
+
+
+def displacement_map(topup_out, acq_row, affine, shape):
+    """Converts topup's field map into a voxel displacement along the phase encode axis.
+
+    Args:
+        topup_out (str): the topup root path (the field is read from <topup_out>-fmap)
+        acq_row (array): the acquisition parameter row (phase encode vector and total readout time)
+        affine (array): affine of the image to correct
+        shape (tuple): spatial shape of the image to correct
+
+    Raises:
+        ValueError: if the image is not on the grid of the field (shape, or affine within AFFINE_TOLERANCE)
+
+    Returns:
+        displacement (numpy.ndarray): displacement in voxels along `axis`
+        axis (int): the phase encode axis
+    """
+    fmap = nb.load(nifti_path(topup_out + "-fmap"))
+    if tuple(fmap.shape[:3]) != tuple(shape[:3]):
+        raise ValueError("Image shape {} does not match the topup field {}".format(shape[:3], fmap.shape[:3]))
+    # the field is used voxel for voxel, an image on another grid of the same shape would get a misregistered field
+    if not np.allclose(fmap.affine, np.asarray(affine, dtype=np.float64), rtol=0, atol=AFFINE_TOLERANCE):
+        raise ValueError("Image affine does not match the topup field, the image is on another grid:\n{}\n{}".format(
+            np.asarray(affine), fmap.affine))
+
+    field = np.asanyarray(fmap.dataobj, dtype=np.float64)
+    if field.ndim > 3:
+        field = field[..., 0]
+
+    pe = np.asarray(acq_row[:3], dtype=np.float64)
+    axis = int(np.argmax(np.abs(pe)))
+    displacement = field * acq_row[3] * pe[axis]
+
+    # FSL voxel coordinates run in the opposite direction along x for images with a neurological (positive
+    # determinant) voxel to world mapping
+    if axis == 0 and np.linalg.det(np.asarray(affine)[:3, :3]) > 0:
+        displacement = -displacement
+
+    return displacement, axis
+
+
+def jacobian_map(displacement, axis):
+    """Returns the Jacobian determinant of a displacement along one axis."""
+    return 1.0 + np.gradient(displacement, axis=axis)
+
+
+def sampling_weights(displacement, axis):
+    """Precomputes the cubic B-spline sample indices and weights for a displacement along one axis.
+
+    Returns:
+        indices (list): four index arrays (taps at floor(p)-1 ... floor(p)+2, mirrored into the image)
+        weights (list): the matching B-spline weights
+    """
+    n = displacement.shape[axis]
+    grid = np.arange(n, dtype=np.float64).reshape([-1 if d == axis else 1 for d in range(displacement.ndim)])
+    position = grid + displacement
+    base = np.floor(position)
+    t = position - base
+    base = base.astype(np.intp)
+
+    weights = [
+        (1 - t) ** 3 / 6,
+        (3 * t ** 3 - 6 * t ** 2 + 4) / 6,
+        (-3 * t ** 3 + 3 * t ** 2 + 3 * t + 1) / 6,
+        t ** 3 / 6,
+    ]
+    indices = [_mirror(base + offset, n) for offset in (-1, 0, 1, 2)]
+    return indices, weights
+
+
+def correction_maps(topup_out, acq_row, affine, shape):
+    """Returns the phase encode axis, Jacobian map and spline sampling weights for a target grid.
+
+    These only depend on the topup result, the acquisition parameter row and the target grid, so they are computed
+    once and reused by every run and echo sharing that geometry. The most recently used MAPS_CACHE_SIZE sets are kept.
+    The maps are computed outside the cache lock, so files with different geometries don't wait for each other; files
+    with the same geometry wait for the first one to compute them.
+
+    Args:
+        topup_out (str): the topup root path
+        acq_row (array): the acquisition parameter row
+        affine (array): affine of the image to correct
+        shape (tuple): shape of the image to correct
+
+    Returns:
+        axis (int): the phase encode axis
+        jacobian (numpy.ndarray): Jacobian map from jacobian_map
+        indices (list): sample indices from sampling_weights
+        weights (list): sample weights from sampling_weights
+    """
+    fmap = nifti_path(topup_out + "-fmap")
+    key = (os.path.realpath(fmap), os.stat(fmap).st_mtime_ns, tuple(np.asarray(acq_row).tolist()),
+           tuple(shape[:3]), np.round(np.asarray(affine, dtype=np.float64), 6).tobytes())
+
+    while True:
+        with _maps_lock:
+            if key in _maps_cache:
+                _maps_cache.move_to_end(key)
+                return _maps_cache[key]
+            computing = _maps_pending.get(key)
+            if computing is None:
+                computing = _maps_pending[key] = threading.Event()
+                break
+        computing.wait()
+
+    try:
+        displacement, axis = displacement_map(topup_out, acq_row, affine, shape)
+        maps = (axis, jacobian_map(displacement, axis)) + sampling_weights(displacement, axis)
+        with _maps_lock:
+            _maps_cache[key] = maps
+            while len(_maps_cache) > MAPS_CACHE_SIZE:
+                _maps_cache.popitem(last=False)
+    finally:
+        with _maps_lock:
+            del _maps_pending[key]
+        computing.set()
+
+    log.debug("Computed correction maps for row %s on grid %s", acq_row, shape[:3])
+    return maps
+
+
+def correct_volumes(data, axis, indices, weights, jacobian):
+    """Resamples a batch of volumes along the phase encode axis and applies the Jacobian modulation.
+
+    Args:
+        data (numpy.ndarray): 4D array (x, y, z, volumes) of volumes sharing the same geometry
+        axis (int): the phase encode axis
+        indices (list): sample indices from sampling_weights
+        weights (list): sample weights from sampling_weights
+        jacobian (numpy.ndarray): Jacobian map from jacobian_map
+
+    Returns:
+        (numpy.ndarray): the corrected volumes as float32
+    """
+    coefficients = ndimage.spline_filter1d(data, order=3, axis=axis, mode="mirror", output=np.float64)
+
+    corrected = np.zeros(data.shape, dtype=np.float64)
+    for index, weight in zip(indices, weights):
+        corrected += np.take_along_axis(coefficients, index[..., np.newaxis], axis=axis) * weight[..., np.newaxis]
+    corrected *= jacobian[..., np.newaxis]
+
+    return corrected.astype(np.float32)
+
+
+def apply_topup_native(image, inindex, topup_out, acq_params, output, chunk_volumes=BATCH_VOLUMES, workers=1):
+    """Applies a topup correction to an image in-process (Jacobian modulation, spline interpolation).
+
+    The image is read, corrected and written `chunk_volumes` volumes at a time, so peak memory depends on the chunk
+    size and not on the length of the run. Volumes are corrected independently, so the output is the same for any
+    chunk size.
+
+    Args:
+        image (str): path to the image to correct
+        inindex (str or int): 1-based row of the acquisition parameters file that matches the image
+        topup_out (str): the topup root path
+        acq_params (str): path to the acquisition parameters file
+        output (str): path of the corrected image (the .nii.gz extension is added if missing)
+        chunk_volumes (int): number of volumes read and corrected at once
+        workers (int): number of chunks corrected at the same time
+
+    Returns:
+        output (str): path to the corrected image
+    """
+    row = int(inindex) - 1
+    acq_row = read_acq_params(acq_params)[row]
+
+    movpar = read_movpar(topup_out)
+    if movpar is not None and row < len(movpar) and np.abs(movpar[row]).max() > MOVEMENT_TOLERANCE:
+        log.warning("Rigid body movement for row %d of %s is not applied by the native engine: %s",
+                    row + 1, acq_params, movpar[row])
+
+    img = nb.load(image)
+    axis, jacobian, indices, weights = correction_maps(topup_out, acq_row, img.affine, img.shape)
+
+    def correct(chunk):
+        return correct_volumes(chunk, axis, indices, weights, jacobian)
+
+    chunks = iter_volume_chunks(img, chunk_volumes or BATCH_VOLUMES)
+    if workers and workers > 1:
+        corrected = _bounded_map(correct, chunks, workers)
+    else:
+        corrected = map(correct, chunks)
+
+    output = _nifti_output(output)
+    write_volume_chunks(output, img, corrected)
+
+    return output
+
+
+def iter_volume_chunks(img, chunk_volumes):
+    """Reads an image sequentially, `chunk_volumes` volumes at a time.
+
+    NIfTI data is stored volume after volume, so each chunk is one contiguous read and compressed files are
+    decompressed once, front to back. The data is read from the image file of the file map (the .img of an image and
+    header pair); images that aren't backed by a file are sliced through their data proxy instead.
+
+    Args:
+        img (nibabel.Nifti1Image): the image to read
+        chunk_volumes (int): number of volumes per chunk
+
+    Yields:
+        (numpy.ndarray): 4D float64 array (x, y, z, volumes) holding the scaled voxel values of the chunk
+    """
+    shape = img.shape
+    n_volumes = shape[3] if len(shape) > 3 else 1
+    dtype = img.get_data_dtype()
+    volume_bytes = int(np.prod(shape[:3])) * dtype.itemsize
+    proxy = img.dataobj
+    image_file = img.file_map["image"].filename if "image" in img.file_map else None
+
+    if image_file is None or not hasattr(proxy, "offset"):
+        for start in range(0, n_volumes, chunk_volumes):
+            count = min(chunk_volumes, n_volumes - start)
+            if len(shape) > 3:
+                yield np.asarray(proxy[..., start:start + count], dtype=np.float64)
+            else:
+                yield np.asarray(proxy[...], dtype=np.float64)[..., np.newaxis]
+        return
+
+    with Opener(image_file, "rb") as fobj:
+        fobj.seek(proxy.offset)
+        for start in range(0, n_volumes, chunk_volumes):
+            count = min(chunk_volumes, n_volumes - start)
+            raw = fobj.read(volume_bytes * count)
+            chunk = np.frombuffer(raw, dtype=dtype).reshape(shape[:3] + (count,), order="F")
+            if proxy.slope != 1.0 or proxy.inter != 0.0:
+                yield chunk * proxy.slope + proxy.inter
+            else:
+                yield chunk.astype(np.float64)
+
+
+def write_volume_chunks(output, img, chunks):
+    """Writes float32 volumes chunk by chunk into a NIfTI image with the geometry and header of `img`.
+
+    Args:
+        output (str): path of the image to write
+        img (nibabel.Nifti1Image): image the header and affine are taken from
+        chunks (iterable): 4D arrays (x, y, z, volumes) in volume order
+    """
+    shape = img.shape
+    # a broadcast array has the right shape without allocating the data, it is only used to sync the header
+    template = nb.Nifti1Image(np.broadcast_to(np.float32(0), shape), img.affine, img.header.copy())
+    template.update_header()
+    header = template.header
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1.0, 0.0)
+    dtype = header.get_data_dtype()
+
+    with Opener(output, "wb") as fobj:
+        header.write_to(fobj)
+        seek_tell(fobj, header.get_data_offset(), write0=True)
+        for chunk in chunks:
+            fobj.write(np.asarray(chunk, dtype=dtype).tobytes(order="F"))
+
+
+def _bounded_map(func, iterable, workers):
+    """Like map, but runs up to `workers` calls at once and only reads ahead that many items."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def compare_to_fsl(native, fsl, tolerance=VALIDATION_TOLERANCE):
+    """Compares a natively corrected image with FSL's applytopup output.
+
+    Returns:
+        (bool): True if the largest voxel difference is within `tolerance` times the largest FSL intensity
+    """
+    native_data = np.asanyarray(nb.load(nifti_path(native)).dataobj, dtype=np.float64)
+    fsl_data = np.asanyarray(nb.load(nifti_path(fsl)).dataobj, dtype=np.float64)
+    if native_data.shape != fsl_data.shape:
+        log.info("Shape mismatch: %s %s vs %s %s", native, native_data.shape, fsl, fsl_data.shape)
+        return False
+
+    scale = np.abs(fsl_data).max() or 1.0
+    difference = np.abs(native_data - fsl_data).max() / scale
+    log.info("Native vs FSL applytopup for %s: max relative difference %.4g", os.path.basename(fsl), difference)
+    return difference <= tolerance
+
+
+def _mirror(index, n):
+    """Reflects indices into [0, n - 1] (whole sample symmetric, matching scipy's "mirror" mode)."""
+    if n == 1:
+        return np.zeros_like(index)
+    period = 2 * (n - 1)
+    index = np.abs(index) % period
+    return np.where(index >= n, period - index, index)
+
+
+def _nifti_output(path):
+    """Adds the .nii.gz extension FSL tools would add to an output name."""
+    path = str(path)
+    return path if path.endswith((".nii", ".nii.gz")) else path + ".nii.gz"
+
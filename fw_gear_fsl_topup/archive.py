@@ -0,0 +1,60 @@
+"""In-process replacement for `zip -q -r <archive> <dir>` used to package the gear results."""
+
+import logging
+import os
+import zipfile
+
+log = logging.getLogger(__name__)
+
+# members that are already compressed, deflating them again costs CPU for no size gain
+STORED_EXTENSIONS = (".gz", ".png", ".jpg", ".jpeg", ".zip", ".mgz")
+
+
+def zip_directory(archive, root_dir, base_dir, dry_run=False):
+    """Archives base_dir the same way as running `zip -q -r <archive> <base_dir>` from root_dir.
+
+    Members are added depth first in directory order, with an entry for every directory, and symlinks are followed.
+    Already compressed files (.nii.gz, .png, ...) are stored as they are and everything else is deflated. The archive
+    is written to a temporary name next to `archive` and renamed when complete; ZIP64 extensions are used when needed.
+
+    Args:
+        archive (str): path of the zip file to write
+        root_dir (str): directory the member names are relative to
+        base_dir (str): directory (relative to root_dir) to archive
+        dry_run (bool): only log what would be archived
+
+    Returns:
+        archive (str): path to the archive
+    """
+    log.info("Zipping %s into %s", os.path.join(str(root_dir), str(base_dir)), archive)
+    if dry_run:
+        return archive
+
+    partial = str(archive) + ".part"
+    n_members = 0
+    with zipfile.ZipFile(partial, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        for path, arcname in _walk(str(root_dir), str(base_dir)):
+            if arcname.endswith("/"):
+                zf.write(path, arcname)
+            elif arcname.lower().endswith(STORED_EXTENSIONS):
+                zf.write(path, arcname, compress_type=zipfile.ZIP_STORED)
+            else:
+                zf.write(path, arcname, compress_type=zipfile.ZIP_DEFLATED)
+            n_members += 1
+    os.replace(partial, archive)
+
+    log.info("Wrote %d members to %s", n_members, archive)
+    return archive
+
+
+def _walk(root_dir, name):
+    """Yields (path, member name) for name and everything below it, in the order zip -r adds them."""
+    path = os.path.join(root_dir, name)
+    if os.path.isdir(path):
+        yield path, name.rstrip("/") + "/"
+        with os.scandir(path) as it:
+            children = [entry.name for entry in it]
+        for child in children:
+            yield from _walk(root_dir, os.path.join(name, child))
+    elif os.path.exists(path):
+        yield path, name
@@ -0,0 +1,161 @@
+"""Batch mode: one gear run for many sessions.
+
+When the gear runs at the project level, or batch_sessions lists sessions, every selected session gets the same input
+resolution as a session level run (see parser.parse_config, inputs are downloaded from the session's BIDS curation into
+work-dir/<session id>) and the same pipeline (main.run). Up to batch_concurrent_sessions sessions are processed at a
+time, all on one Flywheel client, one download cache and one CPU and memory budget (resources.ResourcePool), so the
+stages of all sessions share the workers of a single container.
+
+A failing session doesn't stop the others: errors are tracked per session, and every session that succeeds writes its
+own archive (topup_<destination id>_sub-<subject>_ses-<session>.zip). The outcome of every session is written to
+topup_batch_summary.json in the output directory.
+"""
+
+import contextvars
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fw_gear_fsl_topup import main, resources
+from fw_gear_fsl_topup.download import DownloadCache
+from fw_gear_fsl_topup.parser import parse_config
+from utils.fly.set_performance_config import set_mem_gb, set_n_cpus
+
+log = logging.getLogger(__name__)
+
+SUMMARY_FILE = "topup_batch_summary.json"
+
+# inputs of a session level run that don't apply to the sessions of a batch
+SESSION_INPUTS = ("preprocessing-pipeline-zip", "bids-derivative-intended-for")
+
+# the session the current thread (and the stages it runs, see scheduler.py) works on
+current_session = contextvars.ContextVar("current_session", default=None)
+
+
+class SessionErrorHandler(logging.Handler):
+    """Like errorhandler.ErrorHandler, but only fires for errors logged while working on one session.
+
+    Args:
+        session_id (str): the session, compared to current_session when an error is logged
+    """
+
+    def __init__(self, session_id):
+        super().__init__(logging.ERROR)
+        self.session_id = session_id
+        self.fired = False
+        logging.getLogger().addHandler(self)
+
+    def emit(self, record):
+        if current_session.get() == self.session_id:
+            self.fired = True
+
+    def close(self):
+        logging.getLogger().removeHandler(self)
+        super().close()
+
+
+def batch_sessions(gear_context):
+    """Returns the sessions to run in batch mode, or None for a session level run.
+
+    Sessions are the ones listed in batch_sessions (ids, labels or "<subject label>/<session label>", separated by
+    commas or spaces) among the sessions of the destination's project, or all of them if the destination is a project
+    analysis and batch_sessions is empty.
+    """
+    client = gear_context.client
+    destination = client.get(gear_context.destination["id"])
+    wanted = (gear_context.config.get("batch_sessions") or "").replace(",", " ").split()
+    if not wanted and destination.parent.type != "project":
+        return None
+
+    project = client.get(destination.parents.project)
+    sessions = project.sessions()
+    if not wanted:
+        log.info("Running all %d sessions of project %s", len(sessions), project.label)
+        return sessions
+
+    selected = []
+    for entry in wanted:
+        matches = [session for session in sessions if entry in (session.id, session.label) or
+                   entry == "{}/{}".format(session.subject.label, session.label)]
+        if not matches:
+            log.warning("Session %s not found in project %s", entry, project.label)
+        selected.extend(match for match in matches if match not in selected)
+    log.info("Running %d sessions of project %s", len(selected), project.label)
+    return selected
+
+
+def run_batch(gear_context, sessions):
+    """Runs the pipeline for every session, returns 1 if any of them failed (or none was selected), 0 otherwise."""
+    if not sessions:
+        log.error("No sessions to run")
+        return 1
+    for name in SESSION_INPUTS:
+        if gear_context.get_input_path(name):
+            log.warning("Input %s is not used in batch mode, inputs are downloaded for each session", name)
+
+    # one budget and one download cache for all sessions
+    pool = resources.ResourcePool(set_n_cpus(int(gear_context.config.get("slurm-cpu") or 0)),
+                                  set_mem_gb(float(gear_context.config.get("mem_gb") or 0)))
+    download_cache = None
+    if gear_context.config.get("download_cache_gb") and gear_context.config.get("gear-writable-dir"):
+        download_cache = DownloadCache.from_options({
+            "download-cache-dir": os.path.join(gear_context.config.get("gear-writable-dir"), "download-cache"),
+            "download-cache-gb": gear_context.config.get("download_cache_gb"),
+        })
+
+    # the topup config is the same for every session, saved once (see main.save_qa_config)
+    if gear_context.config.get("QA") and not gear_context.config.get("topup_only"):
+        main.save_qa_config(gear_context, gear_context.output_dir)
+
+    n_sessions = max(1, min(len(sessions), int(gear_context.config.get("batch_concurrent_sessions") or 1)))
+    log.info("Running %d sessions, %d at a time, with %d CPUs", len(sessions), n_sessions, pool.cpus)
+    with ThreadPoolExecutor(max_workers=n_sessions) as executor:
+        outcomes = list(executor.map(lambda session: run_session(gear_context, session, pool, download_cache),
+                                     sessions))
+
+    failed = [outcome for outcome in outcomes if outcome["return_code"]]
+    for outcome in failed:
+        log.error("Session %s failed: %s", outcome["label"], outcome["error"] or "see the log")
+    log.info("Batch finished: %d of %d sessions succeeded", len(outcomes) - len(failed), len(outcomes))
+
+    # written under a temporary name and renamed, so a run killed while writing doesn't leave a truncated summary
+    summary = os.path.join(gear_context.output_dir, SUMMARY_FILE)
+    with open(summary + ".tmp", "w") as f:
+        json.dump(outcomes, f, indent=4)
+    os.replace(summary + ".tmp", summary)
+
+    return 1 if failed else 0
+
+
+def run_session(gear_context, session, pool, download_cache=None):
+    """Resolves the inputs of one session and runs its pipeline, any failure is contained to the session.
+
+    Returns:
+        outcome (dict): the session's "id", "label", "return_code", "error" and "seconds"
+    """
+    outcome = {"id": session.id, "label": session.label, "return_code": 1, "error": None, "seconds": None}
+    started = time.perf_counter()
+    token = current_session.set(session.id)
+    errors = None
+    try:
+        errors = SessionErrorHandler(session.id)
+        log.info("Starting session %s (%s)", session.label, session.id)
+        options = parse_config(gear_context, session=session, download_cache=download_cache)
+        outcome["label"] = options["batch-label"]
+
+        prepare_errors, _ = main.prepare(options=options)
+        if prepare_errors:
+            outcome["error"] = "; ".join(prepare_errors)
+        else:
+            outcome["return_code"] = main.run(options, gear_context, pool=pool, errors=errors)
+    except (Exception, SystemExit) as e:
+        outcome["error"] = str(e) or type(e).__name__
+        log.exception("Session %s failed", session.label)
+    finally:
+        if errors is not None:
+            errors.close()  # removes the handler from the root logger, even if the session raised
+        current_session.reset(token)
+    outcome["seconds"] = round(time.perf_counter() - started, 1)
+    return outcome
@@ -0,0 +1,201 @@
+"""Session level index of BIDS entities, sidecar metadata and NIfTI header information.
+
+The index is built once per session so pairing, acquisition parameter generation and apply-to resolution don't have to
+re-open the same sidecars and images. It can be saved to json and reloaded; entries for images whose size and
+modification time are unchanged, as are those of their sidecar, are reused instead of re-read.
+"""
+
+import json
+import logging
+import os
+
+import nibabel as nb
+
+log = logging.getLogger(__name__)
+
+NIFTI_EXTENSIONS = (".nii.gz", ".nii")
+
+
+def split_extension(path):
+    """Splits a NIfTI path into (root, extension), e.g. "sub-01_bold.nii.gz" -> ("sub-01_bold", ".nii.gz")."""
+    for ext in NIFTI_EXTENSIONS + (".json",):
+        if path.endswith(ext):
+            return path[:-len(ext)], ext
+    return os.path.splitext(path)
+
+
+def parse_entities(path):
+    """Parses the BIDS entities of a filename.
+
+    Args:
+        path (str): path to a BIDS file
+
+    Returns:
+        entities (dict): entity key/value pairs in filename order (e.g. {"sub": "01", "dir": "AP"})
+        suffix (str): the BIDS suffix (e.g. "epi", "bold")
+    """
+    root, _ = split_extension(os.path.basename(path))
+    parts = root.split("_")
+    entities = {}
+    for part in parts[:-1]:
+        key, _, value = part.partition("-")
+        entities[key] = value
+    return entities, parts[-1]
+
+
+class SessionIndex:
+    """Index of the NIfTI images (and their json sidecars) in one session.
+
+    Args:
+        root (str): directory the index was built from
+        entries (dict): per image entries, keyed by image path
+    """
+
+    def __init__(self, root, entries=None):
+        self.root = str(root)
+        self.entries = entries or {}
+        self._sidecars = {}
+
+    @classmethod
+    def build(cls, root, index_file=None):
+        """Scans root for NIfTI images and indexes them.
+
+        Args:
+            root (str): directory to scan (e.g. inputs-dir/sub-<label>)
+            index_file (str): previously saved index, unchanged entries are reused from it. The new index is saved here.
+
+        Returns:
+            (SessionIndex): the session index
+        """
+        previous = {}
+        if index_file and os.path.exists(index_file):
+            try:
+                with open(index_file) as f:
+                    previous = json.load(f).get("entries", {})
+            except (OSError, ValueError) as e:
+                log.warning("Ignoring unreadable index %s: %s", index_file, e)
+
+        index = cls(root)
+        reused = 0
+        for dirpath, _, filenames in os.walk(str(root), followlinks=True):
+            for name in sorted(filenames):
+                if not name.endswith(NIFTI_EXTENSIONS):
+                    continue
+                path = os.path.join(dirpath, name)
+                entry = previous.get(path)
+                if entry and entry["stat"] == _stat(path) and entry.get("sidecar_stat") == _sidecar_stat(path):
+                    index.entries[path] = entry
+                    reused += 1
+                else:
+                    index.add(path)
+
+        log.info("Indexed %d images in %s (%d reused from %s)", len(index.entries), root, reused, index_file)
+
+        if index_file:
+            index.save(index_file)
+
+        return index
+
+    def save(self, index_file):
+        """Saves the index to a json file."""
+        tmp = index_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"root": self.root, "entries": self.entries}, f)
+        os.replace(tmp, index_file)
+
+    def add(self, path):
+        """Reads one image's header and sidecar into the index."""
+        img = nb.load(path)
+        entities, suffix = parse_entities(path)
+
+        sidecar_path = split_extension(path)[0] + ".json"
+        sidecar = self.sidecar(sidecar_path) if os.path.exists(sidecar_path) else None
+
+        entry = {
+            "stat": _stat(path),
+            "sidecar_stat": _sidecar_stat(path),
+            "entities": entities,
+            "suffix": suffix,
+            "sidecar": sidecar,
+            "shape": [int(x) for x in img.shape],
+            "dtype": str(img.get_data_dtype()),
+            "affine": img.affine.tolist(),
+        }
+        self.entries[path] = entry
+        return entry
+
+    def get(self, path):
+        """Returns the entry for an image, indexing it first if it isn't in the index yet."""
+        path = str(path)
+        entry = self.entries.get(path)
+        if entry is None:
+            entry = self.add(path)
+        return entry
+
+    def sidecar(self, json_path):
+        """Returns the parsed contents of a json file, each file is only read once."""
+        json_path = str(json_path)
+        if json_path not in self._sidecars:
+            # reuse the copy stored with the image entry if we have one
+            for ext in NIFTI_EXTENSIONS:
+                entry = self.entries.get(split_extension(json_path)[0] + ext)
+                if entry and entry["sidecar"] is not None:
+                    self._sidecars[json_path] = entry["sidecar"]
+                    break
+            else:
+                with open(json_path) as f:
+                    self._sidecars[json_path] = json.load(f)
+        return self._sidecars[json_path]
+
+    def metadata(self, path, parameter):
+        """Returns a sidecar field for an image (or for a json file).
+
+        Raises:
+            KeyError: if the sidecar doesn't have the field
+        """
+        path = str(path)
+        if path.endswith(".json"):
+            return self.sidecar(path)[parameter]
+        sidecar = self.get(path)["sidecar"]
+        if sidecar is None:
+            raise KeyError(parameter)
+        return sidecar[parameter]
+
+    def shape(self, path):
+        """Returns the data shape of an image from its header."""
+        return tuple(self.get(path)["shape"])
+
+    def is4d(self, path):
+        """Returns True if an image has more than one volume."""
+        shape = self.shape(path)
+        return len(shape) > 3 and shape[3] > 1
+
+    def fieldmap_pairs(self, fmaps):
+        """Groups fieldmaps that only differ in their "dir" entity into pairs.
+
+        Args:
+            fmaps (list): paths to the fieldmap images
+
+        Returns:
+            pairs (list): [image 1, image 2] for each group of exactly two fieldmaps, sorted by the shared name
+        """
+        groups = {}
+        for path in fmaps:
+            entities, suffix = self.get(path)["entities"], self.get(path)["suffix"]
+            root, ext = split_extension(path)
+            shared = "_".join(["{}-{}".format(k, v) for k, v in entities.items() if k != "dir"] + [suffix])
+            key = os.path.join(os.path.dirname(root), shared) + ext
+            groups.setdefault(key, []).append(path)
+
+        return [groups[key] for key in sorted(groups) if len(groups[key]) == 2]
+
+
+def _stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _sidecar_stat(path):
+    """Returns the size and modification time of an image's json sidecar, None if it has none."""
+    sidecar_path = split_extension(path)[0] + ".json"
+    return _stat(sidecar_path) if os.path.exists(sidecar_path) else None
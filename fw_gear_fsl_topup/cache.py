@@ -0,0 +1,157 @@
+"""Content-addressed on-disk cache for topup results.
+
+Entries are keyed by a hash of the topup inputs (merged voxel data, acquisition parameters, config file and the
+requested outputs) and stored as one directory per key. Entries are published with an atomic rename and evicted
+least-recently-used first, so several gear runs can share one cache directory on scratch.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+
+import nibabel as nb
+import numpy as np
+
+from fw_gear_fsl_topup.nifti import nifti_path
+
+log = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+
+
+class TopupCache:
+    """A size bounded cache of topup result files.
+
+    Args:
+        cache_dir (str): directory holding the cache entries
+        max_gb (float): size bound of the cache in GiB, least recently used entries are evicted past it
+    """
+
+    def __init__(self, cache_dir, max_gb):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(float(max_gb) * 1024 ** 3)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_options(cls, options):
+        """Returns the cache configured in the gear options, or None if caching is disabled or unavailable."""
+        cache_dir = options.get("topup-cache-dir")
+        max_gb = options.get("topup-cache-gb")
+        if not cache_dir or not max_gb:
+            return None
+        try:
+            return cls(cache_dir, max_gb)
+        except OSError as e:
+            log.warning("Unable to use topup cache in %s: %s", cache_dir, e)
+            return None
+
+    def key(self, imain, acq_params, config_path, extra=()):
+        """Returns the cache key for a topup run.
+
+        Args:
+            imain (str): topup's --imain image (with or without the nifti extension)
+            acq_params (str): path to the acquisition parameters file
+            config_path (str): path to the topup config file
+            extra (iterable): any other settings that change topup's outputs (e.g. requested optional outputs)
+
+        Returns:
+            (str): hex digest identifying the run
+        """
+        digest = hashlib.sha256()
+
+        img = nb.load(nifti_path(imain))
+        data = np.asanyarray(img.dataobj)
+        digest.update(str(data.shape).encode())
+        digest.update(str(data.dtype).encode())
+        digest.update(np.ascontiguousarray(img.header.get_zooms()).tobytes())
+        digest.update(np.ascontiguousarray(img.affine).tobytes())
+        digest.update(np.ascontiguousarray(data).tobytes())
+
+        for path in (acq_params, config_path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+
+        digest.update(json.dumps(list(extra)).encode())
+
+        return digest.hexdigest()
+
+    def restore(self, key, out_dir):
+        """Copies a cached entry into out_dir.
+
+        Returns:
+            (bool): True if the entry was found and restored, False on a cache miss
+        """
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry, MANIFEST)) as f:
+                files = json.load(f)["files"]
+            for name in files:
+                shutil.copyfile(os.path.join(entry, name), os.path.join(out_dir, name))
+            # mark the entry as recently used
+            os.utime(entry)
+        except (FileNotFoundError, NotADirectoryError):
+            # never cached, or evicted while we were reading it
+            return False
+
+        log.info("Restored topup results from cache entry %s", key)
+        return True
+
+    def store(self, key, files):
+        """Publishes a new entry containing files.
+
+        The entry is assembled in a temporary directory and renamed into place, so other readers either see the
+        complete entry or no entry at all. If another run already published the same key, that entry is kept.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.exists(entry):
+            return
+
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        try:
+            names = []
+            for path in files:
+                name = os.path.basename(path)
+                shutil.copyfile(path, os.path.join(tmp, name))
+                names.append(name)
+            with open(os.path.join(tmp, MANIFEST), "w") as f:
+                json.dump({"files": names}, f)
+            os.rename(tmp, entry)
+            log.info("Stored topup results in cache entry %s", key)
+        except OSError as e:
+            # lost the race to another run, or the scratch volume is full
+            log.debug("Unable to publish cache entry %s: %s", key, e)
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in its size bound."""
+        entries = []
+        total = 0
+        for dirent in os.scandir(self.cache_dir):
+            if dirent.name.startswith(".") or not dirent.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(dirent.path))
+                entries.append((dirent.stat().st_mtime, size, dirent.path))
+            except FileNotFoundError:
+                continue
+            total += size
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            # rename first so the entry disappears atomically for any reader
+            doomed = os.path.join(self.cache_dir, ".evict-" + uuid.uuid4().hex)
+            try:
+                os.rename(path, doomed)
+            except OSError:
+                continue
+            shutil.rmtree(doomed, ignore_errors=True)
+            total -= size
+            log.debug("Evicted topup cache entry %s", os.path.basename(path))
+
@@ -0,0 +1,200 @@
+"""Stage completion markers that let an interrupted run resume where it stopped.
+
+When a checkpointed stage finishes, a marker is written to <work-dir>/checkpoints with a fingerprint of the stage's
+inputs, its result and the size and modification time of every output file named in the result. A rerun in the same
+work directory (see utils.singularity.run_in_tmp_dir) computes the fingerprint again before running a stage and reuses
+the recorded result if the marker matches and all of its outputs are unchanged.
+
+The fingerprint covers the stage's arguments (files by size and modification time, options by value) and the markers of
+the stages it depends on, so a stage that re-runs invalidates everything downstream of it. Paths a stage writes to are
+passed wrapped in Output, so the state of the stage's own output doesn't become part of its fingerprint. Markers are only written
+once a stage has finished and are replaced atomically, so an output left half-written by a killed run never has a
+valid marker.
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import stat
+
+log = logging.getLogger(__name__)
+
+MARKER_DIR = "checkpoints"
+
+# options and stage arguments that don't change any stage's outputs (budgets, clients, environment, caches), left out
+# of fingerprints. The destination is left out too: a retry is a new analysis, and only the stages that stage files
+# for its archive depend on it (through their staging directory argument)
+IGNORED_KEYS = (
+    "destination-id",
+    "output_analysis_id_dir",
+    "client",
+    "environ",
+    "bids-index",
+    "path-resolver",
+    "preproc_gear",
+    "n_cpus",
+    "mem_gb",
+    "max_concurrent_stages",
+    "workers",
+    "parallel_pairs",
+    "topup-cache-dir",
+    "topup-cache-gb",
+    "download-cache-dir",
+    "download-cache-gb",
+    "download-cache",
+    "qa-cache-dir",
+    "store",
+)
+
+
+class Output(str):
+    """A path a stage writes to, described by name only in fingerprints (see describe)."""
+
+
+class Checkpoints:
+    """Completion markers of the stages of one run.
+
+    Args:
+        marker_dir (str): directory the markers are kept in
+    """
+
+    def __init__(self, marker_dir):
+        self.marker_dir = marker_dir
+        os.makedirs(marker_dir, exist_ok=True)
+
+    @classmethod
+    def from_options(cls, options):
+        """Returns the markers of the run in the gear options' work directory, or None if resuming is disabled."""
+        if not options.get("resume") or options.get("dry-run"):
+            return None
+        return cls(os.path.join(str(options["work-dir"]), MARKER_DIR))
+
+    def marker_path(self, name):
+        """Returns the marker file of a stage."""
+        return os.path.join(self.marker_dir, re.sub(r"[^\w.-]", "_", name) + ".json")
+
+    def fingerprint(self, name, func, args, kwargs, deps=()):
+        """Returns a digest of a stage's inputs.
+
+        Args:
+            name (str): stage name
+            func (callable): the stage's work
+            args (list): resolved positional arguments
+            kwargs (dict): resolved keyword arguments
+            deps (list): digests of the markers of the stages it depends on (None for stages without one)
+        """
+        description = [name, getattr(func, "__qualname__", repr(func)), describe(args), describe(kwargs), list(deps)]
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def load(self, name, fingerprint):
+        """Returns the marker of a stage if it is complete for these inputs, None otherwise."""
+        try:
+            with open(self.marker_path(name)) as f:
+                marker = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if marker.get("fingerprint") != fingerprint:
+            log.info("Stage %s inputs changed since it last ran", name)
+            return None
+        for path, recorded in marker["outputs"].items():
+            if file_state(path) != recorded:
+                log.info("Stage %s output %s is missing or changed since it last ran", name, path)
+                return None
+        return marker
+
+    def save(self, name, fingerprint, result):
+        """Writes the marker of a stage that finished.
+
+        Returns:
+            marker (dict): the "fingerprint", "result", "outputs" ({path: [size, mtime_ns]}) and "digest" of the stage
+        """
+        # the result as a resumed run will read it back, so dependents see the same values (and types) either way
+        result = json.loads(json.dumps(result, default=str))
+        outputs = {path: file_state(path) for path in output_files(result)}
+        marker = {"fingerprint": fingerprint, "result": result, "outputs": outputs}
+        marker["digest"] = hashlib.sha256(json.dumps(marker, sort_keys=True, default=str).encode()).hexdigest()
+
+        path = self.marker_path(name)
+        with open(path + ".tmp", "w") as f:
+            json.dump(marker, f)
+        os.replace(path + ".tmp", path)
+        return marker
+
+    def completed(self, name):
+        """Returns the marker of a stage whose recorded outputs are all unchanged, whatever its inputs were.
+
+        Used to avoid resubmitting work whose inputs are known to be unchanged before the stage itself can run (e.g.
+        SLURM jobs submitted ahead of the stages that collect them), None if there is no such marker.
+        """
+        try:
+            with open(self.marker_path(name)) as f:
+                marker = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if all(file_state(path) == recorded for path, recorded in marker["outputs"].items()):
+            return marker
+        return None
+
+    def invalidate(self, name):
+        """Removes the marker of a stage, so it runs again."""
+        try:
+            os.remove(self.marker_path(name))
+        except FileNotFoundError:
+            pass
+
+
+def describe(value):
+    """Returns a json-able description of a stage argument.
+
+    Existing files are described by path, size and modification time (outputs, see Output, only by path); dicts and sequences element by element (leaving
+    out IGNORED_KEYS); other objects (clients, indexes, caches) only by type, as they don't define the outputs.
+    """
+    if isinstance(value, Output):
+        return str(value)
+    if isinstance(value, os.PathLike):
+        value = os.fspath(value)
+    if isinstance(value, str):
+        state = file_state(value) or file_state(value + ".nii.gz") or file_state(value + ".nii")
+        return [value, state] if state else value
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, dict):
+        return {str(key): describe(item) for key, item in value.items() if key not in IGNORED_KEYS}
+    if isinstance(value, (list, tuple)):
+        return [describe(item) for item in value]
+    return type(value).__name__
+
+
+def output_files(result):
+    """Lists the files named in a stage result: absolute paths of files, and the files of FSL style image roots."""
+    if isinstance(result, os.PathLike):
+        result = os.fspath(result)
+    if isinstance(result, str):
+        if not os.path.isabs(result):
+            return []
+        if os.path.isfile(result):
+            return [result]
+        if os.path.isdir(result):
+            return []
+        # e.g. the topup root path, whose outputs are <root>_fieldcoef.nii.gz, <root>-fmap.nii.gz, ...
+        return sorted(path for path in glob.glob(glob.escape(result) + "*") if os.path.isfile(path))
+    if isinstance(result, dict):
+        result = list(result.values())
+    if isinstance(result, (list, tuple)):
+        return list(dict.fromkeys(path for item in result for path in output_files(item)))
+    return []
+
+
+def file_state(path):
+    """Returns [size, mtime_ns] of a file, None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return [st.st_size, st.st_mtime_ns]
@@ -4,6 +4,8 @@ utils.args. They streamline the 'execute' functionality of the build/validate/ex
 paradigm followed in each of the other module-scripts in args.
 """
 
+import fnmatch
+import glob
 import os
 import subprocess as sp
 import re
@@ -101,27 +103,34 @@ def execute_shell(cmd, dryrun=False, cwd=os.getcwd()):
         return returnCode
 
 
-def searchfiles(path, dryrun=False, exit_on_errors=True, find_first=False) -> list[str]:
-    cmd = "ls -d " + path
+def searchfiles(path, dryrun=False, exit_on_errors=True, find_first=False, resolver=None) -> list[str]:
+    """Finds the files matching a path, which may contain glob patterns (the equivalent of `ls -d <path>`).
 
-    log.debug("\n %s", cmd)
+    Args:
+        path (str): path or glob pattern to look up
+        dryrun (bool): log the lookup without running it
+        exit_on_errors (bool): log a miss as an error (True) or as a warning (False)
+        find_first (bool): return only the first match
+        resolver (PathResolver): resolver to use, so directory listings can be shared between lookups
 
-    if not dryrun:
-        terminal = sp.Popen(
-            cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True
-        )
-        stdout, stderr = terminal.communicate()
-        returnCode = terminal.poll()
-        log.debug("\n %s", stdout)
-        log.debug("\n %s", stderr)
+    Returns:
+        files (list): sorted matching paths, or [""] if there were no matches
+    """
+    log.debug("\n searching %s", path)
 
-        files = stdout.strip("\n").split("\n")
+    if not dryrun:
+        resolver = resolver or PathResolver()
+        files = resolver.resolve(path)
 
-        if returnCode > 0 and exit_on_errors:
-            log.error("Error. \n%s\n%s", stdout, stderr)
+        if not files:
+            if exit_on_errors:
+                log.error("Error. \ncannot access '%s': No such file or directory", path)
+            else:
+                log.warning("Warning. \ncannot access '%s': No such file or directory", path)
+            # keep the shape of the previous `ls -d` output, callers check files[0]
+            files = [""]
 
-        if returnCode > 0 and not exit_on_errors:
-            log.warning("Warning. \n%s\n%s", stdout, stderr)
+        log.debug("\n %s", "\n".join(files))
 
         if find_first:
             files = files[0]
@@ -129,6 +138,132 @@ def searchfiles(path, dryrun=False, exit_on_errors=True, find_first=False) -> li
         return files
 
 
+class PathResolver:
+    """Resolves paths and glob patterns in-process.
+
+    Directory listings are read once with os.scandir and reused by every later lookup in the same directory. A prebuilt
+    listing (e.g. from a session index or zip index) can be passed in so lookups don't touch the filesystem at all.
+
+    Args:
+        listing (dict): optional {directory: [names]} listing to resolve against
+        complete (bool): the listing holds every file there is, directories missing from it are taken as empty
+    """
+
+    def __init__(self, listing=None, complete=False):
+        self._listing = {os.path.normpath(d): sorted(names) for d, names in (listing or {}).items()}
+        self.complete = complete
+
+    @classmethod
+    def from_paths(cls, paths):
+        """Builds a resolver whose listing contains exactly the given file paths (e.g. a SessionIndex's images)."""
+        listing = {}
+        for path in paths:
+            directory, name = os.path.split(os.path.normpath(str(path)))
+            listing.setdefault(directory, []).append(name)
+        return cls(listing, complete=True)
+
+    def listdir(self, directory):
+        """Returns the sorted names in a directory (empty if it doesn't exist)."""
+        directory = os.path.normpath(directory)
+        if directory not in self._listing and self.complete:
+            return []
+        if directory not in self._listing:
+            try:
+                with os.scandir(directory) as it:
+                    self._listing[directory] = sorted(entry.name for entry in it)
+            except (FileNotFoundError, NotADirectoryError):
+                self._listing[directory] = []
+        return self._listing[directory]
+
+    def resolve(self, pattern):
+        """Returns the sorted paths matching a path or glob pattern."""
+        pattern = str(pattern)
+        directory, name = os.path.split(pattern)
+
+        if glob.has_magic(directory):
+            # patterns in directory names are rare, let glob walk them
+            return sorted(glob.glob(pattern))
+
+        names = self.listdir(directory or os.curdir)
+        if glob.has_magic(name):
+            matches = fnmatch.filter(names, name)
+            if not name.startswith("."):
+                # like the shell, wildcards don't match hidden files
+                matches = [m for m in matches if not m.startswith(".")]
+        else:
+            matches = [name] if name in names else []
+
+        return [os.path.join(directory, m) for m in matches]
+
+    def resolve_many(self, patterns):
+        """Resolves a list of paths or patterns in one pass.
+
+        Returns:
+            found (list): matching paths, in the order of the patterns
+            missing (list): patterns that had no match
+        """
+        found = []
+        missing = []
+        for pattern in patterns:
+            matches = self.resolve(pattern)
+            if matches:
+                found.extend(matches)
+            else:
+                missing.append(str(pattern))
+        return found, missing
+
+
+def stage_file(src, dst):
+    """Places a copy of src at dst, avoiding writing the data again where the filesystem allows it.
+
+    A hard link is tried first, then a reflink (copy-on-write clone, e.g. on XFS or btrfs), and only then a full copy.
+    Links are only attempted when src and dst are on the same device. Symlinks in src are followed.
+
+    Args:
+        src (str): file to stage
+        dst (str): destination path, replaced if it exists
+
+    Returns:
+        method (str): "hardlink", "reflink" or "copy"
+    """
+    src = os.path.realpath(src)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError as e:
+            log.debug("Unable to hard link %s: %s", src, e)
+
+        if _reflink(src, dst):
+            return "reflink"
+
+    shutil.copy(src, dst)
+    return "copy"
+
+
+# ioctl request number to clone a file on Linux (FICLONE)
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    """Clones src into dst with a reflink, returns False if the filesystem doesn't support it."""
+    try:
+        import fcntl
+
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except (ImportError, OSError) as e:
+        log.debug("Unable to reflink %s: %s", src, e)
+        if os.path.lexists(dst):
+            os.remove(dst)
+        return False
+
+
 def apply_lookup(text, lookup_table):
     if '{' in text and '}' in text:
         for lookup in lookup_table:
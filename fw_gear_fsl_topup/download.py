@@ -0,0 +1,291 @@
+"""Download of session BIDS files from Flywheel through a local, versioned file cache.
+
+Files are located with their BIDS curation metadata (file.info.BIDS) the same way as flywheel_bids' download_bids_dir,
+but every file is keyed by its Flywheel file id and version (or modified timestamp). Downloaded files are kept in a
+cache under gear-writable-dir and staged into the BIDS directory from there, so reruns and config sweeps on the same
+session only fetch files that changed on the platform. Files already present in the target directory with the
+platform's size and modified time are skipped.
+
+Only the client methods used by download_bids_dir are called (get_session, get_session_acquisitions,
+get_acquisition, download_file_from_session and download_file_from_acquisition) and containers/files are read with
+dict style access, so a local fake client can stand in for Flywheel.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from fw_gear_fsl_topup.cache import TopupCache
+from fw_gear_fsl_topup.common import stage_file
+from fw_gear_fsl_topup.bids_index import NIFTI_EXTENSIONS, split_extension
+
+log = logging.getLogger(__name__)
+
+NAMESPACE = "BIDS"
+
+
+class DownloadCache(TopupCache):
+    """A size bounded cache of downloaded Flywheel files.
+
+    Each entry is a directory named after the file id and version holding the one file, entries are published with
+    an atomic rename and evicted least recently used first (see TopupCache).
+
+    Args:
+        cache_dir (str): directory holding the cache entries
+        max_gb (float): size bound of the cache in GiB
+    """
+
+    @classmethod
+    def from_options(cls, options):
+        """Returns the download cache configured in the gear options, or None if it is disabled or unavailable."""
+        cache_dir = options.get("download-cache-dir")
+        max_gb = options.get("download-cache-gb")
+        if not cache_dir or not max_gb:
+            return None
+        try:
+            return cls(cache_dir, max_gb)
+        except OSError as e:
+            log.warning("Unable to use download cache in %s: %s", cache_dir, e)
+            return None
+
+    def path(self, remote):
+        """Returns where a file is (or would be) stored in the cache."""
+        return os.path.join(self.cache_dir, remote["key"], remote["name"])
+
+    def lookup(self, remote):
+        """Returns the cached copy of a file, or None on a cache miss."""
+        path = self.path(remote)
+        if not os.path.exists(path):
+            return None
+        # mark the entry as recently used
+        os.utime(os.path.dirname(path))
+        return path
+
+    def fetch(self, client, remote):
+        """Downloads a file into the cache and returns its cached path.
+
+        The file is downloaded into a temporary entry that is renamed into place, if another run published the same
+        file in the meantime its copy is used.
+        """
+        entry = os.path.join(self.cache_dir, remote["key"])
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        try:
+            _download(client, remote, os.path.join(tmp, remote["name"]))
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                # lost the race to another run
+                log.debug("Cache entry %s already exists", remote["key"])
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp, ignore_errors=True)
+        return self.path(remote)
+
+
+def download_session_bids(client, session_id, target_dir, folders=None, paths=None, cache=None, n_workers=1,
+                          dry_run=False):
+    """Downloads a session's BIDS curated files into target_dir.
+
+    Args:
+        client: Flywheel client (or a fake exposing the same methods)
+        session_id (str): id of the session to download
+        target_dir (str): BIDS directory to download into (files are placed at <target_dir>/<info.BIDS.Path>/...)
+        folders (list): only download acquisition files in these BIDS folders (e.g. ['fmap']), all folders if None
+        paths (list): only download acquisition files at these paths (relative to target_dir) and their sidecars
+        cache (DownloadCache): cache to download through, files are downloaded straight into target_dir if None
+        n_workers (int): number of concurrent downloads
+        dry_run (bool): only log what would be downloaded
+
+    Returns:
+        counts (dict): number of files per outcome ("skipped", "cached", "downloaded")
+    """
+    remotes = list_session_files(client, session_id, target_dir, folders=folders, paths=paths)
+    counts = {"skipped": 0, "cached": 0, "downloaded": 0}
+
+    if dry_run:
+        for remote in remotes:
+            log.info("Would download %s to %s", remote["name"], remote["path"])
+        return counts
+
+    n_workers = max(1, min(len(remotes), n_workers or 1))
+    _pool_connections(client, n_workers)
+    log.info("Fetching %d files for session %s using %d workers", len(remotes), session_id, n_workers)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for outcome in executor.map(lambda remote: _fetch_one(client, remote, cache), remotes):
+            counts[outcome] += 1
+
+    write_missing_sidecars(remotes)
+
+    if cache is not None and counts["downloaded"]:
+        cache.evict()
+
+    log.info("Session %s: %d files unchanged, %d from cache, %d downloaded", session_id, counts["skipped"],
+             counts["cached"], counts["downloaded"])
+    return counts
+
+
+def list_session_files(client, session_id, target_dir, folders=None, paths=None):
+    """Lists the BIDS curated session and acquisition files of a session.
+
+    Returns:
+        remotes (list): one dict per file with the parent container ("container", "container_id"), the platform
+            "name", the cache "key", "size", "modified" (seconds since the epoch), destination "path" and "info"
+    """
+    session = client.get_session(session_id)
+    remotes = [_remote(f, "session", session_id, target_dir) for f in session.get("files") or []]
+
+    if paths is not None:
+        # the sidecars of the requested images are needed too
+        wanted = set()
+        for path in paths:
+            wanted.add(os.path.normpath(path))
+            wanted.add(os.path.normpath(split_extension(path)[0] + ".json"))
+
+    for ses_acq in client.get_session_acquisitions(session_id):
+        if _excluded(ses_acq):
+            continue
+        acq = client.get_acquisition(ses_acq["_id"])
+        for f in acq.get("files") or []:
+            metadata = _bids_metadata(f)
+            if folders is not None and (not metadata or metadata.get("Folder") not in folders):
+                continue
+            remote = _remote(f, "acquisition", acq["_id"], target_dir)
+            if remote and paths is not None and os.path.relpath(remote["path"], target_dir) not in wanted:
+                continue
+            remotes.append(remote)
+
+    remotes = [remote for remote in remotes if remote]
+    seen = {}
+    for remote in remotes:
+        if remote["path"] in seen:
+            log.error("Multiple files with path %s: %s and %s", remote["path"], seen[remote["path"]]["name"],
+                      remote["name"])
+        seen[remote["path"]] = remote
+    return list(seen.values())
+
+
+def write_missing_sidecars(remotes):
+    """Writes json sidecars from file metadata for NIfTIs that don't have a sidecar file (as download_bids_dir does)."""
+    paths = {remote["path"] for remote in remotes}
+    for remote in remotes:
+        if not remote["path"].endswith(NIFTI_EXTENSIONS) or remote["container"] != "acquisition":
+            continue
+        sidecar = split_extension(remote["path"])[0] + ".json"
+        if sidecar in paths or os.path.exists(sidecar):
+            continue
+        metadata = {key: value for key, value in (remote["info"] or {}).items() if key != NAMESPACE}
+        bids = _bids_metadata(remote) or {}
+        for key in bids.get("delete_info", []):
+            metadata.pop(key, None)
+        metadata.update(bids.get("set_info", {}))
+        if not metadata:
+            continue
+        with open(sidecar, "w") as f:
+            json.dump(metadata, f, sort_keys=True, indent=4)
+
+
+def _remote(f, container, container_id, target_dir):
+    """Describes one platform file, returns None if the file isn't part of the BIDS export."""
+    metadata = _bids_metadata(f)
+    if not metadata or str(metadata.get("ignore", False)).lower() in ("true", "1", "yes"):
+        return None
+    if metadata.get("Filename"):
+        if (metadata.get("Path") or "").startswith("sourcedata"):
+            return None
+        path = os.path.join(str(target_dir), metadata["Path"], metadata["Filename"])
+    elif f["name"].endswith((".json", ".tsv")):
+        path = os.path.join(str(target_dir), f["name"])
+    else:
+        return None
+
+    modified = f.get("modified")
+    modified = modified.timestamp() if hasattr(modified, "timestamp") else modified
+    version = f.get("version") or (int(modified) if modified is not None else None)
+    file_id = f.get("file_id") or f.get("_id") or "{}-{}".format(container_id, f["name"])
+
+    return {
+        "container": container,
+        "container_id": container_id,
+        "name": f["name"],
+        "key": "{}_{}".format(file_id, version),
+        "size": f.get("size"),
+        "modified": modified,
+        "path": os.path.normpath(path),
+        "info": f.get("info"),
+    }
+
+
+def _bids_metadata(f):
+    info = f.get("info") or {}
+    metadata = info.get(NAMESPACE)
+    if not metadata or metadata == "NA":
+        return None
+    return metadata
+
+
+def _excluded(container):
+    metadata = (container.get("info") or {}).get(NAMESPACE, {})
+    return isinstance(metadata, dict) and metadata.get("ignore", False)
+
+
+def _fetch_one(client, remote, cache):
+    """Places one file at its destination, returns "skipped", "cached" or "downloaded"."""
+    path = remote["path"]
+    if _unchanged(path, remote):
+        return "skipped"
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if cache is None:
+        _download(client, remote, path)
+        outcome = "downloaded"
+    else:
+        cached = cache.lookup(remote)
+        outcome = "cached" if cached else "downloaded"
+        if cached is None:
+            cached = cache.fetch(client, remote)
+        stage_file(cached, path)
+
+    if remote["modified"] is not None:
+        os.utime(path, (remote["modified"], remote["modified"]))
+    log.debug("%s %s", outcome.capitalize(), path)
+    return outcome
+
+
+def _unchanged(path, remote):
+    """True if path already holds the platform's version of the file (same size and modified time)."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    if remote["modified"] is None:
+        return False
+    if remote["size"] is not None and st.st_size != remote["size"]:
+        return False
+    return int(st.st_mtime) == int(remote["modified"])
+
+
+def _download(client, remote, dest):
+    getattr(client, "download_file_from_" + remote["container"])(remote["container_id"], remote["name"], dest)
+
+
+def _pool_connections(client, n_workers):
+    """Sizes the client's HTTP connection pool so concurrent downloads reuse connections instead of opening new ones."""
+    try:
+        import requests
+
+        session = client.api_client.rest_client.session
+        adapter = session.get_adapter("https://")
+        if getattr(adapter, "_pool_maxsize", 0) >= n_workers:
+            return
+        pooled = requests.adapters.HTTPAdapter(pool_connections=n_workers, pool_maxsize=n_workers,
+                                               max_retries=adapter.max_retries)
+        session.mount("https://", pooled)
+        session.mount("http://", pooled)
+    except (AttributeError, ImportError) as e:
+        # not a Flywheel SDK client (e.g. a fake client), nothing to size
+        log.debug("Not resizing connection pool: %s", e)
+
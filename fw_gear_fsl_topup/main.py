@@ -6,11 +6,14 @@ import errorhandler
 from typing import List, Tuple
 import json
 import nibabel as nb
-from fw_gear_fsl_topup import mri_qa
+from fw_gear_fsl_topup import applytopup, archive, checkpoint, mri_qa, nifti, qa_metrics, resources, slurm
 import shutil
+import glob
 
 from utils.command_line import exec_command, build_command_list
-from fw_gear_fsl_topup.common import execute_shell, searchfiles
+from fw_gear_fsl_topup.common import PathResolver, stage_file
+from fw_gear_fsl_topup.cache import TopupCache
+from fw_gear_fsl_topup.scheduler import FAILED, Ref, Scheduler, StageError
 
 log = logging.getLogger(__name__)
 
@@ -20,6 +23,9 @@ error_handler = errorhandler.ErrorHandler()
 ##--------    Gear Specific files/folders   --------##
 DEFAULT_CONFIG = '/flywheel/v0/b02b0.cnf'
 
+# topup results kept by topup_only runs (appended to the topup root path)
+TOPUP_OUTPUTS = ("_fieldcoef.nii*", "_movpar.txt", "-fmap.nii*", "-dfield*", "-jacdet*", "-rbmat*")
+
 
 def prepare(
         options: dict,
@@ -49,90 +55,465 @@ def prepare(
     # pylint: enable=unused-argument
 
 
-def run(options, gear_context):
+def run(options, gear_context, pool=None, errors=error_handler):
+    """Runs the pipeline for the session in options and zips its results.
+
+    Args:
+        options (dict): gear options from parse_config
+        gear_context: the gear context
+        pool (ResourcePool): CPU and memory budget shared with other sessions (batch mode), created from the
+            options if None
+        errors: tracks the errors logged for this run (its `fired` attribute), all errors of the gear by default
 
+    Returns:
+        run_error (int): 0 on success, 1 on failure
+    """
     # Check the inputs and categorize files
     log.info('Locating opposing phase encoded fieldmap images')
-    pairs = locate_fieldmap_pairs(options["fmaps"])
+    pairs = locate_fieldmap_pairs(options["fmaps"], options.get("bids-index"))
     run_error = 0
 
-    for imgs in pairs:
-        corrected_files = []
+    qa_settings = {
+        "mode": gear_context.config.get('qa_mode') or 'report',
+        "method": gear_context.config.get('qa_mask_method') or 'numpy',
+        "reference": gear_context.config.get('qa_reference') or '0',
+        "thresholds": {"max_displacement": gear_context.config.get('qa_max_displacement'),
+                       "jacobian_min": gear_context.config.get('qa_jacobian_min'),
+                       "jacobian_max": gear_context.config.get('qa_jacobian_max'),
+                       "min_similarity": gear_context.config.get('qa_min_similarity')},
+        "pipeline": gear_context.config.get('qa_pipeline', True),
+        "store": None,
+    }
+    # topup_only runs only estimate the fields, there are no corrected images to check
+    run_qa = gear_context.config['QA'] and not options.get("topup_only")
+    if run_qa:
+        log.info('Running Topup QA (%s)', qa_settings["mode"])
+        qa_settings["store"] = mri_qa.OutlineStore(options.get("qa-cache-dir"))
+        if not options.get("batch-label"):
+            save_qa_config(gear_context, options["output-dir"])  # batch.run_batch saves it once for all sessions
+
+    # every step of every pair is a stage, stages run as soon as their inputs are ready and their estimated CPU and
+    # memory needs fit in the budget. Stages completed by an interrupted earlier run in this work directory are skipped
+    scheduler = Scheduler(max_workers=options.get("max_concurrent_stages") or options.get("n_cpus"),
+                          pool=pool or resources.ResourcePool.from_options(options),
+                          checkpoints=checkpoint.Checkpoints.from_options(options))
+    build_pipeline(scheduler, options, pairs, qa_settings if run_qa else None,
+                   backend=slurm.SlurmBackend.from_options(options))
+
+    if not scheduler.run() or errors.fired:
+        for stage in scheduler.failed(critical_only=True):
+            if stage.status == FAILED:
+                log.error('Stage %s failed: %s', stage.name, stage.error)
+        log.critical('Failure: exiting with code 1 due to logged errors')
+        run_error = 1
+        return run_error
+
+    # report every file whose QA failed, not only the first
+    failed = []
+    metrics = []
+    for name, stage in scheduler.stages.items():
+        if not name.startswith("qa:"):
+            continue
+        try:
+            metrics.append(scheduler.result(name))
+        except StageError as e:
+            log.error('Topup QA failed for %s: %s', stage.args[0], e)
+            failed.append(stage.args[0])
+    if run_qa and qa_settings["mode"] != 'report' and metrics:
+        qa_metrics.write_metrics(metrics, options["output-dir"], name=output_name(options, qa_metrics.METRICS_FILE))
+    if failed:
+        raise Exception("Error running topup QC for {}".format(", ".join(failed)))
+
+    # zip results
+    archive.zip_directory(os.path.join(options["output-dir"],
+                                       output_name(options, "topup_" + str(options["destination-id"])) + ".zip"),
+                          options["work-dir"], options["destination-id"], dry_run=options["dry-run"])
+
+    return run_error
+
+
+def output_name(options, name):
+    """Returns the name of an output file, suffixed with the session in batch mode so sessions don't overwrite it."""
+    if options.get("batch-label"):
+        return name + "_" + options["batch-label"]
+    return name
+
+
+def build_pipeline(scheduler, options, pairs, qa_settings=None, backend=None):
+    """Adds the stages that estimate and apply topup for every fieldmap pair to a scheduler.
 
+    Per pair the stages are: merging the topup input, writing the acquisition parameters, preparing the topup command
+    (or restoring it from the cache), running topup and storing its results. Unless topup_only is set, IntendedFor
+    resolution runs alongside and adds apply, staging and QA stages for every file it finds (see add_apply_stages).
+    Each pair gets its own copy of the options and its own work directory (work-dir/topup/<pair label>), so the pairs
+    never write to the same files. Without parallel_pairs each pair's topup waits for the previous pair's topup, the
+    other stages still overlap. Every stage but IntendedFor resolution is checkpointed, so a rerun after an
+    interruption resumes from the first stage that didn't complete. A file that is IntendedFor several pairs is only
+    corrected by the first of them, so two pairs never write the same corrected file.
+
+    With a SLURM backend, topup for all pairs is submitted as one job array and applytopup as one array per pair that
+    depends on the pair's topup task (see slurm.py). The stages that follow wait for all jobs to finish.
+
+    Args:
+        scheduler (Scheduler): scheduler to add the stages to
+        options (dict): gear options
+        pairs (list): fieldmap pairs from locate_fieldmap_pairs
+        qa_settings (dict): QA settings (see qa_report), no QA stages are added if None
+        backend (SlurmBackend): runs topup and applytopup as SLURM jobs if given
+
+    Returns:
+        names (list): the names of the stages added (IntendedFor resolution adds more when it runs)
+    """
+    names = []
+    previous_topup = None
+    previous_resolution = None
+    submitted = []
+    claimed = {}
+    for imgs in pairs:
+        label = pair_label(imgs)
         log.info("Using fieldmaps: %s", ", ".join(imgs))
 
-        # Run Topup on the inputs
-        log.info('Running Topup')
+        pair_options = dict(options)
+        pair_options["Image1"] = imgs[0]
+        pair_options["Image2"] = imgs[1]
+        pair_options["topup-dir"] = os.path.join(options["work-dir"], "topup", label)
+        os.makedirs(pair_options["topup-dir"], exist_ok=True)
+
+        topup_input = scheduler.add("topup-input:" + label, generate_topup_input, pair_options, checkpoint=True)
+        acq_input = scheduler.add("acqparams:" + label, generate_acquisition_params, pair_options, checkpoint=True)
+        prepared = scheduler.add("topup-prepare:" + label, prepare_topup, pair_options, Ref(topup_input),
+                                 Ref(acq_input), pair_options["topup-dir"], checkpoint=True)
+        if backend is not None:
+            submitted.append((label, prepared))
+            topup = scheduler.add("topup:" + label, collect_topup, backend, Ref("slurm-topup", label),
+                                  Ref(prepared, "out"), after=["slurm-wait"], checkpoint=True)
+        else:
+            after = [previous_topup] if previous_topup and not options.get("parallel_pairs") else []
+            topup = scheduler.add_command("topup:" + label, Ref(prepared, "command"), after=after,
+                                          resources=resources.estimate(resources.topup_resources, imgs,
+                                                                       index=options.get("bids-index")),
+                                          outputs=Ref(prepared, "out"), checkpoint=True)
+        topup_out = scheduler.add("topup-store:" + label, finish_topup, pair_options, Ref(prepared), after=[topup],
+                                  checkpoint=True)
+        names.extend([topup_input, acq_input, prepared, topup, topup_out])
+        previous_topup = topup
+
+        if options.get("topup_only"):
+            names.append(scheduler.add("stage-topup:" + label, stage_topup_outputs, options, Ref(topup_out),
+                                       Ref(acq_input), staging_dir(options), checkpoint=True))
+        else:
+            # IntendedFor resolution doesn't need topup's results, so it runs while topup is estimating
+            jobs = None
+            if backend is not None:
+                # the applytopup jobs are submitted with a dependency on the pair's topup task
+                jobs = (backend, Ref("slurm-topup", label), Ref(prepared, "out"), Ref(acq_input))
+            # resolution is quick, running it in pair order makes the first pair listing a file the one correcting it
+            after = [previous_resolution] if previous_resolution else []
+            previous_resolution = scheduler.add("intended-for:" + label, add_apply_stages, scheduler, options,
+                                                pair_options, label, topup_out, acq_input, qa_settings, jobs,
+                                                claimed=claimed, after=after)
+            names.append(previous_resolution)
+
+    if backend is not None:
+        names.append(scheduler.add("slurm-topup", submit_topup_array, scheduler, backend,
+                                   [label for label, _ in submitted], [Ref(prepared) for _, prepared in submitted]))
+        # every array is submitted once topup is submitted and IntendedFor resolution is done for every pair
+        resolution = [name for name in names if name.startswith("intended-for:")]
+        names.append(scheduler.add("slurm-wait", backend.wait, after=["slurm-topup"] + resolution))
+
+    return names
+
+
+def submit_topup_array(scheduler, backend, labels, prepared):
+    """Submits the topup command of every pair that needs one as a SLURM job array.
+
+    Pairs restored from the topup cache are not submitted, nor are pairs whose topup inputs are unchanged since an
+    earlier run completed their topup (see checkpoint.py).
 
-        topup_dir = os.path.join(options["work-dir"],"topup")
-        os.makedirs(topup_dir, exist_ok=True)
+    Returns:
+        tasks (dict): {pair label: array task id, None if nothing was submitted for the pair}
+    """
+    tasks = dict.fromkeys(labels)
+    commands = [(label, p["command"]) for label, p in zip(labels, prepared)
+                if p["command"] and not _completed_earlier(scheduler, "topup:" + label, "topup-prepare:" + label)]
+    for (label, _), task in zip(commands, backend.submit_array("topup", [command for _, command in commands])):
+        tasks[label] = task
+    return tasks
 
-        options["Image1"] = imgs[0]
-        options["Image2"] = imgs[1]
 
-        topup_input = generate_topup_input(options)
+def collect_topup(backend, task, topup_out):
+    """Checks a pair's SLURM topup task completed (nothing was submitted if task is None), returns the topup root."""
+    if task:
+        backend.check(task)
+    return topup_out
 
-        acq_input = generate_acquisition_params(options)
 
-        topup_out = run_topup(options, topup_input, acq_input, topup_dir)
+def collect_apply(backend, task, partial, output_file):
+    """Checks a file's SLURM applytopup task completed and moves its output into place.
 
-        log.info('Checking intended-fors')
+    Returns:
+        output_file (str): the corrected file
+    """
+    if task:
+        backend.check(task)
+        os.replace(partial, output_file)
+    elif not os.path.exists(output_file):
+        raise RuntimeError('No corrected file {} from an earlier run'.format(output_file))
+    return output_file
 
-        apply_to_files, acq_param_idxs = locate_apply_to_files(options)
 
-        # Try to apply topup to input files
-        log.info('Applying Topup Correction')
-        corrected_files.extend(apply_topup(apply_to_files, acq_param_idxs, topup_out, acq_input))
+def _completed_earlier(scheduler, name, inputs_stage):
+    """True if a stage completed in an earlier run and the stage preparing its inputs was resumed (so they match)."""
+    return (scheduler.checkpoints is not None and scheduler.stages[inputs_stage].resumed and
+            scheduler.checkpoints.completed(name) is not None)
 
-        if error_handler.fired:
-            log.critical('Failure: exiting with code 1 due to logged errors')
-            run_error = 1
-            return run_error
 
-        # move output files to path with destination-id
-        for f in corrected_files:
-            newpath = f.replace(str(options["work-dir"]), os.path.join(options["work-dir"],options["destination-id"]))
-            os.makedirs(os.path.dirname(newpath), exist_ok=True)
-            shutil.copy(f, newpath, follow_symlinks=True)
+def add_apply_stages(scheduler, options, pair_options, label, topup_out, acq_input, qa_settings=None, jobs=None,
+                     claimed=None):
+    """Resolves a pair's IntendedFor files and adds an apply, staging and (optional) QA stage for each of them.
 
-        # Try to run topup QA
-        # apply_to_files is currently a list of [(filename, index), ... ].  We need to combine this
-        # with corrected files so that we have [(original file, corrected file), ... ]
-        file_comparison = [(apply_to_files[i], corrected_files[i]) for i in range(len(corrected_files))]
-        work_dir = options["work-dir"]
-        output_dir = options["output-dir"]
-        try:
-            if gear_context.config['QA']:
-                log.info('Running Topup QA')
-                for original, corrected in file_comparison:
-                    report_out = mri_qa.generate_topup_report(original, corrected, work_dir)
-                    report_dir, report_base = os.path.split(report_out)
-                    shutil.move(report_out, os.path.join(output_dir, report_base))
-
-                    # Move the config file used in the analysis to the output
-                    config_path = gear_context.get_input_path('config_file')
-
-                    # If this wasn't provided as input, save to output for provenance.
-                    if not config_path:
-                        config_path = DEFAULT_CONFIG
-                        config_out = os.path.join(output_dir, 'config_file.txt')
-                        if os.path.exists(config_path):
-                            shutil.copy(config_path, config_out)
-                        else:
-                            log.info(f'no path {config_path}')
-
-        except Exception as e:
-            raise Exception("Error running topup QC") from e
+    Args:
+        scheduler (Scheduler): scheduler to add the stages to
+        options (dict): gear options
+        pair_options (dict): the pair's options (see build_pipeline)
+        label (str): the pair label
+        topup_out (str): name of the stage returning the pair's topup root path
+        acq_input (str): name of the stage returning the pair's acquisition parameters file
+        qa_settings (dict): QA settings (see qa_report), no QA stages are added if None
+        jobs (tuple): the SLURM backend, the pair's topup task, topup root path and acquisition parameters file, if
+            the corrections are submitted as SLURM jobs
+        claimed (dict): {file: pair label} of the files already claimed by a pair, shared by the pairs of a session.
+            Files claimed by another pair are skipped, since their corrected file would be written twice
 
-    # zip results
-    cmd = "zip -q -r " + os.path.join(options["output-dir"],
-                                      "topup_" + str(options["destination-id"])) + ".zip " + options[
-              "destination-id"]
-    execute_shell(cmd, dryrun=options["dry-run"], cwd=options["work-dir"])
+    Returns:
+        names (list): the names of the stages added
+    """
+    log.info('Checking intended-fors')
+    resolved = locate_apply_to_files(pair_options)
+    if resolved and claimed is not None:
+        files, indices = [], []
+        for fl, index in zip(*resolved):
+            owner = claimed.setdefault(os.path.realpath(fl), label)
+            if owner != label:
+                log.warning('%s is IntendedFor by %s and %s, it is only corrected with the fieldmaps of %s',
+                            fl, owner, label, owner)
+                continue
+            files.append(fl)
+            indices.append(index)
+        resolved = (files, indices) if files else None
+    if not resolved:
+        return []
+
+    names = []
+    applied = []
+    method = pair_options.get("apply_method") or "fsl"
+    if jobs is not None and method != "fsl":
+        log.warning('apply_method %s runs in-process, correcting the files of %s locally instead of with SLURM',
+                    method, label)
+        jobs = None
+    if jobs is not None:
+        tasks = submit_apply_array(scheduler, label, resolved, jobs)
+
+    for fl, index in zip(*resolved):
+        base = os.path.basename(fl)
+        output_file = checkpoint.Output(os.path.join(os.path.dirname(fl), 'topup-corrected-{}'.format(base)))
+        if jobs is not None:
+            apply = scheduler.add("apply:{}:{}".format(label, base), collect_apply, jobs[0], tasks[fl],
+                                  checkpoint.Output(_partial_path(output_file)), output_file, after=["slurm-wait"],
+                                  checkpoint=True)
+        else:
+            # the native engine corrects chunks on the CPUs its stage is given
+            needs = resources.estimate(resources.apply_resources, fl, method, pair_options.get("apply_chunk_volumes"),
+                                       cpus=options.get("n_cpus"), index=options.get("bids-index"))
+            apply = scheduler.add("apply:{}:{}".format(label, base), apply_topup_file, fl, index, output_file,
+                                  Ref(topup_out), Ref(acq_input), method=method,
+                                  chunk_volumes=pair_options.get("apply_chunk_volumes"),
+                                  workers=needs.get("cpus") or 1, resources=needs, checkpoint=True)
+        names.append(apply)
+        names.append(scheduler.add("stage:{}:{}".format(label, base), stage_corrected_file, options, Ref(apply),
+                                   staging_dir(options), checkpoint=True))
+        applied.append((fl, index, apply))
+
+    if qa_settings is not None:
+        # without qa_pipeline a pair's reports wait until all of its files are corrected
+        after = [apply for _, _, apply in applied] if not qa_settings.get("pipeline", True) else []
+        for fl, index, apply in applied:
+            names.append(scheduler.add("qa:{}:{}".format(label, os.path.basename(fl)), qa_report, fl, Ref(apply),
+                                       options["work-dir"], options["output-dir"], qa_settings,
+                                       (Ref(topup_out), Ref(acq_input), index), after=after, critical=False,
+                                       resources=resources.estimate(resources.qa_resources, fl,
+                                                                    qa_settings["reference"],
+                                                                    index=options.get("bids-index")),
+                                       checkpoint=True))
+
+    log.info('Added applytopup stages for %d files of %s', len(applied), label)
+    return names
+
+
+def submit_apply_array(scheduler, label, resolved, jobs):
+    """Submits FSL applytopup for a pair's files as a SLURM job array depending on the pair's topup task.
+
+    Files corrected by an earlier run are not submitted again if the pair's topup wasn't re-run and its inputs are
+    unchanged, and the corrected file is newer than the file it was corrected from.
 
-    return run_error
+    Returns:
+        tasks (dict): {file: array task id, None if nothing was submitted for the file}
+    """
+    backend, topup_task, topup_root, acq_params = jobs
+    reuse = topup_task is None and scheduler.stages["topup-prepare:" + label].resumed
+
+    tasks = {}
+    commands = []
+    for fl, index in zip(*resolved):
+        output_file = os.path.join(os.path.dirname(fl), 'topup-corrected-{}'.format(os.path.basename(fl)))
+        tasks[fl] = None
+        if reuse and _completed_earlier(scheduler, "apply:{}:{}".format(label, os.path.basename(fl)),
+                                        "topup-prepare:" + label) and \
+                os.path.getmtime(output_file) >= os.path.getmtime(fl):
+            continue
+        commands.append((fl, applytopup_command(fl, _partial_path(output_file), index, topup_root, acq_params)))
+
+    for (fl, _), task in zip(commands, backend.submit_array("applytopup-" + label,
+                                                           [command for _, command in commands],
+                                                           dependencies=[topup_task])):
+        tasks[fl] = task
+    return tasks
+
+
+def apply_topup_file(fl, index, output_file, topup_out, acq_params, method="fsl", chunk_volumes=0, workers=1):
+    """Corrects one file with apply_method `method`, raises RuntimeError if the correction failed.
+
+    The file is corrected under a temporary name and renamed to output_file once it is complete, so an interrupted
+    correction never leaves a partial output_file behind.
+
+    Returns:
+        output_file (str): the corrected file
+    """
+    partial = _partial_path(output_file)
+    returncode = _apply_one(fl, index, partial, topup_out, acq_params, method, chunk_volumes, workers)
+    if returncode != 0:
+        raise RuntimeError('applytopup failed for {} (return code {})'.format(fl, returncode))
+    os.replace(partial, output_file)
+    return output_file
+
+
+def staging_dir(options):
+    """The directory files are staged in for the results archive, named after the destination (the analysis)."""
+    return checkpoint.Output(os.path.join(options["work-dir"], options["destination-id"]))
+
+
+def _partial_path(output_file):
+    """Where a corrected file is written until it is complete."""
+    return os.path.join(os.path.dirname(output_file), '.partial-' + os.path.basename(output_file))
+
+
+def stage_corrected_file(options, corrected, staging_dir):
+    """Stages a corrected file at its path under staging_dir, the destination-id directory (linked rather than copied
+    where possible).
+
+    Returns:
+        newpath (str): the staged path
+    """
+    newpath = corrected.replace(str(options["work-dir"]), staging_dir)
+    method = stage_file(corrected, newpath)
+    log.debug("Staged %s (%s)", newpath, method)
+    return newpath
+
+
+def stage_topup_outputs(options, topup_out, acq_params, staging_dir):
+    """Stages a pair's topup results (field coefficients, movement parameters, field map, any optional displacement
+    fields, Jacobians and rigid body matrices) and its acquisition parameters for the results archive, under
+    staging_dir (the destination-id directory).
+
+    Returns:
+        staged (list): paths of the staged files
+    """
+    outputs = [acq_params]
+    for suffix in TOPUP_OUTPUTS:
+        outputs.extend(sorted(glob.glob(topup_out + suffix)))
+
+    staged = []
+    for f in outputs:
+        newpath = f.replace(str(options["work-dir"]), staging_dir)
+        method = stage_file(f, newpath)
+        log.debug("Staged %s (%s)", newpath, method)
+        staged.append(newpath)
+
+    log.info('Staged %d topup outputs from %s', len(staged), os.path.dirname(topup_out))
+    return staged
+
+
+def qa_report(original, corrected, work_dir, output_dir, settings, topup):
+    """Runs the QA of one corrected file.
+
+    In 'report' mode the png report is always generated. In 'metrics' mode the numeric metrics (see qa_metrics.py) are
+    computed and the report is only generated if they cross one of the thresholds, 'both' computes the metrics and
+    always generates the report. Reports are moved to output_dir.
+
+    Args:
+        original (str): the file before correction
+        corrected (str): the corrected file
+        work_dir (str): directory the report is generated in
+        output_dir (str): directory the report is moved to
+        settings (dict): QA "mode", outline "method", "reference" volume, metric "thresholds" and outline "store"
+        topup (tuple): the topup root path, acquisition parameters file and acquisition parameter row of the file
+
+    Returns:
+        row (dict): the file, its metrics (if computed) and the path to its report ("" if none was generated)
+    """
+    row = {"file": os.path.basename(original), "corrected": os.path.basename(corrected)}
+    render = settings["mode"] in ('report', 'both')
+    volumes = None
+
+    if settings["mode"] != 'report':
+        volumes = (mri_qa.reference_volume(original, settings["reference"]),
+                   mri_qa.reference_volume(corrected, settings["reference"]))
+        mask, _ = mri_qa.image_mask_outline(original, os.path.join(work_dir, 'outline_work'), settings["method"],
+                                            settings["store"], volumes[0])
+        topup_out, acq_params, index = topup
+        row.update(qa_metrics.field_metrics(topup_out, acq_params, index, mri_qa.brain_mask))
+        row.update(qa_metrics.file_metrics(volumes[0][1], volumes[1][1], mask))
+        row["flags"] = qa_metrics.exceeded_thresholds(row, settings["thresholds"])
+        if row["flags"]:
+            log.warning('QA thresholds exceeded for %s: %s', row["file"], ", ".join(row["flags"]))
+            render = True
+
+    row["report"] = ""
+    if render:
+        report_out = mri_qa.generate_topup_report(original, corrected, work_dir, settings["method"], settings["store"],
+                                                  settings["reference"], volumes)
+        report_dir, report_base = os.path.split(report_out)
+        row["report"] = os.path.join(output_dir, report_base)
+        shutil.move(report_out, row["report"])
+        log.info('QA report for %s saved to %s', row["file"], row["report"])
+    return row
+
+
+def save_qa_config(gear_context, output_dir):
+    """Saves the default topup config to output_dir for provenance if no config file was provided as input."""
+    config_path = gear_context.get_input_path('config_file')
+
+    # If this wasn't provided as input, save to output for provenance.
+    if not config_path:
+        config_path = DEFAULT_CONFIG
+        config_out = os.path.join(output_dir, 'config_file.txt')
+        if os.path.exists(config_path):
+            shutil.copy(config_path, config_out)
+        else:
+            log.info(f'no path {config_path}')
+
+
+def pair_label(imgs):
+    """Returns a name for a fieldmap pair: the shared filename with the "dir" entity removed."""
+    base = os.path.basename(imgs[0])
+    base = base[:base.find('.nii')] if '.nii' in base else base
+    return "_".join([x for x in base.split("_") if "dir" not in x])
+
+
+def locate_fieldmap_pairs(fmaps, index=None):
+    if index is not None:
+        return index.fieldmap_pairs(fmaps)
 
-def locate_fieldmap_pairs(fmaps):
     # first remove the "dir" component - then look for label duplicates
     fmaps_stripped = ["_".join([x for x in s.split("_") if "dir" not in x]) for s in fmaps]
 
@@ -157,15 +538,14 @@ def locate_apply_to_files(options):
     else:
         intended_for_file = options["Image1"].replace("nii.gz", "json")
 
-    filelist = find_metadata(intended_for_file, "IntendedFor")
+    filelist = find_metadata(intended_for_file, "IntendedFor", options.get("bids-index"))
 
-    outfiles = []
+    # look for the files first...
     parentdir = os.path.join(options["inputs-dir"],"sub-"+options["sid"])
-    for path in filelist:
-        # look for the file first...
-        f = searchfiles(os.path.join(parentdir, path), exit_on_errors=False)
-        if f[0]:
-            outfiles.extend(f)
+    resolver = options.get("path-resolver") or PathResolver()
+    outfiles, missing = resolver.resolve_many([os.path.join(parentdir, path) for path in filelist])
+    for path in missing:
+        log.warning("Unable to find IntendedFor file %s", path)
 
     if outfiles:
         dir1 = [s for s in os.path.basename(options["Image1"]).split("_") if "dir" in s][0]
@@ -194,7 +574,10 @@ def assign_acqparam_index(files, dir1, dir2):
 
     return outfiles, outindices
 
-def find_metadata(file, parameter):
+def find_metadata(file, parameter, index=None):
+    if index is not None:
+        return index.metadata(file, parameter)
+
     with open(file) as f:
         data = json.load(f)
         value = data[parameter]
@@ -209,8 +592,9 @@ def generate_acquisition_params(options):
     image1 = options["Image1"]
     image2 = options["Image2"]
 
-    readout1 = find_metadata(image1.replace("nii.gz","json"), 'TotalReadoutTime')
-    readout2 = find_metadata(image2.replace("nii.gz", "json"), 'TotalReadoutTime')
+    index = options.get("bids-index")
+    readout1 = find_metadata(image1.replace("nii.gz","json"), 'TotalReadoutTime', index)
+    readout2 = find_metadata(image2.replace("nii.gz", "json"), 'TotalReadoutTime', index)
 
     lines = []
     if "dir-ap" in str(image1).lower():
@@ -223,22 +607,32 @@ def generate_acquisition_params(options):
     elif "dir-pa" in str(image2).lower():
         lines.append("0 1 0 "+str(readout2))
 
-    with open(os.path.join(options["work-dir"],"topup","acq_params.txt"), 'w') as f:
+    acq_file = os.path.join(topup_work_dir(options), "acq_params.txt")
+    with open(acq_file, 'w') as f:
         f.write('\n'.join(lines))
 
-    return os.path.join(options["work-dir"],"topup","acq_params.txt")
+    return acq_file
 
 
-def is4D(image):
+def topup_work_dir(options):
+    """Returns the directory the current fieldmap pair's topup inputs are written to."""
+    return options.get("topup-dir") or os.path.join(options["work-dir"], "topup")
+
+
+def is4D(image, index=None):
     """Checks to see if a given image is 4D
 
     Args:
         image (str): path to image
+        index (SessionIndex): session index to read the image shape from, instead of opening the image
 
     Returns:
         (bool): true if image is 4d, false otherwise.
 
     """
+    if index is not None:
+        return index.is4d(image)
+
     shape = nb.load(image).header.get_data_shape()
     if len(shape) < 4:
         return (False)
@@ -311,25 +705,63 @@ def check_inputs(context):
 def generate_topup_input(options):
     """Takes gear input files and generates a merged input file for TOPUP.
 
+    The "topup_input_method" option selects how the merged file is made: "nibabel" (default) reads the first volume
+    of each image in-process and writes the merged file once, "fsl" uses fslroi/fslmaths and fslmerge, and "validate"
+    runs both and logs an error if they differ.
+
     Args:
         options (dict): containing relevant settings and options for gear
 
     Returns:
         merged (string): the path to the merged file for use in TOPUP
 
+    """
+    method = options.get("topup_input_method") or "nibabel"
+    if method == "fsl":
+        return generate_topup_input_fsl(options)
+
+    image1_path = options["Image1"]
+    image2_path = options["Image2"]
+    work_dir = topup_work_dir(options)
+
+    # Merge the first volume of each image (image_1 then image_2)
+    merged = os.path.join(work_dir, 'topup_vols')
+    log.info('Merging first volumes of %s and %s', os.path.basename(image1_path), os.path.basename(image2_path))
+    nifti.merge_first_volumes([image1_path, image2_path], merged + '.nii.gz')
+
+    if method == "validate":
+        fsl_merged = generate_topup_input_fsl(options, 'topup_vols_fsl')
+        if nifti.compare_images(merged + '.nii.gz', fsl_merged + '.nii.gz'):
+            log.info('In-process topup input matches fslmerge output')
+        else:
+            log.error('In-process topup input does not match fslmerge output %s', fsl_merged)
+
+    return (merged)
+
+
+def generate_topup_input_fsl(options, merged_name='topup_vols'):
+    """Takes gear input files and generates a merged input file for TOPUP using fslroi/fslmaths and fslmerge.
+
+    Args:
+        options (dict): containing relevant settings and options for gear
+        merged_name (string): name of the merged file in the topup work directory
+
+    Returns:
+        merged (string): the path to the merged file for use in TOPUP
+
     """
 
     # Capture the paths of the input files from the gear context
     image1_path = options["Image1"]
     image2_path = options["Image2"]
-    work_dir = options["work-dir"]
+    work_dir = topup_work_dir(options)
 
     # Create a base directory in the context's working directory for image 1
-    base_out1 = os.path.join(work_dir, 'topup', 'Image1')
+    base_out1 = os.path.join(work_dir, 'Image1')
 
     # If image 1 is 4D, we will only use the first volume (Assuming that a 4D image is fMRI and we only need one volume)
     # TODO: Allow the user to choose which volume to use for topup correction
-    if is4D(image1_path):
+    if is4D(image1_path, options.get("bids-index")):
         im_name = os.path.split(image1_path)[-1]
         log.info('Using volume 1 in 4D image {}'.format(im_name))
 
@@ -343,8 +775,8 @@ def generate_topup_input(options):
     exec_command(cmd)
 
     # Repeat the same steps with image 2
-    base_out2 = os.path.join(work_dir, 'topup', 'Image2')
-    if is4D(image2_path):
+    base_out2 = os.path.join(work_dir, 'Image2')
+    if is4D(image2_path, options.get("bids-index")):
         im_name = os.path.split(image2_path)[-1]
         log.info('Using volume 1 in 4D image {}'.format(im_name))
 
@@ -354,17 +786,15 @@ def generate_topup_input(options):
     exec_command(cmd)
 
     # Merge the two volumes (image_1 then image_2)
-    merged = os.path.join(work_dir, 'topup', 'topup_vols')
+    merged = os.path.join(work_dir, merged_name)
     cmd = ['fslmerge', '-t', merged, base_out1, base_out2]
     exec_command(cmd)
 
     return (merged)
 
 
-def run_topup(options, input, acq_params, topup_dir):
-    """Runs topup on a given input image.
-
-    Requires acquisition parameters and input options from the gear context.
+def prepare_topup(options, input, acq_params, topup_dir):
+    """Builds the topup command, or restores topup's results from the cache.
 
     Args:
         options (dict): flywheel gear context
@@ -373,7 +803,8 @@ def run_topup(options, input, acq_params, topup_dir):
         topup_dir (string): path to location to store results
 
     Returns:
-        out (string): the topup root path
+        prepared (dict): the topup "command" (None if the results were restored from the cache), the topup root path
+            "out" and what finish_topup needs to store the results ("input" and "cache_key")
 
     """
 
@@ -420,51 +851,110 @@ def run_topup(options, input, acq_params, topup_dir):
     # Print the config file settings to the log
     log.info('Using config settings:\n\n{}\n\n'.format(open(config_path, 'r').read()))
 
-    # Build the command and execute
+    # Reuse the results of an identical earlier run if there is one
+    cache = TopupCache.from_options(options)
+    cache_key = None
+    if cache:
+        # output paths differ between runs (scratch directories), only their names matter
+        settings = [[k, os.path.basename(v) if str(v).startswith(output_dir) else v]
+                    for k, v in sorted(argument_dict.items()) if k not in ('imain', 'datain', 'config')]
+        cache_key = cache.key(input, acq_par, config_path, settings)
+        if cache.restore(cache_key, output_dir):
+            return {"command": None, "out": out, "input": input, "cache_key": None}
+
+    # Build the command
     command = build_command_list(['topup'], argument_dict)
-    exec_command(command)
+    return {"command": command, "out": out, "input": input, "cache_key": cache_key}
 
-    return (out)
 
+def finish_topup(options, prepared):
+    """Stores the results of a topup run prepared with prepare_topup in the cache.
 
-def apply_topup(apply_topup_files, index_list, topup_out, acq_params):
-    """Applies a calculated topup correction to a list of files.
+    Returns:
+        out (string): the topup root path
+    """
+    out = prepared["out"]
+    cache = TopupCache.from_options(options) if prepared["cache_key"] else None
+    if cache:
+        # everything topup wrote next to --out, except the merged input itself
+        results = [f for f in glob.glob(out + '*') if not f.startswith(prepared["input"])]
+        cache.store(prepared["cache_key"], results)
 
-    Args:
-        context (class: `flywheel.gear_context.GearContext`): flywheel gear context
-        apply_topup_files (list): A list of files to apply topup correction to
-        index_list (list): A list that corresponds 1:1 with apply_topup_files, this indicates which row to use from the
-        "acquisition_parameters" text file for the associated file.  This essentially tells topup what PE direction each
-        image is.
-        topup_out (string): the base directory/filename for the topup analysis that was run previously.
+    return (out)
 
-    Returns:
-        output_files (list): a list of topup corrected files
 
-    """
+def _apply_one(fl, index, output_file, topup_out, acq_params, method, chunk_volumes, workers=1):
+    """Corrects one file and returns a return code instead of raising.
 
-    output_files = []
-
-    # For all the files we're applying topup to, loop through them with their associated row in the acquisition parameter file
-    for ix, fl in enumerate(apply_topup_files):
-        # Generate an output name: "topup_corrected_" appended to the front of the original filename
-        base = os.path.split(fl)[-1]
-        output_file = os.path.join(os.path.dirname(fl), 'topup-corrected-{}'.format(base))
-        output_files.append(output_file)
-
-        # Generate the applytopup command
-        cmd = ['applytopup',
-               '--imain={}'.format(fl),
-               '--datain={}'.format(acq_params),
-               '--inindex={}'.format(index_list[ix]),
-               '--topup={}'.format(topup_out),
-               '--method=jac',
-               '--interp=spline',
-               '--out={}'.format(output_file)]
+    The native engine corrects up to `workers` chunks at the same time, FSL's applytopup is single threaded.
+    """
+    try:
+        if method == "native":
+            applytopup.apply_topup_native(fl, index, topup_out, acq_params, output_file, chunk_volumes=chunk_volumes,
+                                          workers=workers)
+            return 0
+
+        _, _, returncode = _applytopup_fsl(fl, index, topup_out, acq_params, output_file, chunk_volumes)
+
+        if method == "validate":
+            native_file = os.path.join(os.path.dirname(output_file), 'native-' + os.path.basename(output_file))
+            applytopup.apply_topup_native(fl, index, topup_out, acq_params, native_file, chunk_volumes=chunk_volumes,
+                                          workers=workers)
+            if not applytopup.compare_to_fsl(native_file, output_file):
+                log.error('Native applytopup does not match FSL for %s', fl)
+            os.remove(native_file)
+
+    except (RuntimeError, ValueError, OSError) as e:
+        log.warning(e)
+        returncode = 1
+    return returncode
+
+
+def applytopup_command(imain, out, index, topup_out, acq_params):
+    """Returns the FSL applytopup command correcting imain into out (Jacobian method, spline interpolation)."""
+    return ['applytopup',
+            '--imain={}'.format(imain),
+            '--datain={}'.format(acq_params),
+            '--inindex={}'.format(index),
+            '--topup={}'.format(topup_out),
+            '--method=jac',
+            '--interp=spline',
+            '--out={}'.format(out)]
+
+
+def _applytopup_fsl(fl, index, topup_out, acq_params, output_file, chunk_volumes=0):
+    """Runs FSL's applytopup on one file.
+
+    If chunk_volumes is set and the file has more volumes than that, the file is split with fslroi, each chunk is
+    corrected separately and the corrected chunks are merged back with fslmerge, so applytopup never holds the whole
+    run in memory.
+    """
+    def command(imain, out):
+        return applytopup_command(imain, out, index, topup_out, acq_params)
 
+    n_volumes = nb.load(fl).shape[3] if is4D(fl) else 1
+    if not chunk_volumes or n_volumes <= chunk_volumes:
         # Execute the command
-        exec_command(cmd)
-
-    return (output_files)
+        return exec_command(command(fl, output_file))
+
+    chunk_dir = os.path.join(os.path.dirname(output_file), '.chunks-' + os.path.basename(output_file))
+    os.makedirs(chunk_dir, exist_ok=True)
+    try:
+        corrected_chunks = []
+        for start in range(0, n_volumes, chunk_volumes):
+            count = min(chunk_volumes, n_volumes - start)
+            chunk = os.path.join(chunk_dir, 'chunk{:05d}'.format(start))
+            exec_command(['fslroi', fl, chunk, str(start), str(count)])
+            exec_command(command(chunk, chunk + '_corrected'))
+            # whatever extension FSLOUTPUTTYPE gave the chunk (.nii.gz, .nii, .hdr/.img)
+            for f in glob.glob(glob.escape(chunk) + '.*'):
+                os.remove(f)
+            corrected_chunks.append(chunk + '_corrected')
+
+        result = exec_command(['fslmerge', '-t', output_file] + corrected_chunks)
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+    return result
 
 
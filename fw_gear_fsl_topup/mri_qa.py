@@ -1,14 +1,27 @@
 #!/usr/bin/env python3
 
+import hashlib
 import os
 import subprocess as sp
 import logging
-import matplotlib.pyplot as pl
-import matplotlib.image as mpm
-pl.switch_backend('agg')
+import tempfile
+import threading
+import nibabel as nb
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from scipy import ndimage
+from fw_gear_fsl_topup.applytopup import iter_volume_chunks
+from fw_gear_fsl_topup.nifti import first_volume
 
 log = logging.getLogger()
 
+# number of volumes read at a time when averaging a series
+REFERENCE_CHUNK_VOLUMES = 16
+
+# matplotlib's shared state (font cache, text layout) isn't guaranteed thread safe, figures are drawn one at a time
+_render_lock = threading.Lock()
+
 
 
 def bet(image,workdir,shell=False):
@@ -26,27 +39,25 @@ def bet(image,workdir,shell=False):
 
     com_cmd = ['{}/fslstats'.format(os.path.join(os.environ["FSLDIR"],'bin')), image, '-C']
 
-    print(' '.join(com_cmd))
+    log.debug('Running %s', ' '.join(com_cmd))
     com_cmd = ' '.join(com_cmd)
 
     result = sp.Popen(com_cmd, stdout=sp.PIPE, stderr=sp.PIPE,
                       universal_newlines=True, shell=shell)
 
     out, err = result.communicate()
-    print(out)
-    print(err)
+    log.debug('stdout: %s stderr: %s', out.rstrip(), err.rstrip())
     center_of_mass = out.rstrip()
 
     bet_out = os.path.join(workdir, 'bet')
     bet_cmd = ['{}/bet2'.format(os.path.join(os.environ["FSLDIR"],'bin')), image, bet_out, '-o', '-m', '-t', '-f', '0.5', '-w', '0.4', '-c', center_of_mass]
-    print(' '.join(bet_cmd))
+    log.debug('Running %s', ' '.join(bet_cmd))
     bet_cmd = ' '.join(bet_cmd)
     result = sp.Popen(bet_cmd, stdout=sp.PIPE, stderr=sp.PIPE,
                       universal_newlines=True, shell=shell)
 
     out, err = result.communicate()
-    print(out)
-    print(err)
+    log.debug('stdout: %s stderr: %s', out.rstrip(), err.rstrip())
 
 
     return(bet_out)
@@ -70,40 +81,36 @@ def bet_2_outline(original,bet_root,shell=False):
     diff_out = bet_root+'_diff'
 
     cmd = ['fslmaths', overlay,'-sub',original,diff_out]
-    print(' '.join(cmd))
+    log.debug('Running %s', ' '.join(cmd))
     result = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE,
                       universal_newlines=True, shell=shell)
     out, err = result.communicate()
-    print(out)
-    print(err)
+    log.debug('stdout: %s stderr: %s', out.rstrip(), err.rstrip())
 
     cmd = ['fslstats', diff_out, '-p', '97']
-    print(' '.join(cmd))
+    log.debug('Running %s', ' '.join(cmd))
     result = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE,
                       universal_newlines=True, shell=shell)
     out, err = result.communicate()
-    print(out)
-    print(err)
+    log.debug('stdout: %s stderr: %s', out.rstrip(), err.rstrip())
 
     thresh = out.rstrip()
 
     thresh_out = bet_root+'_thresh'
     cmd = ['fslmaths',diff_out,'-thr',thresh,thresh_out]
-    print(' '.join(cmd))
+    log.debug('Running %s', ' '.join(cmd))
     result = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE,
                       universal_newlines=True, shell=shell)
     out, err = result.communicate()
-    print(out)
-    print(err)
+    log.debug('stdout: %s stderr: %s', out.rstrip(), err.rstrip())
 
     bin_out = bet_root+'_outline'
     cmd = ['fslmaths', thresh_out, '-bin', bin_out]
-    print(' '.join(cmd))
+    log.debug('Running %s', ' '.join(cmd))
     result = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE,
                       universal_newlines=True, shell=shell)
     out, err = result.communicate()
-    print(out)
-    print(err)
+    log.debug('stdout: %s stderr: %s', out.rstrip(), err.rstrip())
 
     os.remove(thresh_out+'.nii.gz')
     os.remove(diff_out+'.nii.gz')
@@ -112,124 +119,319 @@ def bet_2_outline(original,bet_root,shell=False):
 
 
 
-def overlay(image1,image2,output,shell=False):
+def brain_mask(data, threshold=0.1):
     """
-    creates an overlay of image 2 over image1.  Saves three .pngs of the overlay (one along each plane), and merges
-    them into one single .png file
+    Computes a head/brain mask of a volume in memory, in place of bet2's mask.  Voxels above a robust intensity
+    threshold are kept, the connected component closest to the intensity centre of mass is selected, and the mask is
+    smoothed with morphological closing, hole filling and opening.
     Args:
-        image1 (str): path to image1
-        image2 (str): path to image2
-        output (str): path to save merged overlays to
-        shell (bool): include the shell in the subprocess commands or not
+        data (numpy.ndarray): 3D volume
+        threshold (float): fraction of the robust (2nd to 98th percentile) intensity range used as the threshold
 
     Returns:
+        mask (numpy.ndarray): boolean mask
+    """
+
+    data = np.nan_to_num(np.asarray(data, dtype=np.float32))
+    low, high = np.percentile(data, [2, 98])
+    mask = data > low + threshold * (high - low)
+    if not mask.any():
+        return mask
+
+    # keep the component at (or nearest to) the centre of mass, as bet2 grows its surface from there
+    labels, n_labels = ndimage.label(mask)
+    if n_labels > 1:
+        center = np.round(ndimage.center_of_mass(np.where(mask, data, 0))).astype(int)
+        label = labels[tuple(center)]
+        if label == 0:
+            sizes = ndimage.sum_labels(mask, labels, np.arange(1, n_labels + 1))
+            label = int(np.argmax(sizes)) + 1
+        mask = labels == label
 
+    structure = ndimage.generate_binary_structure(3, 1)
+    mask = ndimage.binary_closing(mask, structure, iterations=2)
+    mask = ndimage.binary_fill_holes(mask)
+    mask = ndimage.binary_opening(mask, structure, iterations=1)
+
+    return mask
+
+
+def mask_outline(mask):
     """
+    Returns the boundary voxels of a mask (voxels in the mask with a face-neighbour outside it).
+    Args:
+        mask (numpy.ndarray): boolean mask
 
-    cmd=['overlay','0','0',image1,'-a',image2,'0.001','5',output]
-    print(' '.join(cmd))
-    result = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE,
-                      universal_newlines=True, shell=shell)
+    Returns:
+        outline (numpy.ndarray): boolean outline mask
+    """
 
-    out, err = result.communicate()
-    print(out)
-    print(err)
+    return mask & ~ndimage.binary_erosion(mask, ndimage.generate_binary_structure(3, 1), border_value=0)
 
-    wrkdir = os.path.split(output)[0]
 
-    cmd=['slicer',output,'-c','-s','3',
-         '-x','0.5',os.path.join(wrkdir,'x0v.png'),
-         '-y','0.5',os.path.join(wrkdir,'y0v.png'),
-         '-z','0.5',os.path.join(wrkdir,'z0v.png'),]
+def reference_volume(image, reference='0', chunk_volumes=REFERENCE_CHUNK_VOLUMES):
+    """
+    Derives the 3D volume the QA is run on from a (possibly 4D) image.  A single volume is read on its own, the temporal
+    mean is accumulated over the series chunk_volumes volumes at a time, so memory use doesn't grow with run length.
+    Args:
+        image (str): path to the image
+        reference (str): 'mean' for the temporal mean, otherwise the index of the volume to use (negative indices count
+            from the end)
+        chunk_volumes (int): number of volumes held in memory at once when computing the mean
 
-    print(' '.join(cmd))
-    result = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE,
-                      universal_newlines=True, shell=shell)
+    Returns:
+        img (nibabel.Nifti1Image): the image the volume was read from (header only)
+        data (numpy.ndarray): 3D reference volume
 
-    out, err = result.communicate()
-    print(out)
-    print(err)
+    Raises:
+        ValueError: if reference isn't 'mean' or a volume of the image
+    """
 
-    cmd=['{}/pngappend'.format(os.path.join(os.environ["FSLDIR"],'bin')),os.path.join(wrkdir,'x0v.png'),'+','4',
-         os.path.join(wrkdir,'y0v.png'),'+','4',
-         os.path.join(wrkdir,'z0v.png'),output+'.png']
+    reference = str(reference if reference is not None else '0').strip().lower()
+    img = nb.load(image)
+    n_volumes = img.shape[3] if len(img.shape) > 3 else 1
 
-    print(' '.join(cmd))
-    result = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE,
-                      universal_newlines=True, shell=shell)
+    if reference == 'mean':
+        total = np.zeros(img.shape[:3], dtype=np.float64)
+        for chunk in iter_volume_chunks(img, chunk_volumes):
+            total += chunk.sum(axis=-1)
+        return img, (total / n_volumes).astype(np.float32)
 
-    out, err = result.communicate()
-    print(out)
-    print(err)
+    try:
+        index = int(reference)
+    except ValueError:
+        raise ValueError("QA reference must be 'mean' or a volume index, not '{}'".format(reference))
+    if not -n_volumes <= index < n_volumes:
+        raise ValueError('QA reference volume {} is out of range for {} ({} volumes)'.format(index, image, n_volumes))
 
+    if len(img.shape) > 3:
+        return img, np.asanyarray(img.dataobj[..., index % n_volumes])
+    return img, np.asanyarray(img.dataobj)
 
-def outline_overlay(background, outline, name=''):
+
+def volume_key(img, data, method='numpy'):
     """
-    Generates a .png image of one image's BET extracted brain outline over another image.  Each image containes three
-    overlay views: one along each plane (Cor, Sag, Tra).
+    Returns a key identifying a volume's content: its voxel data, grid and the outline method used on it.
     Args:
-        background (str): path to the backround image
-        outline (str): path to the image who's BET extracted brain is outlined and overlayed on 'background'
-        name (str): The name to save the final image as
+        img (nibabel.Nifti1Image): the image the volume was read from (header only)
+        data (numpy.ndarray): the volume
+        method (str): the outline method
 
     Returns:
+        key (str): hex digest
+    """
+
+    digest = hashlib.sha256()
+    digest.update(method.encode())
+    digest.update(str(data.shape).encode())
+    digest.update(str(data.dtype).encode())
+    digest.update(np.ascontiguousarray(img.affine).tobytes())
+    digest.update(np.ascontiguousarray(data).tobytes())
+    return digest.hexdigest()
+
 
+class OutlineStore:
+    """
+    Memoized brain masks and outlines, keyed by volume content (see volume_key).  Entries are kept in memory for the
+    run and, if a store directory is given, saved there as bit-packed arrays so reruns can reuse them.  Files are
+    written under a temporary name and renamed, so concurrent reports and gear runs can share the directory.
+    Args:
+        store_dir (str): directory to persist entries in (memory only if None)
     """
 
+    def __init__(self, store_dir=None):
+        self.store_dir = store_dir
+        self._entries = {}
+        self._lock = threading.Lock()
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+
+    def get(self, key):
+        """Returns (mask, outline) for a key, or None if it hasn't been computed."""
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key]
+
+        if not self.store_dir:
+            return None
+        try:
+            with np.load(os.path.join(self.store_dir, key + '.npz')) as f:
+                shape = tuple(f['shape'])
+                size = int(np.prod(shape))
+                entry = tuple(np.unpackbits(f[name], count=size).astype(bool).reshape(shape)
+                              for name in ('mask', 'outline'))
+        except (OSError, KeyError, ValueError):
+            return None
+
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    def put(self, key, mask, outline):
+        """Stores the mask and outline computed for a key."""
+        with self._lock:
+            self._entries[key] = (mask, outline)
+
+        if not self.store_dir:
+            return
+        fd, tmp = tempfile.mkstemp(prefix='.' + key, suffix='.npz', dir=self.store_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, shape=np.array(mask.shape), mask=np.packbits(mask), outline=np.packbits(outline))
+            os.replace(tmp, os.path.join(self.store_dir, key + '.npz'))
+        except OSError as e:
+            log.debug('Unable to save outline %s: %s', key, e)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def image_outline(image, workdir='', method='numpy', store=None, volume=None):
+    """
+    Computes the brain outline of an image's first volume (or of the volume passed in), see image_mask_outline.
 
-    bg_dir, bg_base = os.path.split(background)
-    ol_dir, ol_base = os.path.split(outline)
+    Returns:
+        outline (numpy.ndarray): boolean outline mask
+    """
 
-    if name == '':
-        bg_root = bg_base[:bg_base.find('.nii')]
-        ol_root = ol_base[:ol_base.find('.nii')]
-        name = '{}_on_{}'.format(ol_root, bg_root)
-        work_base = bg_dir
+    return image_mask_outline(image, workdir, method, store, volume)[1]
+
+
+def image_mask_outline(image, workdir='', method='numpy', store=None, volume=None):
+    """
+    Computes the brain mask and its outline for an image's first volume (or for the volume passed in).
+    Args:
+        image (str): path to the image to outline
+        workdir (str): base path for bet2's files, each image gets its own subdirectory (only used by the 'fsl' method)
+        method (str): 'numpy' computes the mask and outline in memory, 'fsl' uses bet and bet_2_outline
+        store (OutlineStore): memoized outlines, the outline is only computed if the store doesn't have it
+        volume (tuple): the (img, data) volume to outline if it has already been read (e.g. by reference_volume)
+
+    Returns:
+        mask (numpy.ndarray): boolean brain mask
+        outline (numpy.ndarray): boolean outline mask
+    """
+
+    img, data = volume or first_volume(image)
+    key = volume_key(img, data, method)
+    if store:
+        entry = store.get(key)
+        if entry is not None:
+            log.debug('Reusing outline of %s', image)
+            return entry
+
+    if method == 'fsl':
+        # bet2's files are named after its output root, so each image gets its own directory
+        image_workdir = os.path.join(workdir, key[:16])
+        os.makedirs(image_workdir, exist_ok=True)
+        # bet2 works on the volume the report shows rather than on the whole series
+        reference = os.path.join(image_workdir, 'reference.nii.gz')
+        nb.save(nb.Nifti1Image(np.asarray(data, dtype=np.float32), img.affine), reference)
+        bet_out = bet(reference, image_workdir, True)
+        bin_out = bet_2_outline(reference, bet_out, shell=False)
+        mask = np.asanyarray(nb.load(bet_out + '_mask.nii.gz').dataobj) > 0
+        outline = np.asanyarray(nb.load(bin_out + '.nii.gz').dataobj) > 0
     else:
-        work_base = os.path.split(name)[0]
+        mask = brain_mask(data)
+        outline = mask_outline(mask)
+
+    if store:
+        store.put(key, mask, outline)
+    return mask, outline
+
+
+def center_slices(volume):
+    """
+    Takes the three orthogonal slices through the centre of a volume (sagittal, coronal, axial, as slicer -x/-y/-z 0.5),
+    rotated so the second in-plane axis points up.
+    Args:
+        volume (numpy.ndarray): 3D array
+
+    Returns:
+        slices (list): the three 2D slices
+    """
+
+    nx, ny, nz = volume.shape[:3]
+    return [np.rot90(volume[nx // 2, :, :]), np.rot90(volume[:, ny // 2, :]), np.rot90(volume[:, :, nz // 2])]
+
+
+def render_panel(background, outline, scale=3, gap=4):
+    """
+    Renders the outline in red over the three centre slices of the background, side by side (as overlay, slicer and
+    pngappend did).
+    Args:
+        background (numpy.ndarray): 3D background volume
+        outline (numpy.ndarray): 3D boolean outline mask on the same grid
+        scale (int): upsampling factor of each slice (slicer -s)
+        gap (int): width in pixels of the black gap between slices (pngappend + <gap>)
+
+    Returns:
+        panel (numpy.ndarray): RGB image (height, width, 3) with values in [0, 1]
+    """
+
+    background = np.nan_to_num(np.asarray(background, dtype=np.float32))
+    low, high = np.percentile(background, [2, 98])
+    gray = np.clip((background - low) / max(high - low, np.finfo(np.float32).eps), 0, 1)
 
-    workdir = os.path.join(work_base, 'outline_work')
-    os.makedirs(workdir, exist_ok=True)
+    views = []
+    for gray_slice, outline_slice in zip(center_slices(gray), center_slices(outline)):
+        rgb = np.repeat(gray_slice[..., np.newaxis], 3, axis=-1)
+        rgb[outline_slice > 0] = (1, 0, 0)
+        views.append(rgb.repeat(scale, axis=0).repeat(scale, axis=1))
 
-    bet_out = bet(outline, workdir, True)
+    height = max(view.shape[0] for view in views)
+    panel = []
+    for view in views:
+        pad = height - view.shape[0]
+        panel.append(np.pad(view, ((pad // 2, pad - pad // 2), (0, 0), (0, 0))))
+        panel.append(np.zeros((height, gap, 3), dtype=view.dtype))
 
-    mask_outline = bet_2_outline(outline, bet_out, shell=False)
-    overlay(background, mask_outline, name, shell=False)
+    return np.concatenate(panel[:-1], axis=1)
 
 
-def plot_overlays(files, titles, output):
+def write_report(panels, titles, output):
     """
-    Takes any number N of .png files, each with an associated title, and plots them together in a Nx1 subplot.
+    Writes panels with their titles as one Nx1 figure, using matplotlib's object oriented API (no pyplot state) so it
+    can run from several threads at once.  The png is written under a temporary name and renamed into place, so
+    concurrent processes never see a partial report.
     Args:
-        files (list): list of paths to .png images to include in the plot (ordered)
+        panels (list): RGB images to include in the plot (ordered)
         titles (list): list of titles to assign to each plot
         output (str): the output name to save the image as
 
     Returns:
-
+        output (str): path to the report
     """
 
-    if not len(files) == len(titles):
-        log.warning('Number of files different than number of provided titles')
+    if not len(panels) == len(titles):
+        log.warning('Number of panels different than number of provided titles')
         return
 
-    f, ax = pl.subplots(len(files), 1)
+    fig = Figure()
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.subplots(len(panels), 1, squeeze=False)[:, 0]
 
-    for ai, a in enumerate(ax):
-        file = files[ai]
-        title = titles[ai]
-        image = mpm.imread(file+'.png')
-        a.imshow(image)
+    for a, panel, title in zip(ax, panels, titles):
+        a.imshow(panel)
         a.set_title(title)
         a.set_xticks([])
         a.set_yticks([])
 
-    pl.tight_layout()
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(output), suffix='.png', dir=os.path.dirname(output) or '.')
+    try:
+        with _render_lock, os.fdopen(fd, 'wb') as f:
+            fig.tight_layout()
+            canvas.print_png(f)
+        os.replace(tmp, output)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return output
 
-    pl.savefig(output)
-    pl.close()
 
-def generate_topup_report(original_image, corrected_image, output_base=''):
+def generate_topup_report(original_image, corrected_image, output_base='', method='numpy', store=None,
+                          reference='0', volumes=None):
     """
     Taking an original and topup corrected image, this creates a QA report image by overlaying an outline of the topup
     corrected image over the original, as well as overlaying an outline of the original image over the topup corrected
@@ -238,6 +440,11 @@ def generate_topup_report(original_image, corrected_image, output_base=''):
         original_image (str): path to original image
         corrected_image (str): path to TOPUP fixed image
         output_base (str): base directory for output files
+        method (str): how the brain outlines are computed, 'numpy' (in-process) or 'fsl' (bet2 and fslmaths)
+        store (OutlineStore): memoized outlines shared between reports
+        reference (str): the volume of 4D images the report is made from, a volume index or 'mean' (see
+            reference_volume)
+        volumes (tuple): the original and corrected reference volumes, if they have already been read
 
     Returns:
         report_out (str): The path to the final QA image
@@ -251,54 +458,18 @@ def generate_topup_report(original_image, corrected_image, output_base=''):
 
     original_base = original_base[:original_base.find('.nii.gz')]
 
-    log.info('overlay 1')
-    name1 = os.path.join(output_base, 'corrected_over_original')
-    outline_overlay(original_image, corrected_image, name1)
-
-    log.info('overlay 2')
-    name2 = os.path.join(output_base,'original_over_corrected')
-    outline_overlay(corrected_image, original_image, name2)
+    # each image is read and outlined once, and used both as a background and as an outline
+    original_volume, corrected_volume = volumes or (reference_volume(original_image, reference),
+                                                    reference_volume(corrected_image, reference))
+    workdir = os.path.join(output_base, 'outline_work')
+    original_outline = image_outline(original_image, workdir, method, store, original_volume)
+    corrected_outline = image_outline(corrected_image, workdir, method, store, corrected_volume)
+    original = original_volume[1]
+    corrected = corrected_volume[1]
 
     log.info('generating report')
     report_out = os.path.join(output_base,'{}_QA_report.png'.format(original_base))
-    plot_overlays([name1, name2], ['topup (red) over original', 'original (red) over topup'], report_out)
+    write_report([render_panel(original, corrected_outline), render_panel(corrected, original_outline)],
+                 ['topup (red) over original', 'original (red) over topup'], report_out)
 
     return(report_out)
-
-
-def debug2():
-    #cmd = "drun -v /Users/davidparker/Documents/Flywheel/SSE/MyWork/Gears/Topup/Gear/fsl-topup:/flywheel/v0 flywheel/fsl-topup:0.0.4"
-    import shutil
-
-    # file_comparison = [(apply_to_files[i][0], corrected_files[i]) for i in range(len(corrected_files))]
-
-    file_comparison = [('/flywheel/v0/work/Image1.nii.gz', '/flywheel/v0/output/topup-corrected-nodif.nii.gz'), ('/flywheel/v0/work/Image2.nii.gz', '/flywheel/v0/output/topup-corrected-nodif_PA.nii.gz')]
-    log.info('Running Topup QA')
-
-    work_dir = '/flywheel/v0/work'
-    output_dir = '/flywheel/v0/output'
-
-    for original, corrected in file_comparison:
-        report_out = generate_topup_report(original, corrected, work_dir)
-        report_dir, report_base = os.path.split(report_out)
-        shutil.move(report_out, os.path.join(output_dir, report_base))
-
-        # Move the config file used in the analysis to the output
-        config_path = '/flywheel/v0/output/config_file.txt'
-        config_out =  '/flywheel/v0/output/config_file.txt'
-
-        if not config_path:
-            config_path = DEFAULT_CONFIG
-        if os.path.exists(config_path):
-            shutil.move(config_path, config_out)
-        else:
-            log.info(f'no path {config_path}')
-            exec_command(['ls', '-l', '/'])
-            exec_command(['ls', '-l', '/flywheel'])
-            exec_command(['ls', '-l', '/flywheel/v0'])
-
-
-if __name__ == '__main__':
-    debug2()
-
-
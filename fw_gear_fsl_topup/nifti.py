@@ -0,0 +1,118 @@
+"""In-process NIfTI helpers that replace FSL subprocesses for simple image handling."""
+
+import logging
+import os
+
+import nibabel as nb
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def first_volume(image):
+    """Reads the first volume of an image.
+
+    Only the first volume is read from disk (through nibabel's array proxy), so long 4D series are not decompressed
+    past the volume we need.
+
+    Args:
+        image (str): path to a 3D or 4D image
+
+    Returns:
+        img (nibabel.Nifti1Image): the image the volume was read from (header only)
+        data (numpy.ndarray): 3D array holding the first volume
+    """
+    img = nb.load(image)
+    if len(img.shape) > 3:
+        data = np.asanyarray(img.dataobj[..., 0])
+    else:
+        data = np.asanyarray(img.dataobj)
+    return img, data
+
+
+def merge_first_volumes(images, merged, atol=1e-3):
+    """Writes the first volume of each image into one 4D image (the equivalent of fslroi/fslmaths then fslmerge -t).
+
+    As with fslmerge, all images must have the same spatial dimensions and the header of the first image is used for
+    the output.
+
+    Args:
+        images (list): paths to the images to merge, in output volume order
+        merged (str): path of the output image (including the extension)
+        atol (float): tolerance used when checking the images share the same voxel to world mapping
+
+    Returns:
+        merged (str): path to the merged image
+
+    Raises:
+        ValueError: if the images do not have the same spatial dimensions
+    """
+    volumes = [first_volume(image) for image in images]
+    ref_img, ref_data = volumes[0]
+
+    for image, (img, data) in zip(images[1:], volumes[1:]):
+        if data.shape != ref_data.shape:
+            raise ValueError("Error in size-match along non-concatenated dimension: {} {} vs {} {}".format(
+                images[0], ref_data.shape, image, data.shape))
+        if not np.allclose(img.affine, ref_img.affine, atol=atol):
+            log.warning("Image %s has a different orientation than %s, using the orientation of %s",
+                        image, images[0], images[0])
+
+    # keep the on-disk data type when nothing was scaled, otherwise store the scaled values as float
+    dtypes = {img.get_data_dtype() for img, _ in volumes}
+    scaled = any(img.dataobj.slope != 1 or img.dataobj.inter != 0 for img, _ in volumes)
+    dtype = dtypes.pop() if len(dtypes) == 1 and not scaled else np.float32
+
+    data = np.stack([data for _, data in volumes], axis=-1).astype(dtype, copy=False)
+
+    header = ref_img.header.copy()
+    header.set_data_dtype(dtype)
+    header.set_data_shape(data.shape)
+    header.set_slope_inter(np.nan, np.nan)
+
+    nb.save(nb.Nifti1Image(data, ref_img.affine, header), merged)
+
+    return merged
+
+
+def compare_images(image1, image2, rtol=1e-5, atol=1e-6):
+    """Checks two images hold the same voxel data on the same grid.
+
+    Args:
+        image1 (str): path to the first image
+        image2 (str): path to the second image
+        rtol (float): relative tolerance for the voxel values
+        atol (float): absolute tolerance for the voxel values
+
+    Returns:
+        (bool): True if the images match
+    """
+    img1 = nb.load(image1)
+    img2 = nb.load(image2)
+
+    if img1.shape != img2.shape:
+        log.info("Shape mismatch: %s %s vs %s %s", image1, img1.shape, image2, img2.shape)
+        return False
+
+    if not np.allclose(img1.affine, img2.affine, atol=1e-3):
+        log.info("Affine mismatch: %s vs %s", image1, image2)
+        return False
+
+    data1 = np.asanyarray(img1.dataobj, dtype=np.float64)
+    data2 = np.asanyarray(img2.dataobj, dtype=np.float64)
+    if not np.allclose(data1, data2, rtol=rtol, atol=atol):
+        log.info("Voxel mismatch: %s vs %s (max abs difference %g)", image1, image2, np.abs(data1 - data2).max())
+        return False
+
+    return True
+
+
+def nifti_path(image):
+    """Returns the file for an FSL style image root (e.g. "topup_vols" -> "topup_vols.nii.gz")."""
+    image = str(image)
+    if os.path.exists(image):
+        return image
+    for ext in (".nii.gz", ".nii"):
+        if os.path.exists(image + ext):
+            return image + ext
+    raise FileNotFoundError(image)
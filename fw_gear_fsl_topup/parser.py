@@ -1,22 +1,42 @@
 """Parser module to parse gear config.json."""
 from typing import Tuple
 from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor
 from flywheel_gear_toolkit import GearToolkitContext
 import os
+import json
 import logging
-from fw_gear_fsl_topup.common import execute_shell, searchfiles
+import shutil
+import stat
+from datetime import datetime
+from fw_gear_fsl_topup.common import PathResolver, execute_shell, searchfiles
+from fw_gear_fsl_topup.bids_index import SessionIndex, split_extension
+from fw_gear_fsl_topup.download import DownloadCache, download_session_bids
 import errorhandler
+from utils.fly.set_performance_config import set_mem_gb, set_n_cpus
 
 log = logging.getLogger(__name__)
 
 # Track if message gets logged with severity of error or greater
 error_handler = errorhandler.ErrorHandler()
 
+# saved session index, reused by reruns in the same inputs directory
+BIDS_INDEX_FILE = ".topup_bids_index.json"
+
 def parse_config(
         gear_context: GearToolkitContext,
+        session=None,
+        download_cache=None,
 ) -> Tuple[dict, dict]:
     """Parse the config and other options from the context, both gear and app options.
 
+    Args:
+        gear_context: the gear context
+        session: in batch mode (see batch.py), the session to resolve inputs for instead of the destination's. It
+            gets its own work directory (work-dir/<session id>) and its inputs are always downloaded from its BIDS
+            curation, the session specific inputs of the gear are not used
+        download_cache (DownloadCache): cache shared with other sessions, created from the config if None
+
     Returns:
         gear_options: options for the gear
         app_options: options to pass to the app
@@ -24,14 +44,15 @@ def parse_config(
     # ##   Gear config   ## #
     errors = []
 
+    work_dir = gear_context.work_dir if session is None else gear_context.work_dir / session.id
     options = {"gear-log-level": gear_context.config.get("gear-log-level"),
                "output-dir": gear_context.output_dir,
                "destination-id": gear_context.destination["id"],
-               "work-dir": gear_context.work_dir,
+               "work-dir": work_dir,
                "client": gear_context.client,
                "environ": os.environ,
                "output_analysis_id_dir": (
-                gear_context.work_dir / gear_context.destination["id"]),
+                work_dir / gear_context.destination["id"]),
                "dry-run": gear_context.config.get("gear-dry-run")
         }
 
@@ -42,57 +63,166 @@ def parse_config(
         "rigid_body_matrix",
         "verbose",
         "topup_debug_level",
+        "parallel_pairs",
+        "topup_input_method",
+        "apply_method",
+        "apply_chunk_volumes",
+        "max_concurrent_stages",
+        "resume",
+        "slurm_backend",
+        "slurm_bin_dir",
+        "slurm_job_prefix",
+        "slurm_poll_seconds",
+        "slurm_array_limit",
+        "slurm-cpu",
+        "slurm-ram",
+        "slurm-ntasks",
+        "slurm-nodes",
+        "slurm-partition",
+        "slurm-qos",
+        "slurm-account",
+        "slurm-time",
     ]
     options.update({key: gear_context.config.get(key) for key in options_keys})
 
+    # number of workers used for any parallel steps
+    options["n_cpus"] = set_n_cpus(int(gear_context.config.get("slurm-cpu") or 0))
+    # memory budget of the concurrent steps (see resources.py)
+    options["mem_gb"] = set_mem_gb(float(gear_context.config.get("mem_gb") or 0))
+
+    # topup results cache, shared between runs on the same scratch volume
+    options["topup-cache-gb"] = gear_context.config.get("topup_cache_gb")
+    if options["topup-cache-gb"] and gear_context.config.get("gear-writable-dir"):
+        options["topup-cache-dir"] = os.path.join(gear_context.config.get("gear-writable-dir"), "topup-cache")
+
+    # cache of downloaded flywheel files, keyed by file id and version
+    options["download-cache-gb"] = gear_context.config.get("download_cache_gb")
+    if options["download-cache-gb"] and gear_context.config.get("gear-writable-dir"):
+        options["download-cache-dir"] = os.path.join(gear_context.config.get("gear-writable-dir"), "download-cache")
+
+    # brain outlines computed for QA, reused by reruns on the same images
+    if gear_context.config.get("gear-writable-dir"):
+        options["qa-cache-dir"] = os.path.join(gear_context.config.get("gear-writable-dir"), "qa-cache")
+
+    if download_cache is not None:
+        options["download-cache"] = download_cache
+
     os.makedirs(options["output_analysis_id_dir"], exist_ok=True)
 
+    if session is None:
+        destination = gear_context.client.get(gear_context.destination["id"])
+        sid = gear_context.client.get(destination.parents.subject)
+        sesid = gear_context.client.get(destination.parents.session)
+    else:
+        sid = gear_context.client.get(session.parents.subject)
+        sesid = session
+
+    options["sid"] = sid.label
+    options["sesid"] = sesid.label
+    options["session-id"] = sesid.id
+    if session is not None:
+        # names the session's archive and metrics among the other sessions' outputs
+        options["batch-label"] = "sub-{}_ses-{}".format(sid.label, sesid.label)
+
+    # check that bids derivative intended for json is also passed - if not, return error
+    if session is None and gear_context.get_input_path("bids-derivative-intended-for"):
+        options["intended_for"] = gear_context.get_input_path("bids-derivative-intended-for")
+
+    if gear_context.get_input_path("_acquisition_parameters"):
+        options["acq_par"] = gear_context.get_input_path('_acquisition_parameters')
+
+    if gear_context.get_input_path("_config_file"):
+       options["config_path"] = gear_context.get_input_path('_config_file')
+
     # unzip input files
-    if gear_context.get_input_path("preprocessing-pipeline-zip"):
+    if session is None and gear_context.get_input_path("preprocessing-pipeline-zip"):
         options["preproc_zip"] = True
         options["preproc_zipfile"] = gear_context.get_input_path("preprocessing-pipeline-zip")
 
         log.info("Preprocessed zip inputs file path, %s", options["preproc_zipfile"])
-        rc, outpath = unzip_inputs(options, options["preproc_zipfile"])
+
+        # read the zip's central directory once, it tells us where the inputs will be extracted to
+        zip_index = read_zip_index(options["preproc_zipfile"])
+        outpath = zip_output_paths(options, zip_index)
         options["inputs-dir"] = os.path.join(outpath[0])
 
         # download fieldmaps from flywheel
-        gear_context.download_session_bids(
-            target_dir=os.path.join(gear_context.work_dir, outpath[0]),
-            folders=['fmap']
-        )
+        download_bids(options, os.path.join(work_dir, outpath[0]), folders=['fmap'])
+
+        if options["topup_only"]:
+            # nothing is corrected, the fieldmaps are all we need
+            log.info("topup_only: not extracting the preprocessing zip")
+        else:
+            # only extract the files the fieldmaps are intended for, unless asked to extract everything
+            members = []
+            if (gear_context.config.get("unzip_mode") or "selective") == "selective":
+                members = select_intended_for_members(options, zip_index)
+
+            if members:
+                extract_members(options, options["preproc_zipfile"], members, zip_index)
+            else:
+                log.info("Extracting the whole preprocessing zip")
+                rc, outpath = unzip_inputs(options, options["preproc_zipfile"])
+
+                # the full extraction may have replaced the fieldmaps we downloaded
+                download_bids(options, os.path.join(work_dir, outpath[0]), folders=['fmap'])
 
     # if no external input is passed - and BIDS mode used, download bids dir
     else:
-        outpath = os.path.join(gear_context.work_dir, "BIDS")
+        outpath = os.path.join(work_dir, "BIDS")
         options["inputs-dir"] = os.path.join(outpath)
 
-        gear_context.download_session_bids(
-            target_dir=outpath
-        )
+        # only the fieldmaps and the files they are intended for are used
+        download_bids(options, outpath, folders=['fmap'])
+        if not options["topup_only"]:
+            download_bids(options, outpath, paths=intended_for_paths(options))
 
-    # check that bids derivative intended for json is also passed - if not, return error
-    if gear_context.get_input_path("bids-derivative-intended-for"):
-        options["intended_for"] = gear_context.get_input_path("bids-derivative-intended-for")
+    options["fmaps"] = searchfiles(os.path.join(options["inputs-dir"],"sub-"+sid.label,"ses-"+sesid.label,"fmap/*.nii.gz"))
 
-    if gear_context.get_input_path("_acquisition_parameters"):
-        options["acq_par"] = gear_context.get_input_path('_acquisition_parameters')
+    # index entities, sidecars and image headers once for the whole session
+    options["bids-index"] = SessionIndex.build(
+        os.path.join(options["inputs-dir"], "sub-" + sid.label),
+        index_file=os.path.join(options["inputs-dir"], BIDS_INDEX_FILE),
+    )
+    # IntendedFor files of every pair are looked up in the index's listing rather than the filesystem
+    options["path-resolver"] = PathResolver.from_paths(options["bids-index"].entries)
 
-    if gear_context.get_input_path("_config_file"):
-       options["config_path"] = gear_context.get_input_path('_config_file')
+    return options
 
-    destination = gear_context.client.get(gear_context.destination["id"])
-    sid = gear_context.client.get(destination.parents.subject)
-    sesid = gear_context.client.get(destination.parents.session)
 
-    options["sid"] = sid.label
-    options["sesid"] = sesid.label
+def download_bids(gear_options, target_dir, folders=None, paths=None):
+    """Downloads the session's BIDS files into target_dir through the download cache (see download.py)."""
+    return download_session_bids(
+        gear_options["client"],
+        gear_options["session-id"],
+        target_dir,
+        folders=folders,
+        paths=paths,
+        cache=gear_options.get("download-cache") or DownloadCache.from_options(gear_options),
+        n_workers=gear_options.get("n_cpus"),
+        dry_run=gear_options.get("dry-run"),
+    )
 
 
+def intended_for_paths(gear_options):
+    """Returns the IntendedFor files of the downloaded fieldmaps, relative to the inputs directory."""
+    if "intended_for" in gear_options:
+        sidecars = [gear_options["intended_for"]]
+    else:
+        sidecars = searchfiles(os.path.join(gear_options["inputs-dir"], "sub-" + gear_options["sid"],
+                                            "ses-" + gear_options["sesid"], "fmap/*.json"), exit_on_errors=False)
 
-    options["fmaps"] = searchfiles(os.path.join(options["inputs-dir"],"sub-"+sid.label,"ses-"+sesid.label,"fmap/*.nii.gz"))
+    paths = []
+    for sidecar in sidecars:
+        if not sidecar:
+            continue
+        with open(sidecar) as f:
+            intended_for = json.load(f).get("IntendedFor", [])
+        if isinstance(intended_for, str):
+            intended_for = [intended_for]
+        paths.extend(os.path.join("sub-" + gear_options["sid"], path) for path in intended_for)
 
-    return options
+    return list(dict.fromkeys(paths))
 
 
 def unzip_inputs(gear_options, zip_filename):
@@ -124,15 +254,16 @@ def unzip_inputs(gear_options, zip_filename):
 
     if len(top[0]) == 24:
         # directory starts with flywheel destination id - obscure this for now...
-        cmd = "mv "+top[0]+'/* . ; rm -R '+top[0]
+        # (merged with hard links, as a resumed run may already have the directories)
+        cmd = "cp -al --remove-destination "+top[0]+'/. . ; rm -R '+top[0]
         execute_shell(cmd, cwd=gear_options["work-dir"])
-        for i in set(top1):
+        for i in dict.fromkeys(top1):
             outpath.append(os.path.join(gear_options["work-dir"], i))
 
         # get previous gear info
         gear_options["preproc_gear"] = gear_options["client"].get(top[0])
     else:
-        outpath = os.path.join(gear_options["work-dir"], top[0])
+        outpath = [os.path.join(gear_options["work-dir"], top[0])]
 
     if error_handler.fired:
         log.critical('Failure: exiting with code 1 due to logged errors')
@@ -142,3 +273,124 @@ def unzip_inputs(gear_options, zip_filename):
     return rc, outpath
 
 
+
+
+def read_zip_index(zip_filename):
+    """Reads the central directory of a zip file.
+
+    Args:
+        zip_filename (string): the zip file
+
+    Returns:
+        infos (list): the zip's ZipInfo members, in archive order
+        strip (string): leading "<destination id>/" directory that is removed on extraction ("" if there is none)
+    """
+    with ZipFile(zip_filename, "r") as f:
+        infos = f.infolist()
+
+    top = infos[0].filename.split('/')[0]
+    # directory starts with flywheel destination id - obscure this for now...
+    strip = top + '/' if len(top) == 24 else ''
+
+    return infos, strip
+
+
+def zip_output_paths(gear_options, zip_index):
+    """Returns the top level directories the zip's contents are extracted to (see unzip_inputs)."""
+    infos, strip = zip_index
+    names = [info.filename[len(strip):] for info in infos]
+    # unique first path components, in archive order
+    tops = dict.fromkeys(name.split('/')[0] for name in names)
+    return [os.path.join(gear_options["work-dir"], top) for top in tops if top]
+
+
+def select_intended_for_members(gear_options, zip_index):
+    """Finds the zip members that will be corrected: the IntendedFor files of the session's fieldmaps and their sidecars.
+
+    IntendedFor lists are read from the bids-derivative-intended-for file if it was provided, otherwise from the
+    sidecars of the downloaded fieldmaps.
+
+    Returns:
+        members (list): names of the zip members to extract (empty if none could be matched)
+    """
+    infos, strip = zip_index
+    names = {info.filename for info in infos}
+
+    # member names of files in the inputs directory
+    inputs_dir = os.path.relpath(gear_options["inputs-dir"], str(gear_options["work-dir"]))
+    prefix = strip + inputs_dir.replace(os.sep, '/') + '/'
+
+    members = []
+    for path in intended_for_paths(gear_options):
+        path = path.replace(os.sep, '/')
+        if prefix + path not in names:
+            log.warning("IntendedFor file %s is not in the preprocessing zip", path)
+            continue
+        members.append(prefix + path)
+        sidecar_member = prefix + split_extension(path)[0] + ".json"
+        if sidecar_member in names:
+            members.append(sidecar_member)
+
+    members = list(dict.fromkeys(members))
+    log.info("Selected %d of %d zip members from IntendedFor lists", len(members), len(names))
+    return members
+
+
+def extract_members(gear_options, zip_filename, members, zip_index):
+    """Extracts the selected zip members directly to their final paths, in parallel.
+
+    The leading destination id directory is removed from the member paths (as unzip_inputs does) and symbolic links
+    stored in the zip are recreated as links.
+
+    Args:
+        gear_options (dict): gear options ("work-dir" and "n_cpus" are used)
+        zip_filename (string): the zip file
+        members (list): names of the members to extract
+        zip_index (tuple): result of read_zip_index
+    """
+    _, strip = zip_index
+    if strip:
+        # get previous gear info
+        gear_options["preproc_gear"] = gear_options["client"].get(strip.rstrip('/'))
+
+    n_workers = max(1, min(len(members), gear_options.get("n_cpus") or 1))
+    log.info("Extracting %d files from %s using %d workers", len(members), zip_filename, n_workers)
+
+    def extract(chunk):
+        # each worker uses its own handle, ZipFile objects are not safe to share between threads
+        with ZipFile(zip_filename, "r") as zf:
+            for name in chunk:
+                info = zf.getinfo(name)
+                target = os.path.join(str(gear_options["work-dir"]), name[len(strip):])
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                mtime = datetime(*info.date_time).timestamp()
+                if _extracted(target, info, mtime):
+                    # left by an earlier run in the same work directory
+                    continue
+                if os.path.lexists(target):
+                    os.remove(target)
+                if stat.S_ISLNK(info.external_attr >> 16):
+                    os.symlink(zf.read(info).decode(), target)
+                else:
+                    # extracted under a temporary name, so a partially extracted file is never taken as complete
+                    partial = os.path.join(os.path.dirname(target), ".partial-" + os.path.basename(target))
+                    with zf.open(info) as src, open(partial, "wb") as dst:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+                    os.utime(partial, (mtime, mtime))
+                    os.replace(partial, target)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(extract, [members[i::n_workers] for i in range(n_workers)]))
+
+    log.info("Done unzipping.")
+
+
+def _extracted(target, info, mtime):
+    """True if target already holds the zip member (same size and modified time, as set by extract_members)."""
+    if stat.S_ISLNK(info.external_attr >> 16):
+        return False
+    try:
+        st = os.stat(target)
+    except FileNotFoundError:
+        return False
+    return st.st_size == info.file_size and int(st.st_mtime) == int(mtime)
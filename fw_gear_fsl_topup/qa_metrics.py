@@ -0,0 +1,194 @@
+"""Quantitative topup QA metrics, computed in-process for each corrected file.
+
+For every (original, corrected) file the metrics describe the field topup estimated (range in Hz, largest voxel
+displacement along the file's phase encode axis and the Jacobian extrema), how well the two corrected fieldmaps agree
+(correlation and normalized mutual information of topup's --iout volumes within the brain mask) and how much the
+correction changed the file. Metrics are cheap compared to rendering a report, so across a cohort the png reports can be
+limited to the runs whose metrics cross a threshold.
+"""
+
+import csv
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import nibabel as nb
+import numpy as np
+
+from fw_gear_fsl_topup.applytopup import displacement_map, jacobian_map, read_acq_params
+from fw_gear_fsl_topup.nifti import nifti_path
+
+log = logging.getLogger(__name__)
+
+METRICS_FILE = "topup_qa_metrics"
+
+# a report is rendered when any of these is crossed (see exceeded_thresholds)
+DEFAULT_THRESHOLDS = {
+    "max_displacement": 8.0,
+    "jacobian_min": 0.2,
+    "jacobian_max": 5.0,
+    "min_similarity": 0.9,
+}
+
+# number of (topup result, acquisition row) field metrics kept, enough for the pairs of the sessions running at once
+FIELD_CACHE_SIZE = 64
+
+# the topup field metrics are shared by every file corrected with the same topup result and acquisition row, the most
+# recently used FIELD_CACHE_SIZE are kept
+_field_cache = OrderedDict()
+_field_lock = threading.Lock()
+
+
+def correlation(a, b, mask):
+    """Pearson correlation of two volumes within a mask."""
+    a = np.asarray(a, dtype=np.float64)[mask]
+    b = np.asarray(b, dtype=np.float64)[mask]
+    if a.size < 2 or a.std() == 0 or b.std() == 0:
+        return float("nan")
+    return float(np.corrcoef(a, b)[0, 1])
+
+
+def normalized_mutual_information(a, b, mask, bins=64):
+    """Normalized mutual information (H(a) + H(b)) / H(a, b) of two volumes within a mask, between 1 and 2."""
+    a = np.asarray(a, dtype=np.float64)[mask]
+    b = np.asarray(b, dtype=np.float64)[mask]
+    if a.size == 0:
+        return float("nan")
+    joint, _, _ = np.histogram2d(a, b, bins=bins)
+    joint /= joint.sum()
+
+    def entropy(p):
+        p = p[p > 0]
+        return -np.sum(p * np.log(p))
+
+    h_joint = entropy(joint)
+    if h_joint == 0:
+        return float("nan")
+    return float((entropy(joint.sum(axis=1)) + entropy(joint.sum(axis=0))) / h_joint)
+
+
+def field_metrics(topup_out, acq_params, index, mask_fn):
+    """Summarizes topup's field for one acquisition parameter row.
+
+    Args:
+        topup_out (str): the topup root path (reads <topup_out>-fmap and <topup_out>-input-corrected)
+        acq_params (str): path to the acquisition parameters file
+        index (int): the (1 based) acquisition parameter row the file was corrected with
+        mask_fn (callable): returns a brain mask for a 3D volume
+
+    Returns:
+        metrics (dict): field range in Hz, largest absolute displacement in voxels, Jacobian extrema and the
+            similarity of the corrected fieldmaps, all within the brain mask of the corrected fieldmaps
+    """
+    fmap = nifti_path(topup_out + "-fmap")
+    key = (os.path.realpath(fmap), os.stat(fmap).st_mtime_ns, os.path.realpath(acq_params), int(index))
+    with _field_lock:
+        if key in _field_cache:
+            _field_cache.move_to_end(key)
+            return dict(_field_cache[key])
+
+    img = nb.load(fmap)
+    field = np.asanyarray(img.dataobj, dtype=np.float64)
+    if field.ndim > 3:
+        field = field[..., 0]
+
+    corrected = np.asanyarray(nb.load(nifti_path(topup_out + "-input-corrected")).dataobj, dtype=np.float64)
+    if corrected.ndim < 4:
+        corrected = corrected[..., np.newaxis]
+    mask = mask_fn(corrected.mean(axis=-1))
+    if not mask.any():
+        mask = np.ones(field.shape, dtype=bool)
+
+    row = read_acq_params(acq_params)[int(index) - 1]
+    displacement, axis = displacement_map(topup_out, row, img.affine, field.shape)
+    jacobian = jacobian_map(displacement, axis)
+
+    metrics = {
+        "field_min_hz": float(field[mask].min()),
+        "field_max_hz": float(field[mask].max()),
+        "max_displacement_voxels": float(np.abs(displacement[mask]).max()),
+        "jacobian_min": float(jacobian[mask].min()),
+        "jacobian_max": float(jacobian[mask].max()),
+    }
+    if corrected.shape[-1] > 1:
+        metrics["fieldmap_correlation"] = correlation(corrected[..., 0], corrected[..., 1], mask)
+        metrics["fieldmap_nmi"] = normalized_mutual_information(corrected[..., 0], corrected[..., 1], mask)
+
+    with _field_lock:
+        _field_cache[key] = metrics
+        while len(_field_cache) > FIELD_CACHE_SIZE:
+            _field_cache.popitem(last=False)
+    return dict(metrics)
+
+
+def file_metrics(original, corrected, mask):
+    """Similarity of a file before and after correction within a brain mask (3D reference volumes)."""
+    return {
+        "correction_correlation": correlation(original, corrected, mask),
+        "correction_nmi": normalized_mutual_information(original, corrected, mask),
+    }
+
+
+def exceeded_thresholds(metrics, thresholds=None):
+    """Lists the thresholds a file's metrics cross.
+
+    Args:
+        metrics (dict): metrics from field_metrics and file_metrics
+        thresholds (dict): overrides of DEFAULT_THRESHOLDS (None values are ignored)
+
+    Returns:
+        reasons (list): one description per crossed threshold, empty if the run looks fine
+    """
+    limits = dict(DEFAULT_THRESHOLDS)
+    limits.update({key: value for key, value in (thresholds or {}).items() if value is not None})
+
+    reasons = []
+    if metrics.get("max_displacement_voxels", 0) > limits["max_displacement"]:
+        reasons.append("displacement {:.2f} > {} voxels".format(metrics["max_displacement_voxels"],
+                                                               limits["max_displacement"]))
+    if metrics.get("jacobian_min", 1) < limits["jacobian_min"]:
+        reasons.append("Jacobian minimum {:.3f} < {}".format(metrics["jacobian_min"], limits["jacobian_min"]))
+    if metrics.get("jacobian_max", 1) > limits["jacobian_max"]:
+        reasons.append("Jacobian maximum {:.3f} > {}".format(metrics["jacobian_max"], limits["jacobian_max"]))
+    # nan (e.g. a flat image) compares False, so it is flagged explicitly
+    similarity = metrics.get("fieldmap_correlation")
+    if similarity is not None and not similarity >= limits["min_similarity"]:
+        reasons.append("fieldmap correlation {:.3f} < {}".format(similarity, limits["min_similarity"]))
+    return reasons
+
+
+def _defined(value):
+    """Returns value, or None if it is a non-finite number."""
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def write_metrics(rows, output_dir, name=METRICS_FILE):
+    """Writes per file metrics as <name>.json and <name>.tsv (one row per file).
+
+    Returns:
+        paths (list): the json and tsv paths
+    """
+    json_path = os.path.join(output_dir, name + ".json")
+    tsv_path = os.path.join(output_dir, name + ".tsv")
+    # undefined metrics (nan, e.g. for a flat image) are null in the json and n/a in the tsv
+    rows = [{key: _defined(value) for key, value in row.items()} for row in rows]
+
+    with open(json_path + ".tmp", "w") as f:
+        json.dump(rows, f, indent=4, allow_nan=False)
+    os.replace(json_path + ".tmp", json_path)
+
+    columns = list(dict.fromkeys(key for row in rows for key in row))
+    with open(tsv_path + ".tmp", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, delimiter="\t", restval="n/a")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: "; ".join(value) if isinstance(value, list) else "n/a" if value is None else value
+                             for key, value in row.items()})
+    os.replace(tsv_path + ".tmp", tsv_path)
+
+    log.info("Wrote QA metrics for %d files to %s", len(rows), json_path)
+    return [json_path, tsv_path]
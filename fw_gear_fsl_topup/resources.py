@@ -0,0 +1,184 @@
+"""Resource aware admission of pipeline stages.
+
+Stages declare the CPUs they use and an estimate of their peak memory (resources={"cpus": n, "mem_gb": x}). The
+estimates are computed from NIfTI header dimensions and data types, no image data is read. A ResourcePool admits a
+stage only while the summed estimates of the running stages fit in the CPU and memory budget of the gear (slurm-cpu and
+mem_gb, see utils.fly.set_performance_config). A stage that doesn't fit in an empty pool is started on its own, so an
+oversized run is slow rather than stuck. One pool can be shared by the schedulers of several sessions (batch mode, see
+batch.py), which then take turns on the same budget.
+
+Command stages run with OMP_NUM_THREADS and the other thread pool variables pinned to the CPUs they were admitted with,
+so multi-threaded FSL builds and NumPy in child processes don't oversubscribe the cores given to the other stages.
+"""
+
+import logging
+import os
+import threading
+from math import prod
+
+import nibabel as nb
+import numpy as np
+
+from fw_gear_fsl_topup.applytopup import BATCH_VOLUMES
+from fw_gear_fsl_topup.mri_qa import REFERENCE_CHUNK_VOLUMES
+
+log = logging.getLogger(__name__)
+
+GIB = 1024 ** 3
+
+# thread pool sizes read by OpenMP (FSL), BLAS libraries, numexpr and ITK
+THREAD_VARIABLES = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+)
+
+# memory a child process uses before it touches any image (binary, libraries)
+BASE_GB = 0.25
+
+# float32 copies of its input topup keeps (images, field, derivatives, Hessian at each subsampling level)
+TOPUP_FACTOR = 24
+
+# float32 copies of a run FSL applytopup holds besides the input (converted input, output, spline coefficients)
+APPLY_FACTOR = 3
+
+# float64 copies of each chunk the native engine holds (converted chunk, corrected chunk), and bytes per voxel of its
+# correction maps (displacement, Jacobian, spline indices and weights)
+NATIVE_FACTOR = 2
+NATIVE_MAP_BYTES = 80
+
+# float64 volumes held by a QA report (reference volumes, mask, morphology, rendered panels, metrics maps)
+QA_FACTOR = 12
+
+
+class ResourcePool:
+    """CPU and memory budget shared by the running stages of a Scheduler.
+
+    Args:
+        cpus (int): number of CPUs the stages may use at once
+        mem_gb (float): GiB of memory the stages may use at once, memory isn't limited if 0
+    """
+
+    def __init__(self, cpus, mem_gb=0):
+        self.cpus = max(1, int(cpus or 1))
+        self.mem_gb = float(mem_gb or 0)
+        self.used_cpus = 0
+        self.used_mem_gb = 0.0
+        self._admitted = {}
+        self._released = threading.Condition()
+
+    @classmethod
+    def from_options(cls, options):
+        """Returns the pool for the CPU ("n_cpus") and memory ("mem_gb") budget in the gear options."""
+        pool = cls(options.get("n_cpus"), options.get("mem_gb"))
+        log.info("Resource budget: %d CPUs, %s", pool.cpus,
+                 "{:.1f} GiB".format(pool.mem_gb) if pool.mem_gb else "unlimited memory")
+        return pool
+
+    def demand(self, stage):
+        """Returns the (cpus, mem_gb) a stage needs, stages without an estimate use one CPU and no memory."""
+        cpus = min(max(1, int(stage.resources.get("cpus") or 1)), self.cpus)
+        return cpus, float(stage.resources.get("mem_gb") or 0)
+
+    def admit(self, stage):
+        """Reserves a stage's resources and returns True if they fit in what the running stages left."""
+        cpus, mem_gb = self.demand(stage)
+        with self._released:
+            if self._admitted:
+                if self.used_cpus + cpus > self.cpus:
+                    return False
+                if self.mem_gb and self.used_mem_gb + mem_gb > self.mem_gb:
+                    return False
+            elif self.mem_gb and mem_gb > self.mem_gb:
+                log.warning("Stage %s needs an estimated %.1f GiB, more than the %.1f GiB budget, running it alone",
+                            stage.name, mem_gb, self.mem_gb)
+
+            # keyed by stage, not name, as stages of different sessions can have the same name
+            self._admitted[stage] = (cpus, mem_gb)
+            self.used_cpus += cpus
+            self.used_mem_gb += mem_gb
+            return True
+
+    def release(self, stage):
+        """Returns a finished stage's resources to the pool."""
+        with self._released:
+            cpus, mem_gb = self._admitted.pop(stage, (0, 0.0))
+            self.used_cpus -= cpus
+            self.used_mem_gb -= mem_gb
+            self._released.notify_all()
+
+    def wait_for_release(self, timeout=None):
+        """Waits until some stage (of any scheduler using the pool) returns its resources, or timeout seconds."""
+        with self._released:
+            self._released.wait(timeout)
+
+    def environment(self, stage, environ=None):
+        """Returns the environment of a command stage, with the thread pool variables set to its CPUs."""
+        environ = dict(os.environ if environ is None else environ)
+        threads = str(self._admitted.get(stage, self.demand(stage))[0])
+        for variable in THREAD_VARIABLES:
+            environ[variable] = threads
+        return environ
+
+
+def image_header(image, index=None):
+    """Returns the data shape and bytes per voxel of an image, from the session index if there is one."""
+    if index is not None:
+        entry = index.get(image)
+        return tuple(entry["shape"]), np.dtype(entry["dtype"]).itemsize
+    img = nb.load(image)
+    return img.shape, img.get_data_dtype().itemsize
+
+
+def topup_resources(images, cpus=1, index=None):
+    """Estimates topup's peak memory from the fieldmaps it runs on (the first volume of each, merged as float32)."""
+    voxels = sum(prod(image_header(image, index)[0][:3]) for image in images)
+    return {"cpus": cpus, "mem_gb": BASE_GB + TOPUP_FACTOR * voxels * 4 / GIB}
+
+
+def apply_resources(image, method="fsl", chunk_volumes=0, cpus=1, index=None):
+    """Estimates the CPUs and peak memory of correcting one file with apply_method `method`.
+
+    FSL applytopup is single threaded and holds the whole run (or one chunk of `chunk_volumes`). The native engine
+    corrects up to `cpus` chunks at once (no more than the run has), each held with the shared correction maps.
+    "validate" runs both one after the other.
+    """
+    shape, itemsize = image_header(image, index)
+    voxels = prod(shape[:3])
+    volumes = shape[3] if len(shape) > 3 else 1
+
+    fsl_volumes = min(volumes, chunk_volumes) if chunk_volumes else volumes
+    fsl_gb = BASE_GB + voxels * fsl_volumes * (itemsize + APPLY_FACTOR * 4) / GIB
+
+    if method not in ("native", "validate"):
+        return {"cpus": 1, "mem_gb": fsl_gb}
+
+    native_volumes = min(volumes, chunk_volumes or BATCH_VOLUMES)
+    workers = max(1, min(int(cpus or 1), -(-volumes // native_volumes)))
+    native_gb = voxels * (workers * native_volumes * (itemsize + NATIVE_FACTOR * 8) + NATIVE_MAP_BYTES) / GIB
+
+    mem_gb = native_gb if method == "native" else max(fsl_gb, native_gb)
+    return {"cpus": workers, "mem_gb": mem_gb}
+
+
+def qa_resources(image, reference="0", index=None):
+    """Estimates the peak memory of one file's QA, which works on 3D reference volumes (a mean is streamed)."""
+    shape, itemsize = image_header(image, index)
+    voxels = prod(shape[:3])
+    mem_gb = voxels * QA_FACTOR * 8 / GIB
+    if str(reference).lower() == "mean" and len(shape) > 3:
+        # a chunk of the original and of the corrected run
+        mem_gb += 2 * voxels * min(shape[3], REFERENCE_CHUNK_VOLUMES) * (itemsize + 8) / GIB
+    return {"cpus": 1, "mem_gb": mem_gb}
+
+
+def estimate(func, *args, **kwargs):
+    """Calls one of the estimate functions, returns no estimate if the image header can't be read."""
+    try:
+        return func(*args, **kwargs)
+    except (OSError, ValueError, KeyError, nb.filebasedimages.ImageFileError) as e:
+        log.warning("Unable to estimate resources (%s), using the defaults: %s", func.__name__, e)
+        return {}
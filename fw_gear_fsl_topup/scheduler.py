@@ -0,0 +1,332 @@
+"""Dependency aware execution of the gear's pipeline stages.
+
+The pipeline is described as a graph of named stages. A stage is either an in-process call or a command run with
+utils.command_line.exec_command. Its inputs are the results of other stages, passed as Ref placeholders in its
+arguments, and its output is its return value. Each stage runs as soon as the stages it depends on have finished, with
+at most max_workers stages running at once. Stages can add more stages while they run (e.g. one apply stage per file
+found by IntendedFor resolution).
+
+When a stage fails, the stages that depend on it are cancelled, and with fail_fast no new stages are started at all.
+Stages marked critical=False only cancel their own dependents. Start and end times of every stage are recorded.
+Stages added with checkpoint=True are skipped, reusing their recorded result, when a previous run already completed them
+with the same inputs (see checkpoint.py).
+
+Stages run in the context (contextvars) of the thread that called run(), so per session state such as the error
+tracking of batch mode (see batch.py) follows them into the worker threads.
+"""
+
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from utils.command_line import exec_command
+
+log = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# seconds between checks for resources released by other schedulers sharing the pool
+POOL_POLL_SECONDS = 1.0
+
+
+class StageError(RuntimeError):
+    """Raised by Scheduler.result for a stage that failed or was cancelled."""
+
+
+class Ref:
+    """Placeholder for the result of another stage in a stage's arguments.
+
+    Args:
+        name (str): the stage whose result is used
+        item: if given, result[item] is used instead of the whole result
+    """
+
+    def __init__(self, name, item=None):
+        self.name = name
+        self.item = item
+
+    def __repr__(self):
+        return "Ref({!r})".format(self.name) if self.item is None else "Ref({!r}, {!r})".format(self.name, self.item)
+
+
+class Stage:
+    """One node of the graph, see Scheduler.add."""
+
+    def __init__(self, name, func, args, kwargs, deps, critical=True, resources=None, checkpoint=False):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.deps = deps
+        self.critical = critical
+        self.resources = resources or {}
+        self.checkpoint = checkpoint
+        self.digest = None
+        self.resumed = False
+        self.status = PENDING
+        self.result = None
+        self.error = None
+        self.start = None
+        self.end = None
+
+    @property
+    def seconds(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+class Scheduler:
+    """Runs a graph of stages.
+
+    Args:
+        max_workers (int): maximum number of stages running at the same time
+        fail_fast (bool): stop starting new stages after a critical stage fails (running stages are left to finish)
+        dry_run (bool): passed to exec_command by command stages
+        pool (ResourcePool): if given, stages are only started while their resource estimates fit in the pool's
+            budget, and command stages run with their thread variables pinned (see resources.py)
+        checkpoints (Checkpoints): completion markers of a previous run to resume from (see checkpoint.py)
+    """
+
+    def __init__(self, max_workers=1, fail_fast=True, dry_run=False, pool=None, checkpoints=None):
+        self.max_workers = max(1, int(max_workers or 1))
+        self.fail_fast = fail_fast
+        self.dry_run = dry_run
+        self.pool = pool
+        self.checkpoints = checkpoints
+        self.stages = {}
+        self._lock = threading.RLock()
+        self._cancelled = False
+
+    def add(self, name, func, *args, after=(), critical=True, resources=None, checkpoint=False, **kwargs):
+        """Adds an in-process stage that calls func(*args, **kwargs).
+
+        Args:
+            name (str): unique stage name
+            func (callable): the stage's work, its return value is the stage result
+            after (iterable): names of stages that must finish first, in addition to the ones referenced with Ref
+            critical (bool): if False, a failure of this stage doesn't stop the rest of the pipeline
+            resources (dict): "cpus" and estimated peak "mem_gb" of the stage, used by the resource pool
+            checkpoint (bool): record the stage's completion so a rerun can skip it, its result must be json-able and
+                name the files it writes
+
+        Returns:
+            name (str): the stage name, e.g. to use in other stages' `after`
+        """
+        deps = list(dict.fromkeys(list(after) + [ref.name for ref in _refs(args) + _refs(kwargs.values())]))
+        with self._lock:
+            if name in self.stages:
+                raise ValueError("Stage {} is already defined".format(name))
+            self.stages[name] = Stage(name, func, args, kwargs, deps, critical, resources, checkpoint)
+        return name
+
+    def add_command(self, name, command, after=(), critical=True, resources=None, environ=None, cwd=None,
+                    outputs=None, checkpoint=False):
+        """Adds a stage that runs a command with exec_command.
+
+        Args:
+            command (list or Ref): the command line, or a Ref to a stage returning it (a None command skips the stage)
+            environ (dict): environment of the command
+            cwd (str): working directory of the command
+            outputs: if given (e.g. the command's output root), the stage result instead of exec_command's output
+
+        Returns:
+            name (str): the stage name
+        """
+        return self.add(name, self._run_command, name, command, environ, cwd, outputs, after=after,
+                        critical=critical, resources=resources, checkpoint=checkpoint)
+
+    def _run_command(self, name, command, environ, cwd, outputs):
+        if command is None:
+            return outputs
+        environ = self.environment(self.stages[name], environ)
+        result = exec_command(command, dry_run=self.dry_run, environ=environ, cwd=cwd)
+        return result if outputs is None else outputs
+
+    def environment(self, stage, environ):
+        """Returns the environment a command stage runs with."""
+        if self.pool is None:
+            return environ
+        return self.pool.environment(stage, environ)
+
+    def cancel(self):
+        """Stops starting new stages, stages that are already running finish."""
+        with self._lock:
+            self._cancelled = True
+
+    def run(self):
+        """Runs every stage, returns once no stage is running and nothing more can be started.
+
+        Returns:
+            ok (bool): True if all critical stages finished
+        """
+        started = time.perf_counter()
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                with self._lock:
+                    self._cancel_unreachable()
+                    for stage in self._ready(len(running)):
+                        stage.status = RUNNING
+                        stage.start = time.perf_counter()
+                        log.debug("Starting stage %s", stage.name)
+                        running[executor.submit(contextvars.copy_context().run, self._call, stage)] = stage
+
+                if not running:
+                    if not self._waiting_for_resources():
+                        break
+                    # everything left waits for resources held by another scheduler's stages
+                    self.pool.wait_for_release(POOL_POLL_SECONDS)
+                    continue
+
+                # with a pool, resources may also be released by other schedulers sharing it
+                finished, _ = wait(list(running), timeout=None if self.pool is None else POOL_POLL_SECONDS,
+                                   return_when=FIRST_COMPLETED)
+                for future in finished:
+                    self._finish(running.pop(future), future)
+
+        with self._lock:
+            for stage in self.stages.values():
+                if stage.status == PENDING:
+                    stage.status = CANCELLED
+
+        self.log_timings(time.perf_counter() - started)
+        return not self.failed(critical_only=True)
+
+    def _ready(self, n_running):
+        """Pending stages whose dependencies are done, up to the free worker slots."""
+        if self._cancelled:
+            return []
+        ready = []
+        for stage in self.stages.values():
+            if n_running + len(ready) >= self.max_workers:
+                break
+            if stage.status != PENDING:
+                continue
+            if all(dep in self.stages and self.stages[dep].status == DONE for dep in stage.deps) and \
+                    self.admit(stage):
+                ready.append(stage)
+        return ready
+
+    def _waiting_for_resources(self):
+        """True if a pending stage has all of its dependencies done, so only admission holds it back."""
+        with self._lock:
+            return not self._cancelled and self.pool is not None and any(
+                stage.status == PENDING and all(dep in self.stages and self.stages[dep].status == DONE
+                                                for dep in stage.deps)
+                for stage in self.stages.values())
+
+    def admit(self, stage):
+        """Returns True if the stage may start now, reserving its resources."""
+        return self.pool is None or self.pool.admit(stage)
+
+    def release(self, stage):
+        """Returns the resources of a stage that finished."""
+        if self.pool is not None:
+            self.pool.release(stage)
+
+    def _cancel_unreachable(self):
+        """Cancels pending stages that depend on a failed or cancelled stage."""
+        changed = True
+        while changed:
+            changed = False
+            for stage in self.stages.values():
+                if stage.status != PENDING:
+                    continue
+                blocked = [dep for dep in stage.deps if dep in self.stages and
+                           self.stages[dep].status in (FAILED, CANCELLED)]
+                if blocked:
+                    stage.status = CANCELLED
+                    stage.error = StageError("{} was not run because {} did not finish".format(stage.name, blocked[0]))
+                    log.info("Cancelled stage %s (%s did not finish)", stage.name, blocked[0])
+                    changed = True
+
+    def _call(self, stage):
+        args = [self._resolve(arg) for arg in stage.args]
+        kwargs = {key: self._resolve(value) for key, value in stage.kwargs.items()}
+        if self.checkpoints is None:
+            return stage.func(*args, **kwargs)
+
+        fingerprint = self.checkpoints.fingerprint(stage.name, stage.func, args, kwargs,
+                                                   [self.stages[dep].digest for dep in stage.deps])
+        if not stage.checkpoint:
+            # stages that always run still pass the state of their inputs on to their dependents
+            stage.digest = fingerprint
+            return stage.func(*args, **kwargs)
+
+        marker = self.checkpoints.load(stage.name, fingerprint)
+        if marker is not None:
+            log.info("Stage %s already completed, resuming after it", stage.name)
+            stage.resumed = True
+        else:
+            result = stage.func(*args, **kwargs)
+            marker = self.checkpoints.save(stage.name, fingerprint, result)
+        stage.digest = marker["digest"]
+        return marker["result"]
+
+    def _resolve(self, value):
+        if isinstance(value, Ref):
+            result = self.stages[value.name].result
+            return result if value.item is None else result[value.item]
+        if isinstance(value, (list, tuple)) and any(isinstance(item, Ref) for item in value):
+            return type(value)(self._resolve(item) for item in value)
+        return value
+
+    def _finish(self, stage, future):
+        with self._lock:
+            stage.end = time.perf_counter()
+            self.release(stage)
+            try:
+                stage.result = future.result()
+                stage.status = DONE
+                log.debug("Finished stage %s in %.1fs", stage.name, stage.seconds)
+            except Exception as e:
+                stage.status = FAILED
+                stage.error = e
+                log.warning("Stage %s failed after %.1fs: %s", stage.name, stage.seconds, e)
+                if stage.critical and self.fail_fast:
+                    self._cancelled = True
+
+    def result(self, name):
+        """Returns a stage's result.
+
+        Raises:
+            StageError: if the stage didn't finish
+        """
+        stage = self.stages[name]
+        if stage.status == FAILED:
+            raise StageError("Stage {} failed: {}".format(name, stage.error)) from stage.error
+        if stage.status != DONE:
+            raise StageError("Stage {} did not run ({})".format(name, stage.status))
+        return stage.result
+
+    def failed(self, critical_only=False):
+        """Returns the stages that failed or were cancelled."""
+        return [stage for stage in self.stages.values() if stage.status in (FAILED, CANCELLED) and
+                (stage.critical or not critical_only)]
+
+    def timings(self):
+        """Returns {stage name: seconds} for the stages that ran."""
+        return {stage.name: stage.seconds for stage in self.stages.values() if stage.seconds is not None}
+
+    def log_timings(self, total):
+        lines = ["{:<60} {:>9} {:>9.1f}s".format(stage.name, "resumed" if stage.resumed else stage.status,
+                                                 stage.seconds or 0)
+                 for stage in sorted(self.stages.values(), key=lambda s: s.start if s.start is not None else total)]
+        log.info("Ran %d stages in %.1fs:\n%s", len(self.stages), total, "\n".join(lines))
+
+
+def _refs(values):
+    refs = []
+    for value in values:
+        if isinstance(value, Ref):
+            refs.append(value)
+        elif isinstance(value, (list, tuple)):
+            refs.extend(item for item in value if isinstance(item, Ref))
+    return refs
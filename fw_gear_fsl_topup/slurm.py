@@ -0,0 +1,224 @@
+"""SLURM job array backend for the gear's command stages.
+
+With slurm_backend set, topup for every fieldmap pair is submitted as one job array and applytopup for the files of each
+pair as another array that depends on the pair's topup task (afterok), so SLURM starts each correction as soon as its
+field is estimated, spread over as many nodes as the partition gives. Each array task runs one command, with the
+slurm-* settings of the gear as the sbatch options of every task. The gear waits for all of its jobs with squeue, reads
+their final states with sacct and picks their outputs up from the shared scratch directory (gear-writable-dir), which
+must be mounted on the compute nodes.
+
+sbatch, squeue and sacct are looked up in slurm_bin_dir if it is set, so stand-in scripts with the same command line
+interface can be used to try the backend without a cluster. Commands can be prefixed (slurm_job_prefix, e.g.
+"singularity exec --bind /pl <image>") to run them in the gear's container on the compute nodes.
+"""
+
+import logging
+import os
+import shlex
+import subprocess as sp
+import threading
+import time
+
+from utils.command_line import exec_command
+
+log = logging.getLogger(__name__)
+
+# sacct states of tasks that won't change any more
+TERMINAL_STATES = ("COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "OUT_OF_MEMORY", "NODE_FAIL", "PREEMPTED",
+                   "BOOT_FAIL", "DEADLINE")
+
+# gear config keys and the sbatch options they set on every task
+SBATCH_OPTIONS = {
+    "slurm-cpu": "--cpus-per-task",
+    "slurm-ram": "--mem-per-cpu",
+    "slurm-nodes": "--nodes",
+    "slurm-partition": "--partition",
+    "slurm-qos": "--qos",
+    "slurm-account": "--account",
+    "slurm-time": "--time",
+}
+
+# times sacct is asked again for tasks it doesn't report yet (accounting lags behind squeue)
+SACCT_RETRIES = 5
+
+# consecutive squeue failures (e.g. jobs already purged from slurmctld) after which sacct decides when the jobs are done
+SQUEUE_FAILURES = 3
+
+
+class SlurmBackend:
+    """Submits commands as SLURM job arrays and waits for them.
+
+    Args:
+        script_dir (str): directory for the job scripts and task logs, on storage shared with the compute nodes
+        sbatch_options (list): options given to sbatch for every array (e.g. ["--partition=blanca-ics"])
+        max_running (int): maximum number of tasks of one array running at once (sbatch --array=...%N), 0 for no limit
+        bin_dir (str): directory holding sbatch, squeue and sacct, looked up in PATH if empty
+        job_prefix (str): prefix of every command (e.g. a container exec)
+        poll_seconds (float): time between squeue calls while waiting
+        job_name (str): name of the jobs
+    """
+
+    def __init__(self, script_dir, sbatch_options=(), max_running=0, bin_dir="", job_prefix="", poll_seconds=30,
+                 job_name="topup"):
+        self.script_dir = script_dir
+        self.sbatch_options = list(sbatch_options)
+        self.max_running = int(max_running or 0)
+        self.bin_dir = bin_dir or ""
+        self.job_prefix = shlex.split(job_prefix or "")
+        self.poll_seconds = poll_seconds
+        self.job_name = job_name
+        self.jobs = {}
+        self.sizes = {}
+        self.states = {}
+        self._lock = threading.Lock()
+        os.makedirs(script_dir, exist_ok=True)
+
+    @classmethod
+    def from_options(cls, options):
+        """Returns the backend configured in the gear options, or None if slurm_backend isn't set."""
+        if not options.get("slurm_backend"):
+            return None
+        sbatch_options = ["{}={}".format(option, options[key]) for key, option in SBATCH_OPTIONS.items()
+                          if options.get(key)]
+        return cls(os.path.join(str(options["work-dir"]), "slurm"), sbatch_options,
+                   max_running=options.get("slurm_array_limit"), bin_dir=options.get("slurm_bin_dir"),
+                   job_prefix=options.get("slurm_job_prefix"), poll_seconds=options.get("slurm_poll_seconds") or 30,
+                   job_name="topup-" + str(options.get("destination-id", "")))
+
+    def binary(self, name):
+        return os.path.join(self.bin_dir, name) if self.bin_dir else name
+
+    def submit_array(self, name, commands, dependencies=()):
+        """Submits one array task per command.
+
+        Args:
+            name (str): name of the array, used for its script and task logs
+            commands (list): command lines (lists), task i runs commands[i]
+            dependencies (iterable): task ids ("<job id>_<index>") that must complete successfully first
+
+        Returns:
+            task_ids (list): the task id of each command
+        """
+        if not commands:
+            return []
+
+        script = os.path.join(self.script_dir, name + ".sh")
+        lines = ["#!/bin/bash", 'case "$SLURM_ARRAY_TASK_ID" in']
+        for index, command in enumerate(commands):
+            lines.append("    {}) exec {} ;;".format(index, shlex.join(self.job_prefix + [str(c) for c in command])))
+        lines += ['    *) echo "unknown array task $SLURM_ARRAY_TASK_ID" >&2; exit 1 ;;', "esac", ""]
+        with open(script, "w") as f:
+            f.write("\n".join(lines))
+        os.chmod(script, 0o755)
+
+        array = "0-{}".format(len(commands) - 1)
+        if self.max_running:
+            array += "%{}".format(self.max_running)
+        command = [self.binary("sbatch"), "--parsable", "--array=" + array,
+                   "--job-name={}".format(self.job_name),
+                   "--output=" + os.path.join(self.script_dir, name + "_%A_%a.log"),
+                   "--chdir=" + self.script_dir,
+                   "--ntasks=1", "--kill-on-invalid-dep=yes"] + self.sbatch_options
+        dependencies = [task for task in dependencies if task]
+        if dependencies:
+            command.append("--dependency=afterok:" + ":".join(dependencies))
+        command.append(script)
+
+        stdout, _, _ = exec_command(command)
+        # --parsable prints "<job id>[;<cluster>]"
+        job_id = stdout.strip().splitlines()[-1].split(";")[0]
+        with self._lock:
+            self.jobs[job_id] = name
+            self.sizes[job_id] = len(commands)
+        log.info("Submitted %s as SLURM job array %s (%d tasks)", name, job_id, len(commands))
+        return ["{}_{}".format(job_id, index) for index in range(len(commands))]
+
+    def wait(self):
+        """Waits until none of the submitted jobs is queued or running, then reads the final state of every task.
+
+        Returns:
+            states (dict): {task id: (state, exit code)}
+        """
+        jobs = sorted(self.jobs)
+        if not jobs:
+            return {}
+
+        log.info("Waiting for SLURM jobs %s", ", ".join(jobs))
+        failures = 0
+        while True:
+            queued = self._query([self.binary("squeue"), "--noheader", "--format=%i", "--jobs=" + ",".join(jobs)])
+            if queued is not None and not queued.split():
+                break
+            failures = 0 if queued is not None else failures + 1
+            if failures >= SQUEUE_FAILURES:
+                # squeue can't tell (e.g. the jobs were purged from the controller), the accounting records can
+                self.states.update(self._sacct(jobs))
+                if not self._pending(jobs):
+                    log.warning("squeue failed %d times, took the final job states from sacct", failures)
+                    break
+            time.sleep(self.poll_seconds)
+
+        for attempt in range(SACCT_RETRIES):
+            self.states.update(self._sacct(jobs))
+            if not self._pending(jobs):
+                break
+            time.sleep(self.poll_seconds)
+
+        failed = [task for task, (state, _) in self.states.items() if state != "COMPLETED"]
+        log.info("SLURM jobs finished: %d tasks completed, %d did not", len(self.states) - len(failed), len(failed))
+        return dict(self.states)
+
+    def check(self, task_id):
+        """Raises RuntimeError unless an array task completed successfully (call after wait)."""
+        state, exit_code = self.states.get(task_id, ("UNKNOWN", ""))
+        if state != "COMPLETED":
+            job_id, index = task_id.split("_")
+            logs = os.path.join(self.script_dir, "{}_{}_{}.log".format(self.jobs.get(job_id, "*"), job_id, index))
+            raise RuntimeError("SLURM task {} ended {} (exit code {}), see {}".format(task_id, state, exit_code, logs))
+
+    def _pending(self, jobs):
+        """Returns the jobs that have tasks sacct doesn't report in a terminal state yet."""
+        return [job for job in jobs
+                if sum(1 for task, (state, _) in self.states.items()
+                       if task.split("_")[0] == job and state in TERMINAL_STATES) < self.sizes.get(job, 1)]
+
+    def _sacct(self, jobs):
+        output = self._query([self.binary("sacct"), "--noheader", "--parsable2", "--allocations",
+                              "--format=JobID,State,ExitCode", "--jobs=" + ",".join(jobs)]) or ""
+        states = {}
+        for line in output.splitlines():
+            fields = line.strip().split("|")
+            if len(fields) < 3 or "_" not in fields[0]:
+                continue
+            # a task that never started is reported for a range of tasks, e.g. "123_[2-5]", and is cancelled
+            job_id, tasks = fields[0].split("_", 1)
+            if job_id not in jobs:
+                continue
+            state = fields[1].split()[0] if fields[1] else "UNKNOWN"
+            for index in _task_indices(tasks):
+                states["{}_{}".format(job_id, index)] = (state, fields[2])
+        return states
+
+    def _query(self, command):
+        """Runs squeue or sacct quietly, returns its output or None if it failed (e.g. slurmctld not responding)."""
+        try:
+            result = sp.run(command, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True, check=False)
+        except OSError as e:
+            raise RuntimeError("Unable to run {}: {}".format(command[0], e)) from e
+        if result.returncode != 0:
+            log.warning("%s failed (return code %s): %s", command[0], result.returncode, result.stderr.strip())
+            return None
+        return result.stdout
+
+
+def _task_indices(tasks):
+    """Expands an array task field of sacct ("3", "[2-5]", "[1,4-6%2]") into task indices."""
+    tasks = tasks.strip("[]").split("%")[0]
+    indices = []
+    for part in tasks.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            indices.extend(range(int(start), int(end) + 1))
+        elif part.isdigit():
+            indices.append(int(part))
+    return indices
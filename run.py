@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 
 import os, sys
+import hashlib
+import json
 import logging
 import shutil
 from flywheel_gear_toolkit import GearToolkitContext
 from pathlib import Path
+from fw_gear_fsl_topup.batch import batch_sessions, run_batch
 from fw_gear_fsl_topup.main import prepare, run
 from fw_gear_fsl_topup.parser import parse_config
-from utils.singularity import run_in_tmp_dir
+from utils.singularity import is_locked_scratch_dir, run_in_tmp_dir
 
 os.chdir("/flywheel/v0")
 
@@ -35,15 +38,10 @@ def main(context: GearToolkitContext):
     return_code = 0
 
     """Parses config and runs."""
-    # For now, don't allow runs at the project level:
-    destination = context.client.get(context.destination["id"])
-    if destination.parent.type == "project":
-        log.exception(
-            "This version of the gear does not run at the project level. "
-            "Try running it for each individual subject."
-        )
-        # sys.exit(1)
-        return_code = 1
+    # project level runs (or a list of sessions in batch_sessions) process every session in this container
+    sessions = batch_sessions(context)
+    if sessions is not None:
+        return run_batch(context, sessions)
 
     # Errors and warnings will always be logged when they are detected.
     # Keep a list of errors and warning to print all in one place at end of log
@@ -93,6 +91,24 @@ def main(context: GearToolkitContext):
     return e_code
 
 
+# config that doesn't change the work of a run, left out of the scratch directory's name so e.g. a rerun at debug level
+# resumes
+SCRATCH_IGNORED_CONFIG = ("resume", "gear-log-level")
+
+
+def scratch_name(context: GearToolkitContext):
+    """Name of the scratch directory of a resumable run: <container id>-<config hash>.
+
+    The container is the analysis' parent (the session, or the project in batch mode), not the analysis itself: a
+    retry of a failed job is a new analysis, but for the same container and configuration it finds the previous run's
+    scratch directory and its stage markers.
+    """
+    container_id = context.get_destination_container().parent.id
+    config = json.dumps({key: value for key, value in context.config.items() if key not in SCRATCH_IGNORED_CONFIG},
+                        sort_keys=True, default=str)
+    return "{}-{}".format(container_id, hashlib.sha256(config.encode()).hexdigest()[:12])
+
+
 # Only execute if file is run as main, not when imported by another module
 if __name__ == "__main__":  # pragma: no cover
     # Get access to gear config, inputs, and sdk client if enabled.
@@ -103,7 +119,11 @@ if __name__ == "__main__":  # pragma: no cover
         log.parent.handlers[0].setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
         log.setLevel(gear_context.config['gear-log-level'])
 
-        scratch_dir = run_in_tmp_dir(gear_context.config["gear-writable-dir"])
+        # a stable scratch directory per container and config lets a rerun resume from the stages an interrupted run
+        # completed (see fw_gear_fsl_topup/checkpoint.py)
+        resume = gear_context.config.get("resume", False)
+        scratch_dir = run_in_tmp_dir(gear_context.config["gear-writable-dir"],
+                                     name=scratch_name(gear_context) if resume else None)
 
     # Has to be instantiated twice here, since parent directories might have
     # changed
@@ -113,13 +133,17 @@ if __name__ == "__main__":  # pragma: no cover
         return_code = main(gear_context)
 
     # clean up (might be necessary when running in a shared computing environment)
-    if scratch_dir:
+    resumable = is_locked_scratch_dir(scratch_dir)
+    if resumable and return_code != 0:
+        log.info("Keeping scratch directory %s, rerunning the gear will resume from the completed stages",
+                 scratch_dir.parents[1])
+    elif scratch_dir:
         log.debug("Removing scratch directory")
         for thing in scratch_dir.glob("*"):
             if thing.is_symlink():
                 thing.unlink()  # don't remove anything links point to
                 log.debug("unlinked %s", thing.name)
-        shutil.rmtree(scratch_dir)
+        shutil.rmtree(scratch_dir.parents[1] if resumable else scratch_dir)
         log.debug("Removed %s", scratch_dir)
 
     sys.exit(return_code)
@@ -0,0 +1,162 @@
+"""In-process applytopup engine."""
+
+import threading
+
+import nibabel as nb
+import numpy as np
+import pytest
+
+from fw_gear_fsl_topup import applytopup
+
+SHAPE = (6, 12, 5)
+READOUT = 0.05
+
+
+@pytest.fixture
+def topup(tmp_path):
+    """Writes a topup result with a uniform field and an acquisition parameters file (row 1: +y, row 2: -y)."""
+
+    def make(hz):
+        root = str(tmp_path / "topup_{}".format(hz))
+        nb.save(nb.Nifti1Image(np.full(SHAPE, hz, dtype=np.float32), np.eye(4)), root + "-fmap.nii.gz")
+        acq_params = str(tmp_path / "acqparams.txt")
+        np.savetxt(acq_params, [[0, 1, 0, READOUT], [0, -1, 0, READOUT]])
+        return root, acq_params
+
+    applytopup._maps_cache.clear()
+    return make
+
+
+@pytest.fixture
+def image(tmp_path):
+    data = np.random.default_rng(0).uniform(10, 100, SHAPE + (7,)).astype(np.float32)
+    path = str(tmp_path / "bold.nii.gz")
+    nb.save(nb.Nifti1Image(data, np.eye(4)), path)
+    return path, data
+
+
+def correct(image, root, acq_params, output, **kwargs):
+    return np.asanyarray(nb.load(applytopup.apply_topup_native(image, 1, root, acq_params, output, **kwargs)).dataobj)
+
+
+def test_zero_field_is_identity(topup, image, tmp_path):
+    root, acq_params = topup(0)
+    path, data = image
+    corrected = correct(path, root, acq_params, str(tmp_path / "out"))
+    np.testing.assert_allclose(corrected, data, rtol=1e-5)
+
+
+def test_uniform_shift_is_exact(topup, image, tmp_path):
+    # 40 Hz over a 0.05 s readout is a displacement of exactly 2 voxels along y, with a Jacobian of 1
+    root, acq_params = topup(40)
+    path, data = image
+    corrected = correct(path, root, acq_params, str(tmp_path / "out"))
+    np.testing.assert_allclose(corrected[:, :-2], data[:, 2:], rtol=1e-5)
+
+
+@pytest.mark.parametrize("chunk_volumes,workers", [(1, 1), (3, 1), (3, 2), (0, 1), (100, 1)])
+def test_output_does_not_depend_on_chunks(topup, image, tmp_path, chunk_volumes, workers):
+    root, acq_params = topup(13)
+    path, _ = image
+    whole = correct(path, root, acq_params, str(tmp_path / "whole"), chunk_volumes=7)
+    chunked = correct(path, root, acq_params, str(tmp_path / "chunked"), chunk_volumes=chunk_volumes,
+                      workers=workers)
+    np.testing.assert_array_equal(chunked, whole)
+
+
+def test_correction_maps_are_computed_once_outside_the_lock(topup, monkeypatch):
+    root, acq_params = topup(13)
+    acq_row = applytopup.read_acq_params(acq_params)[0]
+    started = threading.Barrier(2, timeout=10)
+    computed = []
+    displacement_map = applytopup.displacement_map
+
+    def slow_displacement_map(topup_out, row, affine, shape):
+        computed.append(tuple(affine[:3, 3]))
+        if affine[0, 3] in (0, 1):
+            started.wait()  # both geometries are computed at the same time, or this times out
+        return displacement_map(topup_out, row, np.eye(4), shape)
+
+    monkeypatch.setattr(applytopup, "displacement_map", slow_displacement_map)
+    affines = [np.eye(4), np.eye(4), np.eye(4)]
+    affines[2][0, 3] = 1
+    results = [None] * len(affines)
+
+    def run(i):
+        results[i] = applytopup.correction_maps(root, acq_row, affines[i], SHAPE)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(affines))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(computed) == [(0, 0, 0), (1, 0, 0)]
+    assert all(result is not None for result in results) and results[0] is results[1]
+
+
+def test_image_on_another_grid_is_refused(topup, image, tmp_path):
+    root, acq_params = topup(13)
+    _, data = image
+    shifted = np.eye(4)
+    shifted[:3, 3] = [0, 2.5, 0]
+    path = str(tmp_path / "shifted.nii.gz")
+    nb.save(nb.Nifti1Image(data, shifted), path)
+    with pytest.raises(ValueError, match="affine"):
+        correct(path, root, acq_params, str(tmp_path / "out"))
+
+
+@pytest.mark.parametrize("source", ["pair", "memory"])
+def test_chunks_of_image_pairs_and_unsaved_images(tmp_path, image, source):
+    _, data = image
+    img = nb.Nifti1Pair(data * 2, np.eye(4))
+    if source == "pair":
+        nb.save(img, str(tmp_path / "pair.img"))
+        img = nb.load(str(tmp_path / "pair.hdr"))
+    chunks = list(applytopup.iter_volume_chunks(img, 3))
+    assert [chunk.shape[3] for chunk in chunks] == [3, 3, 1]
+    np.testing.assert_array_equal(np.concatenate(chunks, axis=3), data * 2)
+
+
+def test_compare_to_fsl_tolerance(tmp_path, image):
+    path, data = image
+    close, far = str(tmp_path / "close.nii.gz"), str(tmp_path / "far.nii.gz")
+    nb.save(nb.Nifti1Image(data + 0.01 * data.max(), np.eye(4)), close)
+    nb.save(nb.Nifti1Image(data + 0.05 * data.max(), np.eye(4)), far)
+
+    assert applytopup.compare_to_fsl(path, close)
+    assert not applytopup.compare_to_fsl(path, far)
+
+    cropped = str(tmp_path / "cropped.nii.gz")
+    nb.save(nb.Nifti1Image(data[..., :3], np.eye(4)), cropped)
+    assert not applytopup.compare_to_fsl(path, cropped)
+
+
+def test_fsl_chunks_with_uncompressed_output(tmp_path, image, monkeypatch):
+    # FSLOUTPUTTYPE=NIFTI: fslroi and applytopup write .nii files
+    from fw_gear_fsl_topup import main
+
+    path, data = image
+    commands = []
+
+    def exec_command(command, **kwargs):
+        commands.append(command[0])
+        if command[0] == "fslroi":
+            nb.save(nb.Nifti1Image(data[..., int(command[3]):int(command[3]) + int(command[4])], np.eye(4)),
+                    command[2] + ".nii")
+        elif command[0] == "applytopup":
+            imain = next(arg.split("=", 1)[1] for arg in command if arg.startswith("--imain="))
+            out = next(arg.split("=", 1)[1] for arg in command if arg.startswith("--out="))
+            nb.save(nb.load(imain + ".nii"), out + ".nii")
+        elif command[0] == "fslmerge":
+            merged = np.concatenate([np.asanyarray(nb.load(c + ".nii").dataobj) for c in command[3:]], axis=3)
+            nb.save(nb.Nifti1Image(merged, np.eye(4)), command[2])
+        return "", "", 0
+
+    monkeypatch.setattr(main, "exec_command", exec_command)
+    output = str(tmp_path / "corrected.nii.gz")
+    main._applytopup_fsl(path, 1, "topup", "acqparams.txt", output, chunk_volumes=3)
+
+    assert commands == ["fslroi", "applytopup"] * 3 + ["fslmerge"]
+    np.testing.assert_array_equal(np.asanyarray(nb.load(output).dataobj), data)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["bold.nii.gz", "corrected.nii.gz"]
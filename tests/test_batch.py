@@ -0,0 +1,40 @@
+"""Batch mode: the outcome of every session, whatever happens to the others."""
+
+import json
+import logging
+from types import SimpleNamespace
+
+from fw_gear_fsl_topup import batch
+
+
+class StubContext:
+    def __init__(self, output_dir):
+        self.output_dir = str(output_dir)
+        self.config = {"batch_concurrent_sessions": 2, "QA": False}
+
+    def get_input_path(self, name):
+        return None
+
+
+def session(n):
+    return SimpleNamespace(id="ses{}".format(n), label="ses-{}".format(n))
+
+
+def test_failing_session_is_contained(tmp_path, monkeypatch):
+    def parse_config(gear_context, session=None, download_cache=None):
+        if session.id == "ses1":
+            raise RuntimeError("no BIDS curation")
+        return {"batch-label": "sub-01_" + session.label}
+
+    monkeypatch.setattr(batch, "parse_config", parse_config)
+    monkeypatch.setattr(batch.main, "prepare", lambda options: ([], []))
+    monkeypatch.setattr(batch.main, "run", lambda options, gear_context, pool=None, errors=None: 0)
+    handlers = list(logging.getLogger().handlers)
+
+    assert batch.run_batch(StubContext(tmp_path), [session(1), session(2)]) == 1
+
+    assert logging.getLogger().handlers == handlers
+    assert not (tmp_path / (batch.SUMMARY_FILE + ".tmp")).exists()
+    summary = json.loads((tmp_path / batch.SUMMARY_FILE).read_text())
+    assert [(outcome["id"], outcome["return_code"]) for outcome in summary] == [("ses1", 1), ("ses2", 0)]
+    assert summary[0]["error"] == "no BIDS curation"
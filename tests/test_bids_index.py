@@ -0,0 +1,53 @@
+"""Reuse of saved session index entries."""
+
+import json
+import os
+
+import nibabel as nb
+import numpy as np
+
+from fw_gear_fsl_topup.bids_index import SessionIndex
+
+
+def write_image(path, sidecar):
+    nb.save(nb.Nifti1Image(np.zeros((4, 4, 3, 2), dtype=np.float32), np.eye(4)), str(path))
+    with open(str(path).replace(".nii.gz", ".json"), "w") as f:
+        json.dump(sidecar, f)
+
+
+def test_unchanged_entries_are_reused(tmp_path):
+    image = tmp_path / "sub-01_dir-AP_epi.nii.gz"
+    write_image(image, {"TotalReadoutTime": 0.05})
+    index_file = str(tmp_path / "index.json")
+    SessionIndex.build(tmp_path, index_file=index_file)
+
+    index = SessionIndex.build(tmp_path, index_file=index_file)
+    assert index.metadata(str(image), "TotalReadoutTime") == 0.05
+    assert index.shape(str(image)) == (4, 4, 3, 2)
+
+
+def test_changed_sidecar_is_read_again(tmp_path):
+    image = tmp_path / "sub-01_dir-AP_epi.nii.gz"
+    write_image(image, {"TotalReadoutTime": 0.05, "IntendedFor": ["func/a.nii.gz"]})
+    index_file = str(tmp_path / "index.json")
+    SessionIndex.build(tmp_path, index_file=index_file)
+
+    sidecar = str(image).replace(".nii.gz", ".json")
+    with open(sidecar, "w") as f:
+        json.dump({"TotalReadoutTime": 0.06, "IntendedFor": ["func/b.nii.gz"]}, f)
+    os.utime(sidecar, ns=(0, os.stat(sidecar).st_mtime_ns + 10 ** 9))
+
+    index = SessionIndex.build(tmp_path, index_file=index_file)
+    assert index.metadata(str(image), "TotalReadoutTime") == 0.06
+    assert index.metadata(str(image), "IntendedFor") == ["func/b.nii.gz"]
+
+
+def test_removed_sidecar_is_noticed(tmp_path):
+    image = tmp_path / "sub-01_dir-AP_epi.nii.gz"
+    write_image(image, {"TotalReadoutTime": 0.05})
+    index_file = str(tmp_path / "index.json")
+    SessionIndex.build(tmp_path, index_file=index_file)
+
+    os.remove(str(image).replace(".nii.gz", ".json"))
+    index = SessionIndex.build(tmp_path, index_file=index_file)
+    assert index.get(str(image))["sidecar"] is None
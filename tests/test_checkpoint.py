@@ -0,0 +1,139 @@
+"""Resuming the pipeline from the completion markers of an earlier run."""
+
+import os
+import shutil
+
+import pytest
+
+from fw_gear_fsl_topup import main
+from fw_gear_fsl_topup.checkpoint import Checkpoints, Output, describe
+from fw_gear_fsl_topup.scheduler import DONE, Scheduler
+
+FILES = ("sub-01_ses-1_dir-AP_bold.nii.gz", "sub-01_ses-1_dir-PA_bold.nii.gz")
+PAIR = ["/inputs/sub-01_ses-1_dir-AP_epi.nii.gz", "/inputs/sub-01_ses-1_dir-PA_epi.nii.gz"]
+SECOND_PAIR = ["/inputs/sub-01_ses-1_acq-b_dir-AP_epi.nii.gz", "/inputs/sub-01_ses-1_acq-b_dir-PA_epi.nii.gz"]
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    """Stands in for FSL and the session inputs, counts the corrections and QA reports that run."""
+    inputs = tmp_path / "work" / "BIDS" / "sub-01" / "ses-1" / "func"
+    inputs.mkdir(parents=True)
+    for name in FILES:
+        (inputs / name).write_text(name)
+    calls = {"apply": 0, "qa": 0}
+
+    def topup_input(options):
+        root = os.path.join(options["topup-dir"], "topup_vols")
+        with open(root + ".nii.gz", "w") as f:
+            f.write("merged")
+        return root
+
+    def acq_params(options):
+        path = os.path.join(options["topup-dir"], "acqparams.txt")
+        with open(path, "w") as f:
+            f.write("0 1 0 0.05\n0 -1 0 0.05\n")
+        return path
+
+    def prepare(options, input, acq_params, topup_dir):
+        out = os.path.join(topup_dir, "topup")
+        command = ["sh", "-c", "echo field > {}_fieldcoef.nii.gz".format(out)]
+        return {"command": command, "out": out, "input": input, "cache_key": None}
+
+    def apply_one(fl, index, output_file, topup_out, acq_params, method, chunk_volumes, workers=1):
+        calls["apply"] += 1
+        shutil.copy(fl, output_file)
+        return 0
+
+    def qa(original, corrected, work_dir, output_dir, settings, topup):
+        calls["qa"] += 1
+        return {"file": os.path.basename(original), "report": ""}
+
+    monkeypatch.setattr(main, "generate_topup_input", topup_input)
+    monkeypatch.setattr(main, "generate_acquisition_params", acq_params)
+    monkeypatch.setattr(main, "prepare_topup", prepare)
+    monkeypatch.setattr(main, "locate_apply_to_files",
+                        lambda options: ([str(inputs / name) for name in FILES], ["1", "2"]))
+    monkeypatch.setattr(main, "_apply_one", apply_one)
+    monkeypatch.setattr(main, "qa_report", qa)
+
+    options = {"work-dir": str(tmp_path / "work"), "output-dir": str(tmp_path / "output"), "destination-id": "dest",
+               "resume": True, "apply_method": "fsl"}
+    os.makedirs(options["output-dir"])
+
+    def run(destination="dest", pairs=(PAIR,)):
+        run_options = dict(options, **{"destination-id": destination})
+        scheduler = Scheduler(2, checkpoints=Checkpoints.from_options(run_options))
+        main.build_pipeline(scheduler, run_options, list(pairs), {"pipeline": True, "reference": "0"})
+        assert scheduler.run()
+        return scheduler
+
+    return run, calls, inputs
+
+
+def resumed(scheduler, prefix):
+    stages = [stage for name, stage in scheduler.stages.items() if name.startswith(prefix)]
+    assert stages
+    return all(stage.resumed and stage.status == DONE for stage in stages)
+
+
+def test_rerun_resumes_apply_and_qa(pipeline):
+    run, calls, _ = pipeline
+    run()
+    assert calls == {"apply": 2, "qa": 2}
+
+    scheduler = run()
+    assert calls == {"apply": 2, "qa": 2}
+    for prefix in ("topup:", "apply:", "stage:", "qa:"):
+        assert resumed(scheduler, prefix), prefix
+
+
+def test_retry_resumes_and_stages_for_the_new_analysis(pipeline, tmp_path):
+    run, calls, _ = pipeline
+    run()
+
+    scheduler = run(destination="retry")
+    assert calls == {"apply": 2, "qa": 2}
+    for prefix in ("topup:", "apply:", "qa:"):
+        assert resumed(scheduler, prefix), prefix
+    assert not any(stage.resumed for name, stage in scheduler.stages.items() if name.startswith("stage:"))
+    for name in FILES:
+        assert (tmp_path / "work" / "retry" / "BIDS" / "sub-01" / "ses-1" / "func" /
+                ("topup-corrected-" + name)).exists()
+
+
+def test_file_intended_for_two_pairs_is_corrected_once(pipeline):
+    run, calls, _ = pipeline
+    scheduler = run(pairs=(PAIR, SECOND_PAIR))
+    assert calls == {"apply": 2, "qa": 2}
+    assert all(name.startswith(("apply:sub-01_ses-1_epi:", "stage:sub-01_ses-1_epi:", "qa:sub-01_ses-1_epi:"))
+               for name in scheduler.stages if name.startswith(("apply:", "stage:", "qa:")))
+
+
+def test_changed_input_reruns_its_file_only(pipeline):
+    run, calls, inputs = pipeline
+    run()
+    (inputs / FILES[0]).write_text("changed input")
+
+    scheduler = run()
+    assert calls == {"apply": 3, "qa": 3}
+    assert not scheduler.stages["apply:sub-01_ses-1_epi:" + FILES[0]].resumed
+    assert scheduler.stages["apply:sub-01_ses-1_epi:" + FILES[1]].resumed
+
+
+def test_missing_output_reruns_its_stage(pipeline):
+    run, calls, inputs = pipeline
+    run()
+    os.remove(inputs / ("topup-corrected-" + FILES[1]))
+
+    run()
+    assert calls == {"apply": 3, "qa": 3}
+
+
+def test_outputs_are_described_by_name(tmp_path):
+    path = tmp_path / "out.nii.gz"
+    before = describe([str(path), Output(str(path))])
+    path.write_text("written")
+    after = describe([str(path), Output(str(path))])
+    assert before[1] == after[1] == str(path)
+    assert before[0] != after[0]
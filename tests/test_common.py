@@ -0,0 +1,49 @@
+"""In-process path resolution."""
+
+import os
+
+import pytest
+
+from fw_gear_fsl_topup import main
+from fw_gear_fsl_topup.common import PathResolver
+
+
+def test_resolves_patterns_against_the_filesystem(tmp_path):
+    for name in ("sub-01_task-a_bold.nii.gz", "sub-01_task-b_bold.nii.gz", ".hidden_bold.nii.gz"):
+        (tmp_path / name).write_text("")
+    resolver = PathResolver()
+    assert resolver.resolve(str(tmp_path / "*_bold.nii.gz")) == [str(tmp_path / "sub-01_task-a_bold.nii.gz"),
+                                                                 str(tmp_path / "sub-01_task-b_bold.nii.gz")]
+    found, missing = resolver.resolve_many([tmp_path / "sub-01_task-a_bold.nii.gz", tmp_path / "nothing"])
+    assert found == [str(tmp_path / "sub-01_task-a_bold.nii.gz")]
+    assert missing == [str(tmp_path / "nothing")]
+
+
+def test_prebuilt_listing_does_not_touch_the_filesystem(monkeypatch):
+    resolver = PathResolver.from_paths(["/bids/sub-01/ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz",
+                                        "/bids/sub-01/ses-1/fmap/sub-01_ses-1_dir-AP_epi.nii.gz"])
+
+    def scandir(path):
+        raise AssertionError("listed {}".format(path))
+
+    monkeypatch.setattr(os, "scandir", scandir)
+    assert resolver.resolve("/bids/sub-01/ses-1/func/*_bold.nii.gz") == [
+        "/bids/sub-01/ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz"]
+    assert resolver.resolve("/bids/sub-01/ses-1/anat/sub-01_T1w.nii.gz") == []
+
+
+def test_apply_to_files_use_the_session_resolver(tmp_path, monkeypatch):
+    fmap = "/bids/sub-01/ses-1/fmap/sub-01_ses-1_dir-ap_epi.nii.gz"
+    options = {"inputs-dir": "/bids", "sid": "01", "Image1": fmap, "Image2": fmap.replace("dir-ap", "dir-pa"),
+               "path-resolver": PathResolver.from_paths([
+                   "/bids/sub-01/ses-1/func/sub-01_ses-1_dir-ap_bold.nii.gz",
+                   "/bids/sub-01/ses-1/func/sub-01_ses-1_dir-pa_bold.nii.gz"])}
+    intended_for = ["ses-1/func/sub-01_ses-1_dir-ap_bold.nii.gz", "ses-1/func/sub-01_ses-1_dir-pa_bold.nii.gz",
+                    "ses-1/func/sub-01_ses-1_dir-ap_sbref.nii.gz"]
+    monkeypatch.setattr(main, "find_metadata", lambda file, parameter, index=None: intended_for)
+    monkeypatch.setattr(os, "scandir", pytest.fail)
+
+    files, indices = main.locate_apply_to_files(options)
+    assert files == ["/bids/sub-01/ses-1/func/sub-01_ses-1_dir-ap_bold.nii.gz",
+                     "/bids/sub-01/ses-1/func/sub-01_ses-1_dir-pa_bold.nii.gz"]
+    assert indices == ["1", "2"]
@@ -0,0 +1,116 @@
+"""Downloading session BIDS files through the download cache, with a stub client."""
+
+import json
+import os
+
+import pytest
+
+from fw_gear_fsl_topup.download import DownloadCache, download_session_bids, list_session_files
+
+MODIFIED = 1700000000
+
+
+def bids_file(name, folder, path, intended_for=None, version=1):
+    info = {"BIDS": {"Filename": name, "Folder": folder, "Path": path}}
+    if intended_for is not None:
+        info["IntendedFor"] = intended_for
+    return {"name": name, "file_id": "id-" + name, "version": version, "size": len(name), "modified": MODIFIED,
+            "info": info}
+
+
+class StubClient:
+    """Serves a session with a fieldmap acquisition and two functional acquisitions, counts the downloads."""
+
+    def __init__(self):
+        self.downloads = []
+        self.acquisitions = {
+            "fmap": {"_id": "fmap", "files": [
+                bids_file("sub-01_ses-1_dir-AP_epi.nii.gz", "fmap", "sub-01/ses-1/fmap",
+                          intended_for=["ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz"]),
+                bids_file("sub-01_ses-1_dir-PA_epi.nii.gz", "fmap", "sub-01/ses-1/fmap"),
+            ]},
+            "rest": {"_id": "rest", "files": [
+                bids_file("sub-01_ses-1_task-rest_bold.nii.gz", "func", "sub-01/ses-1/func"),
+                bids_file("sub-01_ses-1_task-rest_bold.json", "func", "sub-01/ses-1/func"),
+            ]},
+            "nback": {"_id": "nback", "files": [
+                bids_file("sub-01_ses-1_task-nback_bold.nii.gz", "func", "sub-01/ses-1/func"),
+            ]},
+            "ignored": {"_id": "ignored", "info": {"BIDS": {"ignore": True}}, "files": [
+                bids_file("sub-01_ses-1_T1w.nii.gz", "anat", "sub-01/ses-1/anat"),
+            ]},
+        }
+
+    def get_session(self, session_id):
+        return {"_id": session_id, "files": []}
+
+    def get_session_acquisitions(self, session_id):
+        return [{"_id": acq_id, "info": acq.get("info")} for acq_id, acq in self.acquisitions.items()]
+
+    def get_acquisition(self, acq_id):
+        return self.acquisitions[acq_id]
+
+    def download_file_from_acquisition(self, acq_id, name, dest):
+        self.downloads.append(name)
+        with open(dest, "w") as f:
+            f.write(name)
+
+    def download_file_from_session(self, session_id, name, dest):
+        self.download_file_from_acquisition(session_id, name, dest)
+
+
+@pytest.fixture
+def client():
+    return StubClient()
+
+
+def test_folder_selection(client, tmp_path):
+    counts = download_session_bids(client, "ses", tmp_path / "BIDS", folders=["fmap"], n_workers=2)
+    assert counts == {"skipped": 0, "cached": 0, "downloaded": 2}
+    assert sorted(client.downloads) == ["sub-01_ses-1_dir-AP_epi.nii.gz", "sub-01_ses-1_dir-PA_epi.nii.gz"]
+    fmap = tmp_path / "BIDS" / "sub-01" / "ses-1" / "fmap"
+    assert os.path.getmtime(fmap / "sub-01_ses-1_dir-AP_epi.nii.gz") == MODIFIED
+    # sidecars are written from the file metadata when there is no json file
+    with open(fmap / "sub-01_ses-1_dir-AP_epi.json") as f:
+        assert json.load(f)["IntendedFor"] == ["ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz"]
+
+
+def test_intended_for_selection(client, tmp_path):
+    paths = ["sub-01/ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz"]
+    remotes = list_session_files(client, "ses", str(tmp_path), paths=paths)
+    assert sorted(remote["name"] for remote in remotes) == ["sub-01_ses-1_task-rest_bold.json",
+                                                           "sub-01_ses-1_task-rest_bold.nii.gz"]
+
+    download_session_bids(client, "ses", str(tmp_path), paths=paths)
+    assert "sub-01_ses-1_task-nback_bold.nii.gz" not in client.downloads
+    assert "sub-01_ses-1_T1w.nii.gz" not in client.downloads
+
+
+def test_unchanged_files_are_skipped(client, tmp_path):
+    download_session_bids(client, "ses", str(tmp_path), folders=["fmap"])
+    counts = download_session_bids(client, "ses", str(tmp_path), folders=["fmap"])
+    assert counts == {"skipped": 2, "cached": 0, "downloaded": 0}
+    assert len(client.downloads) == 2
+
+
+def test_cache_hits_and_misses(client, tmp_path):
+    cache = DownloadCache(str(tmp_path / "cache"), 1)
+    counts = download_session_bids(client, "ses", str(tmp_path / "run1"), folders=["fmap"], cache=cache)
+    assert counts == {"skipped": 0, "cached": 0, "downloaded": 2}
+
+    # another work directory, same platform versions: served from the cache
+    counts = download_session_bids(client, "ses", str(tmp_path / "run2"), folders=["fmap"], cache=cache)
+    assert counts == {"skipped": 0, "cached": 2, "downloaded": 0}
+    assert len(client.downloads) == 2
+    staged = tmp_path / "run2" / "sub-01" / "ses-1" / "fmap" / "sub-01_ses-1_dir-PA_epi.nii.gz"
+    assert staged.read_text() == "sub-01_ses-1_dir-PA_epi.nii.gz"
+
+    # a new version on the platform is a miss
+    client.acquisitions["fmap"]["files"][1]["version"] = 2
+    counts = download_session_bids(client, "ses", str(tmp_path / "run3"), folders=["fmap"], cache=cache)
+    assert counts == {"skipped": 0, "cached": 1, "downloaded": 1}
+
+
+def test_dry_run_downloads_nothing(client, tmp_path):
+    download_session_bids(client, "ses", str(tmp_path), folders=["fmap"], dry_run=True)
+    assert client.downloads == []
@@ -0,0 +1,41 @@
+"""Writing the QA metrics files."""
+
+import csv
+import json
+
+import nibabel as nb
+import numpy as np
+import pytest
+
+from fw_gear_fsl_topup import qa_metrics
+
+
+def test_undefined_metrics_are_null(tmp_path):
+    rows = [{"file": "a.nii.gz", "similarity": float("nan"), "max_displacement": 1.5, "flags": ["similarity"]},
+            {"file": "b.nii.gz", "similarity": 0.9, "max_displacement": float("inf"), "flags": []}]
+    json_path, tsv_path = qa_metrics.write_metrics(rows, str(tmp_path))
+
+    with open(json_path) as f:
+        written = json.load(f, parse_constant=lambda name: pytest.fail("json has " + name))
+    assert written[0]["similarity"] is None and written[0]["max_displacement"] == 1.5
+    assert written[1]["max_displacement"] is None
+
+    with open(tsv_path) as f:
+        table = list(csv.DictReader(f, delimiter="\t"))
+    assert table[0]["similarity"] == "n/a" and table[0]["flags"] == "similarity"
+    assert table[1]["max_displacement"] == "n/a"
+
+
+
+def test_field_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(qa_metrics, "FIELD_CACHE_SIZE", 2)
+    monkeypatch.setattr(qa_metrics, "_field_cache", qa_metrics.OrderedDict())
+    acq_params = str(tmp_path / "acqparams.txt")
+    np.savetxt(acq_params, [[0, 1, 0, 0.05], [0, -1, 0, 0.05]])
+    for n in range(4):
+        root = str(tmp_path / "topup_{}".format(n))
+        nb.save(nb.Nifti1Image(np.full((4, 4, 4), n, dtype=np.float32), np.eye(4)), root + "-fmap.nii.gz")
+        nb.save(nb.Nifti1Image(np.ones((4, 4, 4, 2), dtype=np.float32), np.eye(4)), root + "-input-corrected.nii.gz")
+        metrics = qa_metrics.field_metrics(root, acq_params, 1, lambda volume: volume > 0)
+        assert metrics["field_max_hz"] == n
+    assert len(qa_metrics._field_cache) == 2
@@ -0,0 +1,46 @@
+"""Stage resource estimates and admission."""
+
+import nibabel as nb
+import numpy as np
+import pytest
+
+from fw_gear_fsl_topup import resources
+from fw_gear_fsl_topup.resources import ResourcePool
+from fw_gear_fsl_topup.scheduler import Stage
+
+
+@pytest.fixture
+def bold(tmp_path):
+    path = str(tmp_path / "bold.nii.gz")
+    nb.save(nb.Nifti1Image(np.zeros((8, 8, 4, 40), dtype=np.int16), np.eye(4)), path)
+    return path
+
+
+def test_fsl_apply_is_single_threaded(bold):
+    assert resources.apply_resources(bold, "fsl", 10, cpus=8)["cpus"] == 1
+
+
+def test_native_apply_uses_a_cpu_per_chunk(bold):
+    assert resources.apply_resources(bold, "native", 10, cpus=8)["cpus"] == 4
+    assert resources.apply_resources(bold, "native", 10, cpus=2)["cpus"] == 2
+    assert resources.apply_resources(bold, "native", 0, cpus=8)["cpus"] == 3
+    one = resources.apply_resources(bold, "native", 10, cpus=1)["mem_gb"]
+    assert resources.apply_resources(bold, "native", 10, cpus=4)["mem_gb"] > one
+
+
+def test_pool_admits_within_budget():
+    pool = ResourcePool(4, 10)
+    big = Stage("big", None, (), {}, [], resources={"cpus": 3, "mem_gb": 8})
+    small = Stage("small", None, (), {}, [], resources={"cpus": 2, "mem_gb": 1})
+    assert pool.admit(big)
+    assert not pool.admit(small)
+    assert pool.environment(big, {})["OMP_NUM_THREADS"] == "3"
+    pool.release(big)
+    assert pool.admit(small)
+
+
+def test_oversized_stage_runs_alone():
+    pool = ResourcePool(2, 4)
+    huge = Stage("huge", None, (), {}, [], resources={"cpus": 1, "mem_gb": 16})
+    assert pool.admit(huge)
+    assert not pool.admit(Stage("next", None, (), {}, []))
@@ -0,0 +1,21 @@
+"""Stages run on threads of the gear process."""
+
+import logging
+
+import errorhandler
+
+from fw_gear_fsl_topup.scheduler import DONE, Scheduler
+
+
+def test_errors_logged_by_stages_reach_the_error_handler():
+    # a stage that logs an error without raising still fails the run (main.run checks errors.fired)
+    errors = errorhandler.ErrorHandler()
+    try:
+        scheduler = Scheduler(2)
+        scheduler.add("pair-a", logging.getLogger("fw_gear_fsl_topup.main").info, "estimating")
+        scheduler.add("pair-b", logging.getLogger("fw_gear_fsl_topup.main").error, "topup failed for pair-b")
+        assert scheduler.run()
+        assert scheduler.stages["pair-b"].status == DONE
+        assert errors.fired
+    finally:
+        errors.remove()
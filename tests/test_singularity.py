@@ -0,0 +1,39 @@
+"""Named (resumable) scratch directories."""
+
+import os
+from pathlib import Path
+
+import pytest
+
+from utils import singularity
+
+
+@pytest.fixture
+def scratch(tmp_path, monkeypatch):
+    """A writable dir, with /flywheel/v0 standing in for a read-only gear directory."""
+    fwv0 = tmp_path / "missing" / "flywheel" / "v0"
+    monkeypatch.setattr(singularity, "FWV0", str(fwv0))
+    monkeypatch.setattr(singularity, "_scratch_lock", None)
+    monkeypatch.chdir(tmp_path)
+    writable = tmp_path / "writable"
+    writable.mkdir()
+    return writable
+
+
+def test_named_scratch_dir_keeps_a_real_work_dir(scratch):
+    named = scratch / (singularity.SCRATCH_NAME + "ses-config")
+    old_work = Path(str(named) + singularity.FWV0) / "work"
+    old_work.parent.mkdir(parents=True)
+    old_work.symlink_to(scratch)  # left by a run that linked work
+
+    new_fwv0 = singularity.run_in_tmp_dir(str(scratch), name="ses-config")
+    assert (new_fwv0 / "work").is_dir() and not (new_fwv0 / "work").is_symlink()
+    assert singularity.is_locked_scratch_dir(new_fwv0)
+
+
+def test_locked_scratch_dir_is_not_shared(scratch):
+    first = singularity.run_in_tmp_dir(str(scratch), name="ses-config")
+    second = singularity.run_in_tmp_dir(str(scratch), name="ses-config")
+    assert singularity.is_locked_scratch_dir(first)
+    assert not singularity.is_locked_scratch_dir(second)
+    assert not os.path.islink(second / "work")
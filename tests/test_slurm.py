@@ -0,0 +1,129 @@
+"""SLURM job array backend against stand-in sbatch, squeue and sacct scripts."""
+
+import os
+import stat
+
+import pytest
+
+from fw_gear_fsl_topup import slurm
+from fw_gear_fsl_topup.slurm import SlurmBackend, _task_indices
+
+SBATCH = """#!/bin/bash
+# records its arguments, runs every array task right away and records "<job>_<task>|<state>|<exit code>"
+echo "$@" >> {bin}/sbatch.log
+for a in "$@"; do
+  case $a in --array=*) range=${{a#--array=}}; range=${{range%%%*}};; --output=*) out=${{a#--output=}};; esac
+done
+job=$(( $(cat {bin}/next 2>/dev/null || echo 100) ))
+echo $((job + 1)) > {bin}/next
+for i in $(seq ${{range%-*}} ${{range#*-}}); do
+  log=${{out//%A/$job}}; log=${{log//%a/$i}}
+  if SLURM_ARRAY_TASK_ID=$i bash "${{@: -1}}" > "$log" 2>&1; then echo "${{job}}_$i|COMPLETED|0:0" >> {bin}/acct
+  else echo "${{job}}_$i|FAILED|1:0" >> {bin}/acct; fi
+done
+echo "$job;cluster"
+"""
+
+# prints the queued jobs, or fails like squeue does for jobs purged from the controller
+SQUEUE = """#!/bin/bash
+echo "$@" >> {bin}/squeue.log
+if [ -e {bin}/purged ]; then echo "slurm_load_jobs error: Invalid job id specified" >&2; exit 1; fi
+cat {bin}/queue 2>/dev/null || true
+"""
+
+SACCT = """#!/bin/bash
+cat {bin}/acct 2>/dev/null
+echo "99_[3-4]|CANCELLED by 0|0:0"
+"""
+
+
+@pytest.fixture
+def bin_dir(tmp_path):
+    path = tmp_path / "bin"
+    path.mkdir()
+    for name, script in (("sbatch", SBATCH), ("squeue", SQUEUE), ("sacct", SACCT)):
+        (path / name).write_text(script.format(bin=path))
+        (path / name).chmod((path / name).stat().st_mode | stat.S_IEXEC)
+    return path
+
+
+def backend(tmp_path, bin_dir, **options):
+    options = dict({"slurm_backend": True, "work-dir": str(tmp_path / "work"), "slurm_bin_dir": str(bin_dir),
+                    "slurm_poll_seconds": 0.01, "destination-id": "dest", "slurm-partition": "short"}, **options)
+    return SlurmBackend.from_options(options)
+
+
+def test_disabled_without_slurm_backend(tmp_path):
+    assert SlurmBackend.from_options({"work-dir": str(tmp_path)}) is None
+
+
+def test_submits_one_task_per_command(tmp_path, bin_dir):
+    b = backend(tmp_path, bin_dir)
+    out = tmp_path / "out.txt"
+    topup = b.submit_array("topup", [["sh", "-c", "echo field > {}".format(out)], ["echo", "two words"]])
+    apply = b.submit_array("apply", [["true"]], dependencies=[topup[0], None])
+    assert topup == ["100_0", "100_1"]
+    assert apply == ["101_0"]
+
+    calls = (bin_dir / "sbatch.log").read_text().splitlines()
+    assert "--array=0-1" in calls[0].split()
+    assert "--partition=short" in calls[0].split()
+    assert "--job-name=topup-dest" in calls[0].split()
+    assert "--dependency=afterok:100_0" in calls[1].split()
+    assert out.read_text() == "field\n"
+    assert "'two words'" in open(os.path.join(b.script_dir, "topup.sh")).read()
+
+
+def test_array_limit(tmp_path, bin_dir):
+    unlimited = backend(tmp_path, bin_dir, **{"slurm-ntasks": "1"})
+    unlimited.submit_array("topup", [["true"], ["true"]])
+    limited = backend(tmp_path, bin_dir, slurm_array_limit=2)
+    limited.submit_array("topup", [["true"], ["true"], ["true"]])
+
+    calls = [call.split() for call in (bin_dir / "sbatch.log").read_text().splitlines()]
+    assert "--array=0-1" in calls[0]
+    assert "--array=0-2%2" in calls[1]
+
+
+def test_wait_reads_final_states_from_sacct(tmp_path, bin_dir):
+    b = backend(tmp_path, bin_dir)
+    tasks = b.submit_array("topup", [["true"], ["false"]])
+    states = b.wait()
+
+    assert states == {tasks[0]: ("COMPLETED", "0:0"), tasks[1]: ("FAILED", "1:0")}
+    assert "--jobs=100" in (bin_dir / "squeue.log").read_text().split()
+    b.check(tasks[0])
+    with pytest.raises(RuntimeError, match=r"100_1 ended FAILED .*topup_100_1.log"):
+        b.check(tasks[1])
+
+
+def test_wait_polls_until_the_queue_is_empty(tmp_path, bin_dir, monkeypatch):
+    b = backend(tmp_path, bin_dir)
+    tasks = b.submit_array("topup", [["true"]])
+    (bin_dir / "queue").write_text("100_0\n")
+    polls = []
+
+    def sleep(seconds):
+        polls.append(seconds)
+        if len(polls) == 3:
+            os.remove(bin_dir / "queue")
+
+    monkeypatch.setattr(slurm.time, "sleep", sleep)
+    assert b.wait() == {tasks[0]: ("COMPLETED", "0:0")}
+    assert len(polls) == 3
+
+
+def test_wait_falls_back_to_sacct_when_squeue_fails(tmp_path, bin_dir, monkeypatch):
+    b = backend(tmp_path, bin_dir)
+    tasks = b.submit_array("topup", [["true"], ["true"]])
+    (bin_dir / "purged").write_text("")
+    monkeypatch.setattr(slurm.time, "sleep", lambda seconds: None)
+
+    assert b.wait() == {tasks[0]: ("COMPLETED", "0:0"), tasks[1]: ("COMPLETED", "0:0")}
+    assert len((bin_dir / "squeue.log").read_text().splitlines()) == slurm.SQUEUE_FAILURES
+
+
+def test_task_indices():
+    assert _task_indices("3") == [3]
+    assert _task_indices("[2-4]") == [2, 3, 4]
+    assert _task_indices("[1,4-6%2]") == [1, 4, 5, 6]
@@ -7,8 +7,9 @@ from flywheel_gear_toolkit import GearToolkitContext
 import logging
 os.chdir("/flywheel/v0")
 
-from fw_gear_fsl_topup.main import generate_topup_input, generate_acquisition_params, run_topup, \
-    locate_fieldmap_pairs, locate_apply_to_files, apply_topup
+from fw_gear_fsl_topup.main import generate_topup_input, generate_acquisition_params, prepare_topup, \
+    finish_topup, locate_fieldmap_pairs, locate_apply_to_files, apply_topup_file
+from utils.command_line import exec_command
 
 log = logging.getLogger(__name__)
 
@@ -42,7 +43,10 @@ for imgs in pairs:
 
     acq_input = generate_acquisition_params(options)
 
-    # topup_out = run_topup(options, topup_input, acq_input, topup_dir)
+    # prepared = prepare_topup(options, topup_input, acq_input, topup_dir)
+    # if prepared["command"]:
+    #     exec_command(prepared["command"])
+    # topup_out = finish_topup(options, prepared)
     topup_out = '/flywheel/v0/work/topup/topup'
 
     log.info('Checking intended-fors')
@@ -51,4 +55,7 @@ for imgs in pairs:
 
     # Try to apply topup to input files
     log.info('Applying Topup Correction')
-    corrected_files = apply_topup(apply_to_files, acq_param_idxs, topup_out, acq_input)
\ No newline at end of file
+    corrected_files = [apply_topup_file(fl, index,
+                                        op.join(op.dirname(fl), 'topup-corrected-{}'.format(op.basename(fl))),
+                                        topup_out, acq_input)
+                       for fl, index in zip(apply_to_files, acq_param_idxs)]
\ No newline at end of file
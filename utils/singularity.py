@@ -1,6 +1,7 @@
 """Do what it takes to be able to run gears in Singularity.
 """
 
+import fcntl
 import logging
 import os
 import re
@@ -13,14 +14,25 @@ log = logging.getLogger(__name__)
 
 FWV0 = "/flywheel/v0"
 SCRATCH_NAME = "gear-temp-dir-"
+LOCK_NAME = ".lock"
 
+# directories of a named scratch directory that are real directories kept across runs, not links to the job's own
+PERSISTENT_DIRS = ("work",)
 
-def run_in_tmp_dir(writable_dir):
+# the named scratch directory this process holds the lock of, and the lock's open file, held until the process exits
+_scratch_lock = None
+
+
+def run_in_tmp_dir(writable_dir, name=None):
     """Copy gear to a temporary directory and cd to there.
 
     Args:
         writable_dir (string): directory to use for temporary files if /flywheel/v0 is not
             writable.
+        name (string): if given, the directory is <writable_dir>/gear-temp-dir-<name> and is reused
+            if it already exists, so a rerun (e.g. for the same session and config) finds the previous
+            run's work directory. Its work directory is real storage, not a link to the job's. If another
+            running gear holds the directory's lock, a new temporary directory is used instead
 
     Returns:
         tmp_path (path) The path to the temporary directory so it can be deleted
@@ -60,19 +72,69 @@ def run_in_tmp_dir(writable_dir):
     # be deleted mid-run.  A very confusing error to debug!
 
     # Create temporary place to run gear
-    WD = tempfile.mkdtemp(prefix=SCRATCH_NAME, dir=writable_dir)
+    WD = None
+    if name:
+        WD = os.path.join(writable_dir, SCRATCH_NAME + name)
+        reused = os.path.isdir(WD)
+        if not lock_scratch_dir(WD):
+            log.warning("Gear scratch directory %s is in use by another run, not resuming", WD)
+            WD = None
+        elif reused:
+            log.info("Reusing gear scratch directory %s", WD)
+    if WD is None:
+        name = None
+        WD = tempfile.mkdtemp(prefix=SCRATCH_NAME, dir=writable_dir)
     log.debug("Gear scratch directory is %s", WD)
 
     new_FWV0 = Path(WD + FWV0)
-    new_FWV0.mkdir(parents=True)
+    new_FWV0.mkdir(parents=True, exist_ok=True)
+    if name:
+        for persistent in PERSISTENT_DIRS:
+            directory = new_FWV0 / persistent
+            if directory.is_symlink():
+                directory.unlink()  # left by a run that linked it
+            directory.mkdir(exist_ok=True)
     abs_path = Path(".").resolve()
     names = list(Path(FWV0).glob("*"))
-    for name in names:
-        if name.name == "gear_environ.json":  # always use real one, not dev
-            (new_FWV0 / name.name).symlink_to(Path(FWV0) / name.name)
+    for path in names:
+        link = new_FWV0 / path.name
+        if link.is_symlink():
+            link.unlink()  # links of a previous run, recreated below
+        elif link.exists():
+            continue
+        if path.name == "gear_environ.json":  # always use real one, not dev
+            link.symlink_to(Path(FWV0) / path.name)
         else:
-            (new_FWV0 / name.name).symlink_to(abs_path / name.name)
+            link.symlink_to(abs_path / path.name)
     os.chdir(new_FWV0)  # run in /tmp/... directory so it is writeable
     log.debug("cwd is %s", Path.cwd())
 
     return new_FWV0
+
+
+def lock_scratch_dir(scratch_dir):
+    """Takes the exclusive lock of a named scratch directory, creating the directory if needed.
+
+    The lock is an flock on <scratch_dir>/.lock rather than a lock file that has to be removed, so the lock of a run
+    that is killed (e.g. preempted) is released with its process and its retry can take it.
+
+    Returns:
+        locked (bool): False if another process holds the lock
+    """
+    global _scratch_lock
+    os.makedirs(scratch_dir, exist_ok=True)
+    fd = os.open(os.path.join(scratch_dir, LOCK_NAME), os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    _scratch_lock = (scratch_dir, fd)
+    return True
+
+
+def is_locked_scratch_dir(scratch_dir):
+    """Whether scratch_dir (the path run_in_tmp_dir returned) is in the named directory this process holds the lock
+    of, i.e. the one a rerun resumes from."""
+    return _scratch_lock is not None and scratch_dir is not None and \
+        Path(_scratch_lock[0]) in Path(scratch_dir).parents